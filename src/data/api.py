@@ -1,14 +1,21 @@
 from datetime import datetime
 import os
-import time
-import requests
 import json
+import numpy as np
 import api_endpoints
+import fetch
+import instruments
+import rate_limit
+import raw_store
 import functools
-from itertools import repeat
+from contextlib import ExitStack
 import logging
 
 
+RAW_DIR = './data/raw'
+# first date fetched for series never fetched before
+START_DATE = datetime(2019, 12, 31)
+
 symbols = {
     'bitcoin': 'BTC',
     'ethereum': 'ETH'
@@ -29,29 +36,40 @@ def safe_query(func):
 
 
 @safe_query
-def get_coingecko_symbol(symbol: str, start: datetime) -> dict:
-    api_url = api_endpoints.coingecko_history(symbol, start_date=start)
-    raw = requests.get(api_url)
+def get_coingecko_symbol(symbol: str, start: datetime, end: datetime = None) -> dict:
+    api_url = api_endpoints.coingecko_history(symbol, start_date=start, end_date=end)
+    raw = fetch.get(api_url)
     data = raw.json()
 
     return data
 
 
+@safe_query
+def get_deribit_instruments(coin: str, expired: bool = False) -> list:
+    api_url = api_endpoints.deribit_all_instruments(coin, expired=expired)
+    raw = fetch.get(api_url)
+    return raw.json()['result']
+
+
 @safe_query
 def get_deribit_symbols(coin: str) -> list:
-    api_url = api_endpoints.deribit_all_instruments(coin)
-    raw = requests.get(api_url)
-    data = raw.json()['result']
-    symbols = [s['instrument_name'] for s in data if s['kind'] == 'option']
+    """Names of the active options of coin. Every option instrument, active
+    and expired, is also added to the instrument catalog (see instruments.py)
+    with its creation date, tick size, min trade size, etc...
+    """
+    # a failed query returns {}: the catalog keeps what it had
+    active = get_deribit_instruments(coin) or []
+    expired = get_deribit_instruments(coin, expired=True) or []
+    if active or expired:
+        instruments.update(coin, active + expired)
 
-    # TODO: save other data as creation date, ticker size, min trade size, etc...
-    return symbols
+    return [s['instrument_name'] for s in active if s['kind'] == 'option']
 
 
 @safe_query
-def get_deribit_symbol(symbol: str, start: datetime) -> dict:
-    api_url = api_endpoints.deribit_history(symbol, start_date=start)
-    raw = requests.get(api_url)
+def get_deribit_symbol(symbol: str, start: datetime, end: datetime = None) -> dict:
+    api_url = api_endpoints.deribit_history(symbol, start_date=start, end_date=end)
+    raw = fetch.get(api_url)
     data = raw.json()['result']
 
     return data
@@ -60,82 +78,242 @@ def get_deribit_symbol(symbol: str, start: datetime) -> dict:
 @safe_query
 def get_deribit_ticker(symbol: str) -> dict:
     api_url = api_endpoints.deribit_ticker(symbol)
-    raw = requests.get(api_url)
+    raw = fetch.get(api_url)
     data = raw.json()['result']
 
     return data
 
 
-@safe_query
-def get_deribit_volatility(symbol: str, start_date: datetime, end_date=datetime.now()) -> dict:
-    api_url = api_endpoints.deribit_volatility(symbol, start_date=start_date, end_date=end_date)
-    raw = requests.get(api_url)
-    data = raw.json()['result']
+def iter_deribit_volatility(
+        symbol: str,
+        start_date: datetime,
+        end_date: datetime = None,
+        continuation: int = None):
+    """Yields (page, continuation) for every page of volatility history,
+    newest first. continuation is the token of the next page (None on the
+    last one); pass it back to resume after a failure.
+    """
+    if continuation:
+        end_date = datetime.fromtimestamp(continuation / 1000)
+    end_date = end_date or datetime.now()
 
-    if data['continuation']:
-        new_end_date = datetime.fromtimestamp(data['continuation'] / 1000)
-        data['data'] += get_deribit_volatility(symbol, new_end_date)['data']
+    while True:
+        api_url = api_endpoints.deribit_volatility(symbol, start_date=start_date, end_date=end_date)
+        raw = fetch.get(api_url)
+        data = raw.json()['result']
+        continuation = data['continuation']
 
-    return data
+        yield data, continuation
+
+        if not continuation:
+            return
+        end_date = datetime.fromtimestamp(continuation / 1000)
 
 
 @safe_query
-def get_glassnode_active(symbol: str) -> dict:
-    api_url = api_endpoints.glassnode_active(symbol)
-    raw = requests.get(api_url)
-    data = raw.json()
+def get_deribit_volatility(symbol: str, start_date: datetime, end_date: datetime = None) -> dict:
+    data = {'data': [], 'continuation': None}
+    for page, _ in iter_deribit_volatility(symbol, start_date, end_date):
+        data['data'].extend(page['data'])
 
     return data
 
 
 @safe_query
-def get_glassnode_volume(symbol: str) -> dict:
-    api_url = api_endpoints.glassnode_volume(symbol)
-    raw = requests.get(api_url)
+def get_glassnode_active(symbol: str, start: datetime = None, end: datetime = None) -> dict:
+    api_url = api_endpoints.glassnode_active(symbol, start, end)
+    raw = fetch.get(api_url)
     data = raw.json()
 
     return data
 
 
 @safe_query
-def get_glassnode_tx(symbol: str) -> dict:
-    api_url = api_endpoints.glassnode_tx(symbol)
-    raw = requests.get(api_url)
+def get_glassnode_volume(symbol: str, start: datetime = None, end: datetime = None) -> dict:
+    api_url = api_endpoints.glassnode_volume(symbol, start, end)
+    raw = fetch.get(api_url)
     data = raw.json()
 
     return data
 
 
 @safe_query
-def get_glassnode_history(symbol: str, start: datetime) -> dict:
-    api_url = api_endpoints.glassnode_history(symbol, start)
-    raw = requests.get(api_url)
+def get_glassnode_tx(symbol: str, start: datetime = None, end: datetime = None) -> dict:
+    api_url = api_endpoints.glassnode_tx(symbol, start, end)
+    raw = fetch.get(api_url)
     data = raw.json()
 
     return data
 
 
 @safe_query
-def get_polygon_symbol(symbol: str, start_date: datetime = datetime(2019, 12, 31)) -> dict:
-    time.sleep(60/5) # max: 5 requests per second
-        
-    api_url = api_endpoints.polygon_history(symbol, start_date = start_date)
-    raw = requests.get(api_url)
+def get_glassnode_history(symbol: str, start: datetime, end: datetime = None) -> dict:
+    api_url = api_endpoints.glassnode_history(symbol, start, end)
+    raw = fetch.get(api_url)
     data = raw.json()
 
-    last_timestamp = data['results'][-1]['t']/1000
-    if last_timestamp < datetime.timestamp(datetime.now().replace(hour=0)):
-        new_start_date = datetime.fromtimestamp(last_timestamp)
-        data['results'] += get_polygon_symbol(symbol, new_start_date)['results']
+    return data
+
+
+def iter_polygon_symbol(
+        symbol: str,
+        start_date: datetime = datetime(2019, 12, 31),
+        continuation: int = None,
+        end_date: datetime = None):
+    """Yields (page, continuation) for every page of price history, oldest
+    first, up to end_date (default: now). continuation is the timestamp (ms)
+    of the last bar yielded; pass it back to resume after a failure. Pages
+    restart at the day of the last bar, so bars already yielded are dropped.
+    """
+    end_date = end_date or datetime.now()
+    last_day = datetime.timestamp(end_date.replace(hour=0))
+
+    while True:
+        if continuation:
+            start_date = datetime.fromtimestamp(continuation / 1000)
+        api_url = api_endpoints.polygon_history(symbol, start_date=start_date, end_date=end_date)
+        raw = fetch.get(api_url)
+        data = raw.json()
+
+        results = [d for d in data.get('results', []) if not continuation or d['t'] > continuation]
+        if not results:
+            return
+        data['results'] = results
+        continuation = results[-1]['t']
+
+        yield data, continuation
+
+        if continuation / 1000 >= last_day:
+            return
+
+
+@safe_query
+def get_polygon_symbol(symbol: str, start_date: datetime = datetime(2019, 12, 31),
+                       end_date: datetime = None) -> dict:
+    data = {}
+    for page, _ in iter_polygon_symbol(symbol, start_date, end_date=end_date):
+        results = data.get('results', [])
+        results.extend(page['results'])
+        data = {**page, 'results': results}
 
     return data
 
 
-def save_asset(coin: str, folder: str, data):
-    with open(f'./data/raw/{folder}/{coin}.json', 'w') as raw:
+def save_asset(coin: str, folder: str, data, raw_dir: str = RAW_DIR):
+    with open(f'{raw_dir}/{folder}/{coin}.json', 'w') as raw:
         json.dump(data, raw)
 
 
+def save_columns(coin: str, folder: str, columns: dict, raw_dir: str = RAW_DIR):
+    """Saves columns as a columnar snapshot in {raw_dir}/{folder}/{coin}
+    (see raw_store)
+    """
+    raw_store.save(f'{raw_dir}/{folder}/{coin}', columns)
+
+
+def concat_column(chunks: list, dtype) -> np.ndarray:
+    return np.concatenate([np.asarray(c, dtype=dtype) for c in chunks]) if chunks else np.empty(0, dtype)
+
+
+def glassnode_columns(data: list) -> dict:
+    """Glassnode metric response -> columns t (s), v"""
+    return {
+        't': np.array([d['t'] for d in data], dtype=np.int64),
+        'v': np.array([d['v'] for d in data], dtype=np.float64),
+    }
+
+
+def glassnode_ohlc_columns(data: list) -> dict:
+    """Glassnode ohlc response -> columns t (s), open, high, low, close"""
+    return {
+        't': np.array([d['t'] for d in data], dtype=np.int64),
+        'open': np.array([d['o']['o'] for d in data], dtype=np.float64),
+        'high': np.array([d['o']['h'] for d in data], dtype=np.float64),
+        'low': np.array([d['o']['l'] for d in data], dtype=np.float64),
+        'close': np.array([d['o']['c'] for d in data], dtype=np.float64),
+    }
+
+
+def coingecko_volume_columns(data: dict) -> dict:
+    """Coingecko market chart response -> columns t (ms), v (total volume)"""
+    volumes = data.get('total_volumes', [])
+    return {
+        't': np.array([d[0] for d in volumes], dtype=np.int64),
+        'v': np.array([d[1] for d in volumes], dtype=np.float64),
+    }
+
+
+def contracts_columns(history: dict) -> dict:
+    """{contract: deribit chart response} -> one row per contract and tick,
+    columns contract, t (ms), volume, open, low, high, close
+    """
+    contracts = [c for c, data in history.items() if data.get('ticks')]
+    lengths = [len(history[c]['ticks']) for c in contracts]
+    columns = {'contract': np.repeat(np.array(contracts, dtype=str), lengths)}
+    columns['t'] = concat_column([history[c]['ticks'] for c in contracts], np.int64)
+    for key in ['volume', 'open', 'low', 'high', 'close']:
+        columns[key] = concat_column([history[c][key] for c in contracts], np.float64)
+    return columns
+
+
+@safe_query
+def stream_asset(coin: str, folder: str, pages, key: str, timestamp=None, raw_dir: str = RAW_DIR) -> dict:
+    """Writes pages, as yielded by the iter_* paginators, to the same file as
+    save_asset({key: [...all page[key] items]}) while they arrive, so the
+    whole history is never held in memory.
+    Progress goes to {coin}.json.part and the continuation token to
+    {coin}.json.token; if the run fails, they are kept and resume_token
+    returns the token to restart the paginator from.
+    timestamp: function item -> timestamp (s), to track the newest item
+    Returns: stream state (items written, newest timestamp as 'last')
+    """
+    path = f'{raw_dir}/{folder}/{coin}.json'
+    state = load_stream_state(path)
+    finished = state is not None and state['items'] and state['continuation'] is None
+
+    with open(f'{path}.part', 'r+' if state else 'w') as part:
+        if state:
+            # drop whatever was written after the last saved token
+            part.seek(state['offset'])
+            part.truncate()
+        else:
+            part.write(f'{{{json.dumps(key)}: [')
+            state = {'continuation': None, 'items': 0, 'last': None}
+        for page, continuation in ([] if finished else pages):
+            for item in page[key]:
+                part.write(', ' if state['items'] else '')
+                json.dump(item, part)
+                state['items'] += 1
+            if timestamp and page[key]:
+                state['last'] = max(state['last'] or 0, *map(timestamp, page[key]))
+            part.flush()
+            state['continuation'] = continuation
+            state['offset'] = part.tell()
+            with open(f'{path}.token', 'w') as token:
+                json.dump(state, token)
+        part.write(']}')
+
+    os.replace(f'{path}.part', path)
+    if os.path.exists(f'{path}.token'):
+        os.remove(f'{path}.token')
+
+    return state
+
+
+def load_stream_state(path: str) -> dict:
+    """State of an unfinished stream_asset to path, None if there is none"""
+    if not (os.path.exists(f'{path}.part') and os.path.exists(f'{path}.token')):
+        return None
+    with open(f'{path}.token') as token:
+        return json.load(token)
+
+
+def resume_token(coin: str, folder: str, raw_dir: str = RAW_DIR):
+    """Continuation token of an unfinished stream_asset, None if there is none"""
+    state = load_stream_state(f'{raw_dir}/{folder}/{coin}.json')
+    return state['continuation'] if state else None
+
+
 def mkdir_if_exists(path):
     """This function creates a directory, specified in path if it doesn't exist.
     If it does, it does nothing.
@@ -144,34 +322,118 @@ def mkdir_if_exists(path):
         os.mkdir(path)
 
 
-def main(start: datetime, end: datetime):
-    mkdir_if_exists('./data/raw/onchain')
-    mkdir_if_exists('./data/raw/onchain/tx')
-    mkdir_if_exists('./data/raw/onchain/volume')
-    mkdir_if_exists('./data/raw/onchain/active')
-    mkdir_if_exists('./data/raw/contracts')
-    mkdir_if_exists('./data/raw/contracts/metadata')
-    mkdir_if_exists('./data/raw/contracts/data')
-    mkdir_if_exists('./data/raw/underlying')
-    mkdir_if_exists('./data/raw/underlying/price')
-    mkdir_if_exists('./data/raw/underlying/volume')
-    mkdir_if_exists('./data/raw/underlying/recent')
-    mkdir_if_exists('./data/raw/underlying/dvol')
+def since(watermarks: dict, start: datetime, *series) -> datetime:
+    """Start date to fetch a series from: right after its watermark (the
+    newest timestamp already fetched), or start if it has none.
+    series: (provider, metric, coin, contract)
+    """
+    mark = watermarks.get(series)
+    return datetime.fromtimestamp(mark + 1) if mark is not None else start
+
+
+def newest(timestamps) -> float:
+    """Newest of timestamps (s), None if empty"""
+    return max(timestamps, default=None)
+
+
+def main(
+        start: datetime = START_DATE,
+        end: datetime = None,
+        watermarks: dict = None,
+        raw_dir: str = RAW_DIR) -> dict:
+    """Requests every series from the apis and saves them in raw_dir.
+    start: first date to fetch for series without a watermark
+    end: last date to fetch (default: now)
+    watermarks: {(provider, metric, coin, contract): newest timestamp (s)
+        already fetched}. contract is '' for non-contract series
+    raw_dir: folder the raw snapshots are saved to
+    Returns: the watermarks of the data fetched in this run
+    """
+    end = end or datetime.now()
+    watermarks = watermarks or {}
+    new_watermarks = {}
+
+    mkdir_if_exists(raw_dir)
+    mkdir_if_exists(f'{raw_dir}/onchain')
+    mkdir_if_exists(f'{raw_dir}/onchain/tx')
+    mkdir_if_exists(f'{raw_dir}/onchain/volume')
+    mkdir_if_exists(f'{raw_dir}/onchain/active')
+    mkdir_if_exists(f'{raw_dir}/contracts')
+    mkdir_if_exists(f'{raw_dir}/contracts/metadata')
+    mkdir_if_exists(f'{raw_dir}/contracts/data')
+    mkdir_if_exists(f'{raw_dir}/underlying')
+    mkdir_if_exists(f'{raw_dir}/underlying/price')
+    mkdir_if_exists(f'{raw_dir}/underlying/volume')
+    mkdir_if_exists(f'{raw_dir}/underlying/recent')
+    mkdir_if_exists(f'{raw_dir}/underlying/dvol')
 
     for coin_name, coin in symbols.items():
         contracts = get_deribit_symbols(coin)
-
-        save_asset(coin, 'onchain/tx', get_glassnode_tx(coin))
-        save_asset(coin, 'onchain/volume', get_glassnode_volume(coin))
-        save_asset(coin, 'onchain/active', get_glassnode_active(coin))
-        save_asset(coin, 'contracts/metadata', dict(zip(contracts,
-            map(get_deribit_ticker, contracts))))
-        save_asset(coin, 'contracts/data', dict(zip(contracts,
-            map(get_deribit_symbol, contracts, repeat(start)))))
-        save_asset(coin, 'underlying/price', get_glassnode_history(coin, start))
-        save_asset(coin, 'underlying/volume', get_coingecko_symbol(coin_name))
-        save_asset(coin, 'underlying/recent', get_polygon_symbol(coin, start_date=start))
-        save_asset(coin, 'underlying/dvol', get_deribit_volatility(coin, start))
+        starts = [since(watermarks, start, 'deribit', 'history', coin, c) for c in contracts]
+
+        # every provider gets its own pool, sized from its concurrency, so
+        # the thousands of deribit requests never queue the other providers
+        with ExitStack() as stack:
+            pools = {provider: stack.enter_context(fetch.executor(provider))
+                     for provider in fetch.DEFAULT_CONCURRENCY}
+            deribit, glassnode = pools['deribit'], pools['glassnode']
+            dvol = deribit.submit(stream_asset, coin, 'underlying/dvol',
+                iter_deribit_volatility(coin, since(watermarks, start, 'deribit', 'dvol', coin, ''),
+                    end, resume_token(coin, 'underlying/dvol', raw_dir)),
+                'data', lambda d: d[0] / 1000, raw_dir)
+            tickers = deribit.map(get_deribit_ticker, contracts)
+            history = deribit.map(functools.partial(get_deribit_symbol, end=end), contracts, starts)
+            tx = glassnode.submit(get_glassnode_tx, coin,
+                since(watermarks, None, 'glassnode', 'tx', coin, ''), end)
+            volume = glassnode.submit(get_glassnode_volume, coin,
+                since(watermarks, None, 'glassnode', 'volume', coin, ''), end)
+            active = glassnode.submit(get_glassnode_active, coin,
+                since(watermarks, None, 'glassnode', 'active', coin, ''), end)
+            price = glassnode.submit(get_glassnode_history, coin,
+                since(watermarks, start, 'glassnode', 'price', coin, ''), end)
+            u_volume = pools['coingecko'].submit(get_coingecko_symbol, coin_name,
+                since(watermarks, datetime(2013, 12, 31), 'coingecko', 'volume', coin, ''), end)
+            recent = pools['polygon'].submit(stream_asset, coin, 'underlying/recent',
+                iter_polygon_symbol(coin, since(watermarks, start, 'polygon', 'recent', coin, ''),
+                    resume_token(coin, 'underlying/recent', raw_dir), end),
+                'results', lambda d: d['t'] / 1000, raw_dir)
+
+            contracts_history = dict(zip(contracts, history))
+            series = {
+                ('glassnode', 'tx', coin, ''): tx.result(),
+                ('glassnode', 'volume', coin, ''): volume.result(),
+                ('glassnode', 'active', coin, ''): active.result(),
+                ('glassnode', 'price', coin, ''): price.result(),
+            }
+            save_columns(coin, 'onchain/tx', glassnode_columns(series[('glassnode', 'tx', coin, '')]), raw_dir)
+            save_columns(coin, 'onchain/volume', glassnode_columns(series[('glassnode', 'volume', coin, '')]), raw_dir)
+            save_columns(coin, 'onchain/active', glassnode_columns(series[('glassnode', 'active', coin, '')]), raw_dir)
+            save_asset(coin, 'contracts/metadata', dict(zip(contracts, tickers)), raw_dir)
+            save_columns(coin, 'contracts/data', contracts_columns(contracts_history), raw_dir)
+            save_columns(coin, 'underlying/price', glassnode_ohlc_columns(series[('glassnode', 'price', coin, '')]), raw_dir)
+            save_columns(coin, 'underlying/volume', coingecko_volume_columns(u_volume.result()), raw_dir)
+
+            for key, data in series.items():
+                new_watermarks[key] = newest(d['t'] for d in data)
+            # contract hours past the underlying price are only preprocessed
+            # once it is fetched, so their watermark stays behind it
+            priced = new_watermarks[('glassnode', 'price', coin, '')]
+            if priced is None:
+                priced = watermarks.get(('glassnode', 'price', coin, ''))
+            for c, data in contracts_history.items():
+                new_watermarks[('deribit', 'history', coin, c)] = newest(
+                    t / 1000 for t in data.get('ticks', []) if priced is not None and t / 1000 <= priced)
+            new_watermarks[('coingecko', 'volume', coin, '')] = newest(
+                d[0] / 1000 for d in u_volume.result().get('total_volumes', []))
+            new_watermarks[('polygon', 'recent', coin, '')] = recent.result().get('last')
+            new_watermarks[('deribit', 'dvol', coin, '')] = dvol.result().get('last')
+
+    logger = logging.getLogger(__name__)
+    for provider, m in rate_limit.metrics().items():
+        logger.info(f"{provider} -- {m['requests']} requests, {m['throttled']} throttled, "
+                    f"{m['wait_time']:.1f}s waiting for rate limit")
+
+    return {key: mark for key, mark in new_watermarks.items() if mark is not None}
 
 
 if __name__ == "__main__":
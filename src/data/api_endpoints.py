@@ -9,7 +9,7 @@ dotenv.load_dotenv('.env')
 def coingecko_history(
         symbol: str,
         start_date: datetime = datetime(2013, 12, 31),
-        end_date: datetime = datetime.now()) -> str:
+        end_date: datetime = None) -> str:
     """Coin history, in USD. Granularity automatic (1 day). 
     Useful for market volume
     Symbol example: 'bitcoin' or 'ethereum'
@@ -17,6 +17,7 @@ def coingecko_history(
     """
     s = quote(symbol)
     start = int(start_date.timestamp())
+    end_date = end_date or datetime.now()
     end = int(end_date.timestamp())
     return f'https://api.coingecko.com/api/v3/coins/{s}/market_chart/range?vs_currency=usd&from={start}&to={end}'
 
@@ -25,7 +26,7 @@ def deribit_history(
         symbol: str,
         resolution: str = '60',
         start_date: datetime = datetime(2020, 12, 31),
-        end_date: datetime = datetime.now()) -> str:
+        end_date: datetime = None) -> str:
     """Contract symbol price history.
     Symbol example: 'BTC-1JUL22-12000-C'
     Resolution: int (minutes) or 1D
@@ -34,6 +35,7 @@ def deribit_history(
     s = quote(symbol)
     r = quote(resolution)
     start = int(start_date.timestamp() * 1000)
+    end_date = end_date or datetime.now()
     end = int(end_date.timestamp() * 1000)
     return f'https://www.deribit.com/api/v2/public/get_tradingview_chart_data?start_timestamp={start}&end_timestamp={end}&instrument_name={s}&resolution={r}'
 
@@ -66,7 +68,7 @@ def deribit_volatility(
         symbol: str,
         resolution: str = '3600',
         start_date: datetime = datetime(2019, 12, 31),
-        end_date: datetime = datetime.now()) -> str:
+        end_date: datetime = None) -> str:
     """Volatility history.
     Symbol example: 'BTC'
     Resolution: int (seconds) or 1D
@@ -75,52 +77,76 @@ def deribit_volatility(
     r = quote(str(resolution))
     s = quote(symbol)
     start = int(start_date.timestamp() * 1000)
+    end_date = end_date or datetime.now()
     end = int(end_date.timestamp() * 1000)
     return f'https://www.deribit.com/api/v2/public/get_volatility_index_data?currency={s}&start_timestamp={start}&end_timestamp={end}&resolution={r}'
 
 
-def glassnode_history(symbol: str, start_date:datetime) -> str:
+def glassnode_since(start_date: datetime, end_date: datetime = None) -> str:
+    """Query parameters restricting a glassnode metric to points since
+    start_date and until end_date (None: no bound)"""
+    since = f'&s={int(start_date.timestamp())}' if start_date else ''
+    until = f'&u={int(end_date.timestamp())}' if end_date else ''
+    return since + until
+
+
+def glassnode_history(
+        symbol: str,
+        start_date: datetime = None,
+        end_date: datetime = None) -> str:
     """Coin price history, in usd, pre 2011, amazing granularity (1h).
     Useful for price history
     Symbol example: 'BTC' or 'ETH'
-    TODO: Add start_date to the endpoint
+    Default timestamps: Start (full history), End (now)
     """
     GLASS_API = os.environ.get("GLASS_API")
     s = quote(symbol)
-    return f'https://api.glassnode.com/v1/metrics/market/price_usd_ohlc?api_key={GLASS_API}&a={s}&i=1h'
+    return f'https://api.glassnode.com/v1/metrics/market/price_usd_ohlc?api_key={GLASS_API}&a={s}&i=1h{glassnode_since(start_date, end_date)}'
 
 
-def glassnode_tx(symbol: str) -> str:
+def glassnode_tx(
+        symbol: str,
+        start_date: datetime = None,
+        end_date: datetime = None) -> str:
     """Total amount of on-chain tx
     Symbol example: 'BTC' or 'ETH'
+    Default timestamps: Start (full history), End (now)
     """
     GLASS_API = os.environ.get("GLASS_API")
     s = quote(symbol)
-    return f'https://api.glassnode.com/v1/metrics/transactions/count?api_key={GLASS_API}&a={s}'
+    return f'https://api.glassnode.com/v1/metrics/transactions/count?api_key={GLASS_API}&a={s}{glassnode_since(start_date, end_date)}'
 
 
-def glassnode_volume(symbol: str) -> str:
+def glassnode_volume(
+        symbol: str,
+        start_date: datetime = None,
+        end_date: datetime = None) -> str:
     """Total volume of coin transacted on-chain
     Symbol example: 'BTC' or 'ETH'
+    Default timestamps: Start (full history), End (now)
     """
     GLASS_API = os.environ.get("GLASS_API")
     s = quote(symbol)
-    return f'https://api.glassnode.com/v1/metrics/transactions/transfers_volume_sum?api_key={GLASS_API}&a={s}'
+    return f'https://api.glassnode.com/v1/metrics/transactions/transfers_volume_sum?api_key={GLASS_API}&a={s}{glassnode_since(start_date, end_date)}'
 
 
-def glassnode_active(symbol: str) -> str:
+def glassnode_active(
+        symbol: str,
+        start_date: datetime = None,
+        end_date: datetime = None) -> str:
     """Addresses active in the last 1 year (send/recieve)
     Symbol example: 'BTC' or 'ETH'
+    Default timestamps: Start (full history), End (now)
     """
     GLASS_API = os.environ.get("GLASS_API")
     s = quote(symbol)
-    return f'https://api.glassnode.com/v1/metrics/supply/active_more_1y_percent?api_key={GLASS_API}&a={s}'
+    return f'https://api.glassnode.com/v1/metrics/supply/active_more_1y_percent?api_key={GLASS_API}&a={s}{glassnode_since(start_date, end_date)}'
 
 
 def polygon_history(
         symbol: str,
         start_date: str = datetime(2019, 12, 31),
-        end_date: str = datetime.now()) -> str:
+        end_date: datetime = None) -> str:
     """Coin history, in USD. Max 2 years.
     Useful for granular data last 2 years
     Symbol example: 'BTC' or 'ETH'
@@ -129,5 +155,6 @@ def polygon_history(
     POLY_API = os.environ.get("POLY_API")
     s = quote(symbol)
     s_date = start_date.strftime("%Y-%m-%d")
+    end_date = end_date or datetime.now()
     e_date = end_date.strftime("%Y-%m-%d")
     return f'https://api.polygon.io/v2/aggs/ticker/X:{s}USD/range/1/hour/{s_date}/{e_date}?adjusted=true&sort=asc&limit=50000&apiKey={POLY_API}'
\ No newline at end of file
@@ -1,4 +1,3 @@
-import time
 from datetime import datetime
 import json
 import numpy as np
@@ -7,6 +6,7 @@ import matplotlib.pyplot as plt
 import matplotlib
 
 import finance
+import instruments
 import preprocess
 
 
@@ -15,15 +15,13 @@ def bench_greeks(coin):
         data = json.load(json_file)
 
     contracts = list(data.keys())
-    # contracts = [contracts[i] for i,c in enumerate(contracts) if int(c.split('-')[2]) < 50_000]
-    contracts = [contracts[i] for i,c in enumerate(contracts) if c.split('-')[3] == 'C' and int(c.split('-')[2]) < 50_000]
-    c_name_split = [c.split('-') for c in contracts]
+    c_expiration, c_strike, c_is_call = instruments.parse_instruments(contracts)
+    # keep = c_strike < 50_000
+    keep = c_is_call & (c_strike < 50_000)
+    contracts = [c for c, k in zip(contracts, keep) if k]
+    c_expiration, c_strike, c_is_call = c_expiration[keep], c_strike[keep], c_is_call[keep]
 
-    get_timestamp = lambda d: time.mktime(datetime.strptime(d + '-10',"%d%b%y-%H").timetuple())
-    c_expiration = [get_timestamp(c[1]) for c in c_name_split]
     c_expiration_days = [abs((datetime.fromtimestamp(exp) - datetime.now()).days)+1+3 for exp in c_expiration]
-    c_strike = [int(c[2]) for c in c_name_split]
-    c_is_call = [c[3] == 'C' for c in c_name_split]
 
     df_greeks_o = pd.DataFrame([(
         data[c]['instrument_name'], 
@@ -160,9 +158,9 @@ def bench_greek_model():
     # rho = [x['rho'] for x in contracts]
     # rho = np.array(rho).reshape(np.shape(s))
 
-    iv = [x['iv_bi'] for x in contracts]
+    iv = [x['iv'] for x in contracts]
     iv = np.array(iv).reshape(np.shape(s))
-    plot_3d_surface(s, T, iv, zlabel='iv_bi')
+    plot_3d_surface(s, T, iv, zlabel='iv')
 
     # iv = [x['iv_rn'] for x in contracts]
     # iv = np.nan_to_num(np.array(iv).reshape(np.shape(s)))
@@ -176,15 +174,14 @@ def bench_greek_model():
 def bench_iv(coin):
     df = preprocess.get_contract_data(coin).head(10_000)
 
-    iv = [finance.iv_2(
-        'c' if c['is_call'] else 'p',
-        c['c_close'],
+    # contract prices are quoted in coin, priced here against a 20k underlying
+    iv = finance.bsm_iv(
         20_000,
-        c['strike'],
+        df['strike'].to_numpy(dtype=np.float64),
         0,
-        (c['expiration_days'] + 5) / 365,
-        0
-    ) for i,c in df.iterrows()]
+        preprocess.time_to_expiry(df) + 5 / 365,
+        df['c_close'].to_numpy(dtype=np.float64) * 20_000,
+        df['is_call'].to_numpy(dtype=bool))
 
     print(iv)
 
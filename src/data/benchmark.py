@@ -0,0 +1,300 @@
+"""Benchmarks of the pricing, iv, preprocessing and load hot paths.
+Runs offline on a reproducible synthetic option chain, saved in the same raw
+layout api.main writes, and reports seconds, rows per second and peak memory
+(tracemalloc) of each benchmark. Results are saved as json; pass a previous
+result with --compare to see the speedup of every benchmark against it.
+
+    python src/data/benchmark.py --contracts 200 --hours 720 --compare old.json
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+import finance
+import insert_dataset
+import instruments
+import preprocess
+import raw_store
+import sql_create
+import surface
+
+
+COIN = 'BTC'
+T0 = 1656633600  # 2022-07-01 00:00 UTC
+# the scalar functions are timed on a sample of rows, too slow for all rows
+SCALAR_ROWS = 500
+OUTPUT_DIR = './reports/benchmarks'
+
+
+def synthetic_chain(raw_dir: str, n_contracts: int = 100,
+                    n_hours: int = 24 * 30, seed: int = 0) -> dict:
+    """Writes a synthetic coin to raw_dir, laid out as api.main saves it:
+    an hourly gbm underlying, daily volume and on-chain series, and
+    n_contracts options (calls and puts over a strike and expiry grid)
+    priced with a Black-Scholes smile, one bar per contract and hour.
+    Returns: the contract rows as arrays (s, k, T, p, is_call, sigma), for
+        the pricing benchmarks
+    """
+    rng = np.random.default_rng(seed)
+    hours = T0 + np.arange(n_hours) * 3600
+    days = hours[::24]
+    close = 20_000 * np.exp(np.cumsum(rng.normal(0, 0.005, n_hours)))
+
+    n_expiries = max(1, int(np.sqrt(n_contracts / 2)))
+    n_strikes = max(1, n_contracts // (2 * n_expiries))
+    expiries = [datetime.fromtimestamp(hours[-1] + 86400 * 7 * (i + 1),
+                                       tz=timezone.utc).strftime('%d%b%y')
+                .upper() for i in range(n_expiries)]
+    strikes = np.linspace(0.5, 1.5, n_strikes) * close[-1] // 500 * 500
+    names = np.array([f'{COIN}-{e}-{int(k)}-{cp}'
+                      for e in expiries for k in strikes for cp in 'CP'])
+
+    c = np.repeat(names, n_hours)
+    t = np.tile(hours, len(names)).astype(np.float64)
+    s = np.tile(close, len(names))
+    expiration, k, is_call = instruments.parse_instruments(c)
+    T = (np.abs(np.floor_divide(expiration - t, 86400)) + 1) / 365
+    sigma = np.sqrt(surface.svi(0.2 * T, 0.1 * np.sqrt(T), -0.4, 0.05, 0.2,
+                                np.log(k / s)) / T)
+    p = finance.bsm_greeks(s, k, 0, T, sigma, is_call)['value'].to_numpy()
+
+    raw_store.save(f'{raw_dir}/underlying/price/{COIN}', {
+        't': hours, 'open': close, 'high': close * 1.002,
+        'low': close * 0.998, 'close': close})
+    raw_store.save(f'{raw_dir}/underlying/volume/{COIN}',
+                   {'t': days * 1000, 'v': rng.random(len(days)) * 1e9})
+    raw_store.save(f'{raw_dir}/onchain/tx/{COIN}',
+                   {'t': days, 'v': rng.random(len(days)) * 1e5})
+    raw_store.save(f'{raw_dir}/onchain/volume/{COIN}',
+                   {'t': days, 'v': rng.random(len(days)) * 1e5})
+    os.makedirs(f'{raw_dir}/underlying/recent', exist_ok=True)
+    with open(f'{raw_dir}/underlying/recent/{COIN}.json', 'w') as f:
+        json.dump({'results': [
+            {'t': int(h) * 1000, 'c': float(x), 'v': 1.0, 'n': 1}
+            for h, x in zip(hours, close)]}, f)
+    raw_store.save(f'{raw_dir}/contracts/data/{COIN}', {
+        'contract': c, 't': t * 1000, 'volume': rng.random(len(c)),
+        'open': p / s, 'high': p / s, 'low': p / s, 'close': p / s})
+
+    return {'s': s, 'k': k, 'T': T, 'p': p, 'is_call': is_call,
+            'sigma': sigma, 'close': close, 'hours': hours}
+
+
+def measure(func, repeat: int = 1, memory: bool = True) -> dict:
+    """Times func (best of repeat runs), then runs it once more under
+    tracemalloc for its peak memory
+    func: returns the number of rows it processed
+    """
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows = func()
+        seconds.append(time.perf_counter() - start)
+    result = {'rows': rows, 'seconds': min(seconds),
+              'rows_per_s': rows / max(min(seconds), 1e-12)}
+
+    if memory:
+        tracemalloc.start()
+        func()
+        result['peak_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+    return result
+
+
+def scalar(func, sample: np.ndarray, *args):
+    """Benchmark running the scalar func over the sample rows of args
+    (arrays are indexed, other arguments passed as they are)
+    """
+    def run():
+        for i in sample:
+            func(*(a[i] if isinstance(a, np.ndarray) else a for a in args))
+        return len(sample)
+    return run
+
+
+def pricing_benchmarks(chain: dict) -> dict:
+    """Benchmarks of the finance functions over the synthetic chain"""
+    s, k, T, p, is_call, sigma = (
+        chain[c] for c in ['s', 'k', 'T', 'p', 'is_call', 'sigma'])
+    sample = np.linspace(0, len(s) - 1, min(SCALAR_ROWS, len(s))).astype(int)
+    close = chain['close']
+
+    def bsm_greeks():
+        finance.bsm_greeks(s, k, 0, T, sigma, is_call)
+        return len(s)
+
+    def bsm_iv():
+        finance.bsm_iv(s, k, 0, T, p, is_call)
+        return len(s)
+
+    def volatility():
+        finance.volatility(pd.Series(close, index=chain['hours']))
+        return len(close)
+
+    return {
+        'metrics': scalar(finance.metrics, sample, s, k, 0, T, sigma, p,
+                          is_call),
+        'iv': scalar(finance.iv, sample, s, k, 0, T, p, is_call),
+        'implied_volatility': scalar(finance.implied_volatility, sample,
+                                     s, k, 0, T, p, is_call),
+        'bsm_greeks': bsm_greeks,
+        'bsm_iv': bsm_iv,
+        'volatility': volatility,
+    }
+
+
+def pipeline_benchmarks(work_dir: str, workers: int) -> dict:
+    """Benchmarks of the preprocessing and load steps over the synthetic
+    chain saved in work_dir
+    """
+    raw_dir = f'{work_dir}/raw'
+    volatility_dir = f'{work_dir}/volatility'
+    catalog_dir = f'{work_dir}/instruments'
+    state = {}
+
+    def get_contract_data():
+        return len(preprocess.get_contract_data(COIN, raw_dir))
+
+    def run_preprocess():
+        # a fresh state dir every run, so every run computes the full series
+        state['data'] = preprocess.main(
+            workers, raw_dir,
+            volatility_dir=tempfile.mkdtemp(dir=volatility_dir))
+        return len(state['data'][COIN][1])
+
+    def insert_connection():
+        db_file = f'{work_dir}/bench.db'
+        if os.path.exists(db_file):
+            os.remove(db_file)
+        con = sql_create.connect(db_file)
+        sql_create.create(con)
+        insert_dataset.insert_connection(con, state['data'],
+                                         defer_indexes=True, raw_dir=raw_dir,
+                                         catalog_dir=catalog_dir)
+        con.close()
+        return len(state['data'][COIN][1])
+
+    os.makedirs(volatility_dir, exist_ok=True)
+    return {
+        'get_contract_data': get_contract_data,
+        'preprocess': run_preprocess,
+        # runs on the output of preprocess
+        'insert_connection': insert_connection,
+    }
+
+
+def benchmarks(chain: dict, work_dir: str, workers: int) -> dict:
+    """Benchmark name: function running it over the synthetic chain"""
+    return {**pricing_benchmarks(chain),
+            **pipeline_benchmarks(work_dir, workers)}
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: dict, previous: dict) -> dict:
+    """Speedup of every benchmark against a previous result (> 1 is faster)"""
+    before = previous.get('benchmarks', {})
+    return {name: before[name]['seconds'] / max(r['seconds'], 1e-12)
+            for name, r in results['benchmarks'].items() if name in before}
+
+
+def run(args) -> dict:
+    """Runs the benchmarks selected in args over a synthetic chain in a
+    temporary directory
+    Returns: the results, with the run's environment and config
+    """
+    logger = logging.getLogger(__name__)
+    results = {
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'config': {'contracts': args.contracts, 'hours': args.hours,
+                   'seed': args.seed, 'workers': args.workers,
+                   'repeat': args.repeat},
+        'benchmarks': {},
+    }
+    with tempfile.TemporaryDirectory() as work_dir:
+        chain = synthetic_chain(f'{work_dir}/raw', args.contracts,
+                                args.hours, args.seed)
+        runs = benchmarks(chain, work_dir, args.workers)
+        names = args.only or list(runs)
+        # insert_connection loads what preprocess produced
+        if 'insert_connection' in names and 'preprocess' not in names:
+            runs['preprocess']()
+
+        for name in names:
+            result = measure(runs[name], args.repeat, not args.no_memory)
+            results['benchmarks'][name] = result
+            peak_mb = result.get('peak_mb', float('nan'))
+            logger.info(f'{name} -- {result["rows"]} rows '
+                        f'-- {result["seconds"]:.3f}s '
+                        f'-- {result["rows_per_s"]:,.0f} rows/s '
+                        f'-- {peak_mb:.1f} MB')
+    return results
+
+
+def main(args):
+    logger = logging.getLogger(__name__)
+    results = run(args)
+
+    if args.compare:
+        with open(args.compare) as f:
+            results['speedup'] = compare(results, json.load(f))
+        for name, speedup in results['speedup'].items():
+            logger.info(f'{name} -- {speedup:.2f}x vs {args.compare}')
+
+    output = (args.output
+              or f'{OUTPUT_DIR}/bench-{datetime.now():%Y%m%d-%H%M%S}.json')
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    logger.info(f'results saved to {output}')
+    return results
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark the pricing, iv, preprocessing and load hot '
+                    'paths on synthetic data.')
+    parser.add_argument('-c', '--contracts', type=int, default=100,
+                        help='Option contracts in the synthetic chain.')
+    parser.add_argument('-H', '--hours', type=int, default=24 * 30,
+                        help='Hourly bars per contract.')
+    parser.add_argument('-s', '--seed', type=int, default=0,
+                        help='Seed of the synthetic data.')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Processes used by preprocess (1: serial).')
+    parser.add_argument('-r', '--repeat', type=int, default=1,
+                        help='Timed runs per benchmark (best is kept).')
+    parser.add_argument('--only', nargs='+',
+                        help='Benchmarks to run (default: all).')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='Skip the peak memory run.')
+    parser.add_argument('-o', '--output',
+                        help=f'Json results file (default: '
+                             f'{OUTPUT_DIR}/bench-<date>.json).')
+    parser.add_argument('--compare',
+                        help='Previous json results to compute speedups '
+                             'against.')
+    main(parser.parse_args())
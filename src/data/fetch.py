@@ -0,0 +1,91 @@
+"""Shared HTTP layer used by the api getters.
+Every provider gets one keep-alive session (connection pool) and a cap on
+the number of requests in flight, so getters can be called from many
+threads at once without opening a connection per request.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import dotenv
+import requests
+from requests.adapters import HTTPAdapter
+
+import rate_limit
+
+dotenv.load_dotenv('.env')
+
+
+PROVIDERS = {
+    'www.deribit.com': 'deribit',
+    'api.glassnode.com': 'glassnode',
+    'api.coingecko.com': 'coingecko',
+    'api.polygon.io': 'polygon',
+}
+
+# max requests in flight per provider, overridable with e.g. DERIBIT_CONCURRENCY
+DEFAULT_CONCURRENCY = {
+    'deribit': 16,
+    'glassnode': 4,
+    'coingecko': 2,
+    'polygon': 1,
+}
+
+TIMEOUT = 30
+
+_lock = threading.Lock()
+_sessions = {}
+_semaphores = {}
+
+
+def get_provider(url: str) -> str:
+    """Provider name of an api url, the host itself for unknown hosts"""
+    host = urlparse(url).netloc
+    return PROVIDERS.get(host, host)
+
+
+def get_concurrency(provider: str) -> int:
+    default = DEFAULT_CONCURRENCY.get(provider, 1)
+    return int(os.environ.get(f'{provider.upper()}_CONCURRENCY', default))
+
+
+def executor(provider: str) -> ThreadPoolExecutor:
+    """Thread pool for the requests of provider, one thread per request it
+    may have in flight
+    """
+    return ThreadPoolExecutor(max_workers=get_concurrency(provider),
+                              thread_name_prefix=provider)
+
+
+def get_session(provider: str) -> requests.Session:
+    """Returns the (lazily created) keep-alive session of provider"""
+    with _lock:
+        if provider not in _sessions:
+            concurrency = get_concurrency(provider)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _sessions[provider] = session
+            _semaphores[provider] = threading.BoundedSemaphore(concurrency)
+        return _sessions[provider]
+
+
+def get(url: str, timeout: float = TIMEOUT) -> requests.Response:
+    """GET url through its provider's session, waiting for a free slot if the
+    provider already has its maximum of requests in flight and for a token of
+    its rate limit. 429 responses are retried after Retry-After (or a
+    jittered backoff), up to rate_limit.MAX_RETRIES times.
+    """
+    provider = get_provider(url)
+    session = get_session(provider)
+    bucket = rate_limit.get_bucket(provider)
+    for attempt in range(rate_limit.MAX_RETRIES + 1):
+        bucket.acquire()
+        with _semaphores[provider]:
+            response = session.get(url, timeout=timeout)
+        if response.status_code != 429 or attempt == rate_limit.MAX_RETRIES:
+            return response
+        delay = rate_limit.retry_after(response.headers.get('Retry-After'))
+        bucket.pause(delay if delay is not None else rate_limit.backoff(attempt))
@@ -6,8 +6,8 @@
 import numpy as np
 import pandas as pd
 from scipy.stats import norm
-from datetime import datetime
-from math import log, sqrt, exp
+from collections import deque
+from math import sqrt
 
 
 def get_d1(
@@ -22,8 +22,10 @@ def get_d1(
     r: Continuous risk-free rate
     T: Time to expiry in years (days / 365)
     sigma: Underlying volatility
+    Accepts scalars or numpy arrays (broadcasted)
     """
-    return (log(s / k) + (r + sigma ** 2 * 0.5) * T) / (sigma * sqrt(T))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (np.log(s / k) + (r + sigma ** 2 * 0.5) * T) / (sigma * np.sqrt(T))
 
 
 def get_d2(
@@ -38,8 +40,77 @@ def get_d2(
     r: Continuous risk-free rate
     T: Time to expiry in years (days / 365)
     sigma: Underlying volatility
+    Accepts scalars or numpy arrays (broadcasted)
     """
-    return (log(s / k) + (r - sigma ** 2 * 0.5) * T) / (sigma * sqrt(T))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (np.log(s / k) + (r - sigma ** 2 * 0.5) * T) / (sigma * np.sqrt(T))
+
+
+def _price(s, k, r, T, d1, d2, is_call):
+    call = np.exp(-r*T) * (s * np.exp(r*T) * norm.cdf(d1) - k * norm.cdf(d2))
+    put = np.exp(-r*T) * (k * norm.cdf(-d2) - s * np.exp(r*T) * norm.cdf(-d1))
+    return np.where(is_call, call, put)
+
+
+def _delta(d1, is_call):
+    return np.where(is_call, norm.cdf(d1), norm.cdf(d1) - 1)
+
+
+def _gamma(s, T, sigma, d1):
+    return norm.pdf(d1) / (s * sigma * np.sqrt(T))
+
+
+def _vega(s, T, d1):
+    return s * np.sqrt(T) * norm.pdf(d1) / 100
+
+
+def _theta(s, k, r, T, sigma, d1, d2, is_call):
+    decay = -s * norm.pdf(d1) * sigma / (2 * np.sqrt(T))
+    call = decay - r * k * np.exp(-r*T) * norm.cdf(d2) / 365
+    put = decay + r * k * np.exp(-r*T) * norm.cdf(-d2) / 365
+    return np.where(is_call, call, put)
+
+
+def _rho(k, r, T, d2, is_call):
+    call = k * T * np.exp(-r*T) * norm.cdf(d2) / 100
+    put = -k * T * np.exp(-r*T) * norm.cdf(-d2) / 100
+    return np.where(is_call, call, put)
+
+
+def bsm_greeks(
+    s: np.ndarray, 
+    k: np.ndarray, 
+    r: np.ndarray, 
+    T: np.ndarray, 
+    sigma: np.ndarray, 
+    is_call: np.ndarray) -> pd.DataFrame:
+    """Black-Scholes Model - fair price and greeks for a batch of contracts.
+    d1 and d2 are computed once for the whole batch.
+    s: Underlying asset price
+    k: Option strike
+    r: Continuous risk-free rate
+    T: Time to expiry in years (days / 365)
+    sigma: Underlying volatility
+    is_call: Contract is call (False is a put)
+    All arguments are scalars or arrays broadcastable to a common shape.
+    Returns: DataFrame with columns delta, gamma, vega, theta, rho, value
+    """
+    s, k, r, T, sigma, is_call = np.broadcast_arrays(
+        *map(np.asarray, (s, k, r, T, sigma, is_call)))
+    s, k, r, T, sigma = (np.ravel(x).astype(np.float64) for x in (s, k, r, T, sigma))
+    is_call = np.ravel(is_call).astype(bool)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d1 = get_d1(s, k, r, T, sigma)
+        d2 = d1 - sigma * np.sqrt(T)
+        return pd.DataFrame({
+            'delta': _delta(d1, is_call),
+            'gamma': _gamma(s, T, sigma, d1),
+            'vega': _vega(s, T, d1),
+            'theta': _theta(s, k, r, T, sigma, d1, d2, is_call),
+            'rho': _rho(k, r, T, d2, is_call),
+            'value': _price(s, k, r, T, d1, d2, is_call),
+        })
 
 
 def bsm_price(
@@ -57,12 +128,9 @@ def bsm_price(
     sigma: Underlying volatility
     is_call: Contract is call (False is a put)
     """
-    d1 = (log(s / k) + (r + sigma ** 2 * 0.5) * T) / (sigma * sqrt(T))
+    d1 = get_d1(s, k, r, T, sigma)
     d2 = d1 - sigma * sqrt(T)
-    if is_call:
-        return exp(-r*T) * (s * exp((r)*T) * norm.cdf(d1) - k * norm.cdf(d2))
-    else:
-        return exp(-r*T) * (k * norm.cdf(-d2) - (s * exp((r)*T) * norm.cdf(-d1)))
+    return float(_price(s, k, r, T, d1, d2, is_call))
 
 
 def delta(
@@ -80,10 +148,7 @@ def delta(
     sigma: Underlying volatility
     is_call: Contract is call (False is a put)
     """
-    if is_call:
-        return norm.cdf((log(s / k) + (r + sigma ** 2 * 0.5) * T) / (sigma * sqrt(T)))
-    else:
-        return norm.cdf((log(s / k) + (r + sigma ** 2 * 0.5) * T) / (sigma * sqrt(T))) - 1
+    return float(_delta(get_d1(s, k, r, T, sigma), is_call))
 
 
 def gamma(
@@ -99,7 +164,7 @@ def gamma(
     T: Time to expiry in years (days / 365)
     sigma: Underlying volatility
     """
-    return norm.pdf((log(s / k) + (r + sigma ** 2 * 0.5) * T) / (sigma * sqrt(T))) / (s * sigma * sqrt(T))
+    return float(_gamma(s, T, sigma, get_d1(s, k, r, T, sigma)))
 
 
 def vega(
@@ -115,7 +180,7 @@ def vega(
     T: Time to expiry in years (days / 365)
     sigma: Underlying volatility
     """
-    return s * sqrt(T) * norm.pdf((log(s / k) + (r + sigma ** 2 * 0.5) * T) / (sigma * sqrt(T))) / 100
+    return float(_vega(s, T, get_d1(s, k, r, T, sigma)))
 
 
 def theta(
@@ -133,11 +198,9 @@ def theta(
     sigma: Underlying volatility
     is_call: Contract is call (False is a put)
     """
-    d1 = (log(s / k) + (r + sigma ** 2 * 0.5) * T) / (sigma * sqrt(T))
-    if is_call:
-        return -s * norm.pdf(d1) * sigma / (2 * sqrt(T)) - r * k * exp(-r*T) * norm.cdf(d1 - sigma * sqrt(T)) / 365
-    else:
-        return -s * norm.pdf(d1) * sigma / (2 * sqrt(T)) + r * k * exp(-r * T) * norm.cdf(-(d1 - sigma * sqrt(T))) / 365
+    d1 = get_d1(s, k, r, T, sigma)
+    d2 = d1 - sigma * sqrt(T)
+    return float(_theta(s, k, r, T, sigma, d1, d2, is_call))
 
 
 def rho(
@@ -155,10 +218,97 @@ def rho(
     sigma: Underlying volatility
     is_call: Contract is call (False is a put)
     """
-    if is_call:
-        return k * T * (exp(-r*T)) * norm.cdf((log(s / k) + (r - sigma ** 2 * 0.5) * T) / (sigma * sqrt(T))) / 100
-    else:
-        return -k * T * (exp(-r*T)) * norm.cdf(-(log(s / k) + (r - sigma ** 2 * 0.5) * T) / (sigma * sqrt(T))) / 100
+    return float(_rho(k, r, T, get_d2(s, k, r, T, sigma), is_call))
+
+
+IV_LOWER = 0.0001
+IV_UPPER = 500.0
+
+
+def _iv_guess(s, kd, T, c):
+    """Corrado-Miller closed-form approximation of the implied volatility,
+    from the call price c (puts are mapped to calls by put-call parity)
+    kd: Discounted strike (k * exp(-r*T))
+    """
+    x = s - kd
+    a = c - x / 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        guess = np.sqrt(2 * np.pi / T) / (s + kd) * (a + np.sqrt(np.maximum(a ** 2 - x ** 2 / np.pi, 0)))
+    return np.clip(np.nan_to_num(guess, nan=0.5), IV_LOWER, IV_UPPER)
+
+
+def bsm_iv(
+    s: np.ndarray, 
+    k: np.ndarray, 
+    r: np.ndarray, 
+    T: np.ndarray, 
+    p: np.ndarray, 
+    is_call: np.ndarray, 
+    tol: float = 0.00001, 
+    max_iter: int = 100) -> pd.DataFrame:
+    """Implied volatility (Black-Scholes price) for a batch of contracts.
+    Starts from a closed-form guess and refines it with Newton steps on vega,
+    falling back to bisection of the [IV_LOWER, IV_UPPER] bracket whenever a
+    Newton step leaves it. Only unconverged elements are iterated.
+    s: Underlying asset price
+    k: Option strike
+    r: Continuous risk-free rate
+    T: Time to expiry in years (days / 365)
+    p: Contract price in the open market
+    is_call: Contract is call (False is a put)
+    tol: Price error tolerance
+    max_iter: Max amount of iterations
+    Returns: DataFrame with columns iv, converged, iterations. iv is NaN when
+        p is outside the no-arbitrage bounds of the contract
+    """
+    s, k, r, T, p, is_call = np.broadcast_arrays(
+        *map(np.asarray, (s, k, r, T, p, is_call)))
+    s, k, r, T, p = (np.ravel(x).astype(np.float64) for x in (s, k, r, T, p))
+    is_call = np.ravel(is_call).astype(bool)
+
+    kd = k * np.exp(-r*T)
+    lower_price = np.where(is_call, np.maximum(s - kd, 0), np.maximum(kd - s, 0))
+    upper_price = np.where(is_call, s, kd)
+    with np.errstate(invalid='ignore'):
+        solvable = (s > 0) & (k > 0) & (T > 0) & (p > lower_price) & (p < upper_price)
+
+    iv = np.full(len(s), np.nan)
+    converged = np.zeros(len(s), dtype=bool)
+    iterations = np.zeros(len(s), dtype=np.int64)
+
+    idx = np.flatnonzero(solvable)
+    sigma = _iv_guess(s[idx], kd[idx], T[idx], np.where(is_call, p, p + s - kd)[idx])
+    lo = np.full(len(idx), IV_LOWER)
+    hi = np.full(len(idx), IV_UPPER)
+
+    for i in range(max_iter):
+        if not len(idx):
+            break
+        _s, _k, _r, _T, _p, _c = s[idx], k[idx], r[idx], T[idx], p[idx], is_call[idx]
+        d1 = get_d1(_s, _k, _r, _T, sigma)
+        d2 = d1 - sigma * np.sqrt(_T)
+        diff = _price(_s, _k, _r, _T, d1, d2, _c) - _p
+        iterations[idx] += 1
+
+        # price is increasing in sigma: keep the root bracketed
+        hi = np.where(diff > 0, sigma, hi)
+        lo = np.where(diff < 0, sigma, lo)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            newton = sigma - diff / (_s * np.sqrt(_T) * norm.pdf(d1))
+        bisect = ~np.isfinite(newton) | (newton <= lo) | (newton >= hi)
+        next_sigma = np.where(bisect, (lo + hi) / 2, newton)
+
+        done = (np.abs(diff) < tol) | (hi - lo < 1e-12)
+        iv[idx[done]] = sigma[done]
+        converged[idx[done]] = True
+
+        keep = ~done
+        idx, sigma, lo, hi = idx[keep], next_sigma[keep], lo[keep], hi[keep]
+
+    # best estimate for elements that ran out of iterations
+    iv[idx] = sigma
+
+    return pd.DataFrame({'iv': iv, 'converged': converged, 'iterations': iterations})
 
 
 def iv(
@@ -168,7 +318,7 @@ def iv(
     T: float, 
     p: float, 
     is_call: bool) -> float:
-    """Implied volatility (Black-Scholes price) - bisection method
+    """Implied volatility (Black-Scholes price) - safeguarded Newton method
     s: Underlying asset price
     k: Option strike
     r: Continuous risk-free rate
@@ -176,40 +326,7 @@ def iv(
     p: Contract price in the open market
     is_call: Contract is call (False is a put)
     """
-    iteration = 0
-    upper_vol = 500.0
-    lower_vol = 0.0001
-
-    while 1:
-        iteration +=1
-        mid_vol = (upper_vol + lower_vol)/2.0
-        price = bsm_price(s, k, r, T, mid_vol, is_call)
-        if is_call:
-            lower_price = bsm_price(s, k, r, T, lower_vol, is_call)
-            
-            if (lower_price - p) * (price - p) > 0:
-                lower_vol = mid_vol
-            else:
-                upper_vol = mid_vol
-            if abs(price - p) < 0.00001: break 
-            if mid_vol > 500.0 - 5 :
-                mid_vol = 0.0001
-                break
-
-        else: #TODO: put IV has 54% correlation with deribit iv
-            upper_price = bsm_price(s, k, r, T, upper_vol, is_call)
-
-            if (upper_price - p) * (price - p) > 0:
-                upper_vol = mid_vol
-            else:
-                lower_vol = mid_vol
-            if abs(price - p) < 0.00001: break 
-            if iteration > 50: break
-            if mid_vol < 0.0001:
-                mid_vol = 0.0001
-                break
-
-    return mid_vol
+    return float(bsm_iv(s, k, r, T, p, is_call)['iv'].iloc[0])
 
 
 def metrics(
@@ -220,7 +337,8 @@ def metrics(
     sigma: float, 
     p: float, 
     is_call: bool) -> dict:
-    """Implied volatility (Black-Scholes price) - bisection method
+    """Greeks, Black-Scholes value and implied volatility of one contract
+    (the iv from the batched Newton solver, see bsm_iv)
     s: Underlying asset price
     k: Option strike
     r: Continuous risk-free rate
@@ -228,6 +346,7 @@ def metrics(
     sigma: Underlying volatility
     p: Contract price in the open market
     is_call: Contract is call (False is a put)
+    Returns: {'delta', 'gamma', 'vega', 'theta', 'rho', 'value', 'iv'}
     """
     return {
         'delta': delta(s, k, r, T, sigma, is_call),
@@ -241,16 +360,158 @@ def metrics(
     }
 
 
-def volatility(underlying: pd.Series) -> pd.Series:
+VOL_WINDOW = 30 * 86400
+# annualization factor volatility has always used (252 ** 1/2 == 126)
+VOL_FACTOR = 252 ** 1/2
+VOL_ESTIMATORS = ('close', 'parkinson', 'garman_klass')
+
+
+class RollingVolatility:
+    """Realized volatility over a rolling time window. The per point terms of
+    the window are kept with their running sums, so adding points costs
+    O(new points) instead of recomputing the whole history.
+    window: seconds; a point at t sees the points in (t - window, t]
+    estimator:
+        'close': sample std of the close to close log returns
+        'parkinson': sqrt(mean(ln(h/l)^2) / (4 ln 2))
+        'garman_klass': sqrt(mean(ln(h/l)^2 / 2 - (2 ln 2 - 1) ln(c/o)^2))
+    factor: annualization factor the estimate is multiplied by
+    Points whose term is not finite (missing or zero prices) are skipped.
+    """
+    def __init__(self, window: float = VOL_WINDOW, estimator: str = 'close', factor: float = VOL_FACTOR):
+        if estimator not in VOL_ESTIMATORS:
+            raise ValueError(f'unknown volatility estimator {estimator!r}')
+        self.window = window
+        self.estimator = estimator
+        self.factor = factor
+        self.t = deque()
+        self.x = deque()
+        self.s1 = 0.0
+        self.s2 = 0.0
+        self.last_t = None
+        self.last_close = None
+
+    def _terms(self, close, open, high, low) -> np.ndarray:
+        if self.estimator != 'close' and (high is None or low is None):
+            raise ValueError(f'{self.estimator} volatility needs high and low prices')
+        if self.estimator == 'garman_klass' and open is None:
+            raise ValueError('garman_klass volatility needs open prices')
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if self.estimator == 'close':
+                prev = np.nan if self.last_close is None else self.last_close
+                x = np.log(close / np.concatenate([[prev], close[:-1]]))
+            elif self.estimator == 'parkinson':
+                x = np.log(high / low) ** 2 / (4 * np.log(2))
+            else:
+                x = 0.5 * np.log(high / low) ** 2 - (2 * np.log(2) - 1) * np.log(close / open) ** 2
+        return np.where(np.isfinite(x), x, np.nan)
+
+    def _value(self, n, s1, s2):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if self.estimator == 'close':
+                var = np.where(n > 1, (s2 - s1 ** 2 / n) / (n - 1), np.nan)
+            else:
+                var = np.where(n > 0, s1 / n, np.nan)
+            return np.sqrt(np.maximum(var, 0)) * self.factor
+
+    @staticmethod
+    def _columns(t, close, open, high, low) -> tuple:
+        as_array = lambda a: None if a is None else np.asarray(a, dtype=np.float64)
+        return as_array(t), as_array(close), as_array(open), as_array(high), as_array(low)
+
+    def init(self, t, close, open=None, high=None, low=None) -> np.ndarray:
+        """Resets the estimator to the series t (sorted, in seconds), computing
+        the volatility of every point at once
+        close, open, high, low: prices (open, high, low only needed by the
+        range estimators)
+        Returns: volatility of each point
+        """
+        t, close, open, high, low = self._columns(t, close, open, high, low)
+        self.last_close = None
+        x = self._terms(close, open, high, low)
+
+        valid = ~np.isnan(x)
+        x0 = np.where(valid, x, 0.0)
+        c0 = np.concatenate([[0], np.cumsum(valid)])
+        c1 = np.concatenate([[0.0], np.cumsum(x0)])
+        c2 = np.concatenate([[0.0], np.cumsum(x0 ** 2)])
+        left = np.searchsorted(t, t - self.window, side='right')
+        right = np.arange(1, len(t) + 1)
+        volatility = self._value(c0[right] - c0[left], c1[right] - c1[left], c2[right] - c2[left])
+
+        # keep the last window for the next updates
+        self.t, self.x = deque(), deque()
+        self.s1 = self.s2 = 0.0
+        if len(t):
+            keep = valid & (t > t[-1] - self.window)
+            self.t.extend(t[keep].tolist())
+            self.x.extend(x[keep].tolist())
+            self.s1 = float(x[keep].sum())
+            self.s2 = float((x[keep] ** 2).sum())
+            self.last_t = float(t[-1])
+            self.last_close = float(close[-1])
+        return volatility
+
+    def update(self, t, close, open=None, high=None, low=None) -> np.ndarray:
+        """Adds points newer than the last one seen
+        Returns: volatility of each new point
+        """
+        t, close, open, high, low = self._columns(t, close, open, high, low)
+        if len(t) and self.last_t is not None and t[0] <= self.last_t:
+            raise ValueError('RollingVolatility.update only takes points newer than the last one')
+        x = self._terms(close, open, high, low)
+
+        volatility = np.empty(len(t))
+        for i, (t_i, x_i) in enumerate(zip(t.tolist(), x.tolist())):
+            if x_i == x_i:
+                self.t.append(t_i)
+                self.x.append(x_i)
+                self.s1 += x_i
+                self.s2 += x_i ** 2
+            while self.t and self.t[0] <= t_i - self.window:
+                self.t.popleft()
+                x_old = self.x.popleft()
+                self.s1 -= x_old
+                self.s2 -= x_old ** 2
+            volatility[i] = self._value(len(self.t), self.s1, self.s2)
+
+        if len(t):
+            self.last_t = float(t[-1])
+            self.last_close = float(close[-1])
+        return volatility
+
+    def state(self) -> dict:
+        """Columns to persist the estimator (e.g. with raw_store.save)"""
+        return {
+            't': np.array(self.t, dtype=np.float64),
+            'x': np.array(self.x, dtype=np.float64),
+            'last': np.array([self.last_t, self.last_close], dtype=np.float64),
+            'window': np.array(self.window, dtype=np.float64),
+            'factor': np.array(self.factor, dtype=np.float64),
+            'estimator': np.array(self.estimator),
+        }
+
+    @classmethod
+    def from_state(cls, state: dict) -> 'RollingVolatility':
+        """Rebuilds an estimator saved with state()"""
+        estimator = cls(float(state['window']), str(state['estimator']), float(state['factor']))
+        estimator.t.extend(np.asarray(state['t']).tolist())
+        estimator.x.extend(np.asarray(state['x']).tolist())
+        estimator.s1 = float(np.sum(state['x']))
+        estimator.s2 = float(np.sum(np.square(state['x'])))
+        last_t, last_close = np.asarray(state['last']).tolist()
+        if last_t == last_t:
+            estimator.last_t, estimator.last_close = last_t, last_close
+        return estimator
+
+
+def volatility(underlying: pd.Series, window: float = VOL_WINDOW) -> pd.Series:
     """Computes volatility for underlying data. The series passed should be
     indexed by time, specifically by a timestamp represented either by an int
-    or a float.
+    or a float. Close to close over window seconds, see RollingVolatility.
     """
-    output_data = underlying.copy().fillna(0)
-    output_data.index = list(map(lambda x: datetime.fromtimestamp(x), output_data.index))
-    log_returns = np.log(output_data/output_data.shift())
-    volatility = log_returns.rolling('30D').std() * (252 ** 1/2)
-    volatility.index = list(map(datetime.timestamp, volatility.index))
+    values = RollingVolatility(window).init(underlying.index, underlying)
+    volatility = pd.Series(values, index=underlying.index, name=underlying.name)
     volatility = volatility[~volatility.index.duplicated(keep='first')]
     return volatility
 
@@ -2,93 +2,178 @@ import os
 import logging
 import pandas as pd
 
+import instruments
+import sql_create
 import sql_insert
 import sql_select
+import surface
 
 
-def insert_underlying_data(con, underlying_id, coin):
-    underlying_data_df = pd.read_csv(f'./data/interim/underlying/{coin}.csv')
-    underlying_data_df = underlying_data_df.fillna(0)
-    make_underlying_data = lambda u: [
-        underlying_id, 
-        u['t'],
-        u['u_open'],
-        u['u_high'],
-        u['u_low'],
-        u['u_close'],
-        u['u_volume'],
-        u['chain_tx'],
-        u['chain_volume'],
-        u['recent_price'],
-        u['recent_volume'],
-        u['recent_transaction'],
-        u['volatility']]
-    underlying_data = [make_underlying_data(row) for i, row in underlying_data_df.iterrows()]
-
-    sql_insert.insert_underlying_data(con, underlying_data)
-
-
-def insert_contract_meta(con, underlying_id, coin):
-    contract_df = pd.read_csv(f'./data/interim/contracts/{coin}.csv')
-    make_contract_meta = lambda c: [
-        underlying_id,
-        c['contract'],
-        c['expiration'],
-        c['strike'],
-        c['is_call']]
-    contract_meta = [make_contract_meta(row) for i, row in contract_df.iterrows()]
-    contract_meta = list(set(tuple(sub) for sub in contract_meta))
+RAW_DIR = './data/raw'
+INTERIM_DIR = './data/interim'
+CHUNK_SIZE = 100_000
+
+
+def to_rows(df: pd.DataFrame, columns: list):
+    """Rows of df[columns] as tuples of python values, ready for executemany"""
+    return zip(*(df[c].tolist() for c in columns))
+
+
+UNDERLYING_COLUMNS = ['t', 'u_open', 'u_high', 'u_low', 'u_close', 'u_volume',
+    'chain_tx', 'chain_volume', 'recent_price', 'recent_volume',
+    'recent_transaction', 'volatility']
+CONTRACT_META_COLUMNS = ['contract', 'expiration', 'strike', 'is_call']
+CONTRACT_DATA_COLUMNS = ['contract', 't', 'c_volume', 'c_open', 'c_close', 'c_high',
+    'c_low', 'value', 'delta', 'vega', 'theta', 'gamma', 'rho', 'iv']
+
+
+def read_interim(coin, interim_dir: str = INTERIM_DIR, chunk_size: int = CHUNK_SIZE) -> tuple:
+    """Reads the interim csv files of coin, written by preprocess with interim_dir
+    Returns: (underlying_df, contract_meta_df, contract data chunks, surface_df),
+        chunks of chunk_size rows read lazily so the contract file is read once
+    """
+    underlying_df = pd.read_csv(f'{interim_dir}/underlying/{coin}.csv').fillna(0)
+    contract_path = f'{interim_dir}/contracts/{coin}.csv'
+    contract_meta_df = pd.read_csv(contract_path, usecols=CONTRACT_META_COLUMNS)
+    chunks = pd.read_csv(contract_path, usecols=CONTRACT_DATA_COLUMNS, chunksize=chunk_size)
+    surface_path = f'{interim_dir}/surface/{coin}.csv'
+    surface_df = pd.read_csv(surface_path) if os.path.exists(surface_path) else None
+    return underlying_df, contract_meta_df, chunks, surface_df
+
+
+def iter_chunks(df: pd.DataFrame, chunk_size: int = CHUNK_SIZE):
+    """df in slices of chunk_size rows, like read_csv(chunksize=)"""
+    for i in range(0, len(df), chunk_size):
+        yield df.iloc[i:i + chunk_size]
+
+
+def insert_underlying_data(con, underlying_id, underlying_df: pd.DataFrame) -> dict:
+    """Upserts the underlying data of one coin
+    underlying_df: as returned by preprocess.preprocess
+    Returns: {'inserted': n, 'updated': n, 'skipped': n}
+    """
+    underlying_data_df = underlying_df[UNDERLYING_COLUMNS].fillna(0)
+    underlying_data_df.insert(0, 'underlying_id', underlying_id)
+    underlying_data = to_rows(underlying_data_df, ['underlying_id', *UNDERLYING_COLUMNS])
+
+    return sql_insert.upsert_underlying_data(con, underlying_data)
+
+
+def insert_contract_meta(con, underlying_id, contract_df: pd.DataFrame):
+    contract_df = contract_df[CONTRACT_META_COLUMNS].drop_duplicates()
+    contract_df.insert(0, 'underlying_id', underlying_id)
+    contract_meta = to_rows(contract_df, ['underlying_id', *CONTRACT_META_COLUMNS])
 
     sql_insert.insert_contracts_meta(con, contract_meta)
 
 
-def insert_contract_data(con, contract_id):
-    coin = contract_id[1].split('-')[0]
-    contract_df = pd.read_csv(f'./data/interim/contracts/{coin}.csv')
-    contract_df = contract_df[contract_df['contract'] == contract_id[1]]
-
-    make_contract_data = lambda c: [
-        contract_id[0],
-        c['t'],
-        c['c_volume'],
-        c['c_open'],
-        c['c_close'],
-        c['c_high'],
-        c['c_low'],
-        c['value'],
-        c['delta'],
-        c['vega'],
-        c['theta'],
-        c['gamma'],
-        c['rho'],
-        c['iv']]
-    contract_data = [make_contract_data(row) for i, row in contract_df.iterrows()]
-
-    sql_insert.insert_contracts_data(con, contract_data)
-
-
-def insert_connection(con):
-    """Runs db scripts to turn interim data (./data/interim)
-    into clean data ready to be analyzed (./data/processed/datawarehouse.db)
+def insert_meta(con, underlying_meta: list, catalog_dir: str = instruments.CATALOG_DIR) -> dict:
+    """Upserts the exchange metadata (tick size, commissions, min trade) of
+    every underlying with an instrument catalog (see instruments.py)
+    underlying_meta: [(UNDERLYING_ID, NAME), ...]
+    """
+    meta = [(coin[0], *instruments.meta(catalog)) for coin in underlying_meta
+            if not (catalog := instruments.load(coin[1], catalog_dir)).empty]
+    return sql_insert.upsert_meta(con, meta)
+
+
+def insert_vol_surface(con, underlying_id, surface_df: pd.DataFrame) -> dict:
+    """Upserts the SVI slices of one coin (see surface.fit)
+    Returns: {'inserted': n, 'updated': n, 'skipped': n}
+    """
+    surface_df = surface_df[surface.COLUMNS].copy()
+    surface_df.insert(0, 'underlying_id', underlying_id)
+    return sql_insert.upsert_vol_surface(con, to_rows(surface_df, ['underlying_id', *surface.COLUMNS]))
+
+
+def insert_contract_data(con, chunks, contract_ids: pd.DataFrame) -> dict:
+    """Upserts all contract data of one coin, one chunk at a time.
+    Commits only after the last chunk.
+    chunks: iterable of contract DataFrames (see iter_chunks, read_interim)
+    contract_ids: DataFrame with columns contract_id, contract (name)
+    Returns: {'inserted': n, 'updated': n, 'skipped': n}
+    """
+    counts = []
+    with con:
+        for contract_df in chunks:
+            contract_df = contract_df[CONTRACT_DATA_COLUMNS].merge(contract_ids, on='contract')
+            contract_data = to_rows(contract_df, ['contract_id', *CONTRACT_DATA_COLUMNS[1:]])
+            counts.append(sql_insert.upsert_contracts_data(con, contract_data, commit=False))
+
+    return add_counts(counts)
+
+
+def add_counts(counts: list) -> dict:
+    """Sums a list of {'inserted': n, 'updated': n, 'skipped': n}"""
+    return {key: sum(c[key] for c in counts) for key in ['inserted', 'updated', 'skipped']}
+
+
+def insert_connection(
+        con,
+        data: dict = None,
+        defer_indexes: bool = False,
+        raw_dir: str = RAW_DIR,
+        interim_dir: str = INTERIM_DIR,
+        chunk_size: int = CHUNK_SIZE,
+        catalog_dir: str = instruments.CATALOG_DIR) -> dict:
+    """Runs db scripts to turn preprocessed data into clean data ready to be
+    analyzed (./data/processed/datawarehouse.db)
+    Data rows are upserted on their natural keys, (coin, timestamp) and
+    (contract, timestamp), so running it again only writes what changed.
+    data: {coin: (underlying_df, contract_df, surface_df)} as returned by preprocess.main.
+        If None, the interim csv files in interim_dir are read instead, for
+        the coins listed in raw_dir
+    defer_indexes: drop the indexes of the data tables during the load and
+        build them again at the end (faster for big loads)
+    chunk_size: contract rows sent to the db at a time
+    catalog_dir: instrument catalogs, the source of META
+    Returns: {'underlying': counts, 'contracts': counts, 'surface': counts}, with counts as
+        {'inserted': n, 'updated': n, 'skipped': n}
     """
     logger = logging.getLogger(__name__)
 
+    if data is None:
+        coins = [x.split('.')[0] for x in os.listdir(f'{raw_dir}/underlying/price')]
+        data = {coin: read_interim(coin, interim_dir, chunk_size) for coin in coins}
+    else:
+        data = {coin: (underlying_df, contract_df, iter_chunks(contract_df, chunk_size), surface_df)
+                for coin, (underlying_df, contract_df, surface_df) in data.items()}
+
+    if defer_indexes:
+        indexes = sql_create.drop_indexes(con, ['UNDERLYING_DATA', 'CONTRACTS_DATA'])
+
     # underlying metadata
-    raw_underlying_dir = os.listdir(f'./data/raw/underlying/price')
-    underlying_meta = [*map(lambda x: (x.split('.')[0],), raw_underlying_dir)]
     logger.info('Insert -- underlying metadata')
-    sql_insert.insert_underlying_meta(con, underlying_meta)
+    sql_insert.insert_underlying_meta(con, [(coin,) for coin in data])
 
     # underlying data
-    underlying_meta = sql_select.get_underlying_meta(con)
+    underlying_meta = [coin for coin in sql_select.get_underlying_meta(con) if coin[1] in data]
     logger.info('Insert -- underlying data')
-    [insert_underlying_data(con, coin[0], coin[1]) for coin in underlying_meta]
+    underlying_counts = add_counts([insert_underlying_data(con, coin[0], data[coin[1]][0]) for coin in underlying_meta])
+    logger.info(f'Insert -- underlying data -- {underlying_counts}')
+
+    # exchange metadata
+    logger.info('Insert -- metadata')
+    insert_meta(con, underlying_meta, catalog_dir)
 
     # contracts meta
     logger.info('Insert -- contract metadata')
-    [insert_contract_meta(con, coin[0], coin[1]) for coin in underlying_meta]
+    [insert_contract_meta(con, coin[0], data[coin[1]][1]) for coin in underlying_meta]
 
     # contracts data
-    contract_ids = sql_select.get_contracts_ids(con)
+    contract_ids = pd.DataFrame(sql_select.get_contracts_ids(con), columns=['contract_id', 'contract'])
     logger.info('Insert -- contract data')
-    [insert_contract_data(con, contract_id) for contract_id in contract_ids]
+    contract_counts = add_counts([insert_contract_data(con, data[coin[1]][2], contract_ids) for coin in underlying_meta])
+    logger.info(f'Insert -- contract data -- {contract_counts}')
+
+    # volatility surface
+    logger.info('Insert -- volatility surface')
+    surface_counts = add_counts([insert_vol_surface(con, coin[0], data[coin[1]][3])
+                                 for coin in underlying_meta if data[coin[1]][3] is not None])
+    logger.info(f'Insert -- volatility surface -- {surface_counts}')
+
+    if defer_indexes:
+        logger.info('Insert -- rebuilding indexes')
+        sql_create.create_indexes(con, indexes)
+
+    return {'underlying': underlying_counts, 'contracts': contract_counts, 'surface': surface_counts}
@@ -0,0 +1,110 @@
+"""Deribit instrument catalog.
+Every option instrument seen by get_instruments (active and expired) is kept
+in a columnar snapshot per coin, ./data/external/instruments/<coin>, with its
+name already parsed (expiration, strike, is_call) next to the exchange
+metadata (creation date, tick size, min trade size, commissions). It lives
+outside ./data/raw so it survives the cleanup of raw data between runs.
+"""
+import os
+import time
+from datetime import datetime
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+import raw_store
+
+
+CATALOG_DIR = './data/external/instruments'
+
+# catalog column: instrument field in the deribit get_instruments response
+FIELDS = {
+    'creation': 'creation_timestamp',
+    'tick_size': 'tick_size',
+    'min_trade': 'min_trade_amount',
+    'contract_size': 'contract_size',
+    'maker_commission': 'maker_commission',
+    'taker_commission': 'taker_commission',
+    'is_active': 'is_active',
+}
+
+
+@lru_cache(maxsize=None)
+def parse_instrument(name: str) -> tuple:
+    """Contract name (e.g. 'BTC-1JUL22-12000-C') -> (expiration, strike,
+    is_call)
+    Memoized: every name is only parsed once per process.
+    """
+    c = name.split('-')
+    expiration = time.mktime(
+        datetime.strptime(c[1] + '-10', "%d%b%y-%H").timetuple())
+    return expiration, int(c[2]), c[3] == 'C'
+
+
+def parse_instruments(names: np.ndarray) -> tuple:
+    """Parses an array of contract names, each distinct name once
+    Returns: (expiration, strike, is_call) arrays aligned with names
+    """
+    unique, idx = np.unique(np.asarray(names), return_inverse=True)
+    keys = [parse_instrument(name) for name in unique.tolist()]
+    expiration = np.array([k[0] for k in keys], dtype=np.float64)
+    strike = np.array([k[1] for k in keys], dtype=np.int64)
+    is_call = np.array([k[2] for k in keys], dtype=bool)
+    return expiration[idx], strike[idx], is_call[idx]
+
+
+def catalog_columns(instruments: list) -> dict:
+    """Columns of the option instruments of a get_instruments response"""
+    options = [i for i in instruments if i.get('kind') == 'option']
+    names = np.array([i['instrument_name'] for i in options], dtype=str)
+    expiration, strike, is_call = parse_instruments(names)
+    columns = {'name': names, 'expiration': expiration, 'strike': strike,
+               'is_call': is_call}
+    for column, field in FIELDS.items():
+        columns[column] = np.array([i.get(field) for i in options],
+                                   dtype=np.float64)
+    columns['creation'] = columns['creation'] / 1000
+    columns['is_active'] = columns['is_active'] == 1
+    return columns
+
+
+def load(coin: str, catalog_dir: str = CATALOG_DIR) -> pd.DataFrame:
+    """Catalog of coin, indexed by instrument name (empty if never saved)"""
+    path = f'{catalog_dir}/{coin}'
+    if not os.path.exists(path):
+        return pd.DataFrame(
+            columns=['expiration', 'strike', 'is_call', *FIELDS],
+            index=pd.Index([], name='name'))
+    return pd.DataFrame(raw_store.load(path)).set_index('name')
+
+
+def update(coin: str, instruments: list,
+           catalog_dir: str = CATALOG_DIR) -> pd.DataFrame:
+    """Adds the instruments of a get_instruments response to the catalog of
+    coin. Instruments already there are replaced by their newest version,
+    the ones missing from the response (e.g. long expired) are kept.
+    Returns: the updated catalog
+    """
+    new = pd.DataFrame(catalog_columns(instruments)).set_index('name')
+    catalog = load(coin, catalog_dir)
+    if not catalog.empty:
+        new = pd.concat([catalog[~catalog.index.isin(new.index)], new])
+    catalog = new.sort_index()
+
+    os.makedirs(catalog_dir, exist_ok=True)
+    raw_store.save(f'{catalog_dir}/{coin}', {
+        'name': catalog.index.to_numpy(dtype=str),
+        **{c: catalog[c].to_numpy() for c in catalog.columns}})
+    return catalog
+
+
+def meta(catalog: pd.DataFrame) -> tuple:
+    """Exchange metadata shared by the options of a coin, as stored in META
+    Returns: the most common (tick size, taker commission, maker commission,
+        min trade), None for values the exchange never sent
+    """
+    columns = ['tick_size', 'taker_commission', 'maker_commission',
+               'min_trade']
+    modes = [catalog[c].mode() for c in columns]
+    return tuple(float(m.iloc[0]) if len(m) else None for m in modes)
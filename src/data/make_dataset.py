@@ -3,13 +3,13 @@ import os, shutil
 import logging
 from dotenv import find_dotenv, dotenv_values
 
-import sqlite3
 import argparse
 
-from preprocess import main as preprocess_main
+from preprocess import main as preprocess_main, INTERIM_DIR
 from api import main as api_main
 from insert_dataset import insert_connection
 import sql_create
+import sql_insert
 
 
 def rm_files_recurse(folder):
@@ -30,22 +30,24 @@ def main(args):
     """
     logger = logging.getLogger(__name__)
     logger.info('requesting data from api (raw)')
-    api_main()
+    watermarks = api_main()
 
-    logger.info('preprocessing data: adding greeks (raw -> interim)')
-    preprocess_main()
+    logger.info('preprocessing data: adding greeks')
+    interim_dir = INTERIM_DIR if args.keep_interim else None
+    data = preprocess_main(args.workers, interim_dir=interim_dir)
 
     logger.info('creating sqlite file')
     db_file_path = os.path.join(args.output_filepath, args.DATA_WAREHOUSE_FILE)
     if os.path.exists(db_file_path):
         os.remove(db_file_path)
-    con = sqlite3.connect(db_file_path)
+    con = sql_create.connect(db_file_path)
 
     logger.info('creating sqlite database')
     sql_create.create(con)
     
-    logger.info('inserting data into database (interim -> processed)')
-    insert_connection(con)
+    logger.info('inserting data into database (processed)')
+    insert_connection(con, data, defer_indexes=True)
+    sql_insert.insert_watermarks(con, watermarks)
 
     logger.info('cleanup: delete intermediate files (raw & interim)')
     rm_files_recurse('raw')
@@ -58,6 +60,8 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description='Run data processing scripts to turn raw data from (../raw) into clean data ready to be analyzed (saved in ../processed).')
     parser.add_argument('-o', '--output-filepath', help='output filepath', required=True)
+    parser.add_argument('-k', '--keep-interim', help='Also write the preprocessed data to ./data/interim as csv (debugging).', action='store_true')
+    parser.add_argument('-w', '--workers', help='Processes used to compute greeks (1: serial).', type=int, default=1)
     args = parser.parse_args()
     # add arguments from .env to the namespace
     args = argparse.Namespace(**vars(args), **dotenv_values(find_dotenv()))
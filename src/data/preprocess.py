@@ -1,33 +1,74 @@
 import json
+import multiprocessing
 import os
+import signal
+import sqlite3
 import time
+from contextlib import closing
 import pandas as pd
 import numpy as np
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
 import logging
 
 import finance
-from tqdm import tqdm
-
+import instruments
+import raw_store
+import sql_select
+import surface
+
+
+RAW_DIR = './data/raw'
+INTERIM_DIR = './data/interim'
+VOLATILITY_DIR = './data/external/volatility'
+CHUNKS_PER_WORKER = 4
+HOUR = 3600
+HOURS_PER_DAY = 24
+# main may run in a thread (update_dataset daemon): forking a threaded
+# process can deadlock the children, so the pool starts them without fork
+MP_CONTEXT = ('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods()
+              else 'spawn')
 
 # TODO: add DVOL to underlying
-# TODO: interploate u_volume to be similar to recet
 
 
-def get_24h_data(data: list) -> np.ndarray:
-    return np.array([[d/24]*24 for d in data]).flatten()
+def upsample_hourly(timestamps: np.ndarray, values: np.ndarray, method: str = 'split') -> tuple:
+    """Upsamples a daily series to hourly, one point for every hour of the
+    (local) day of each daily timestamp.
+    timestamps: daily epochs (s), int64
+    values: value of each day
+    method: 'split' the daily value evenly over its 24 hours, 'ffill' repeat
+        it every hour, or 'interpolate' the hourly share (value / 24) linearly
+        between consecutive days
+    Returns: (hourly timestamps as int64, hourly values)
+    """
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+
+    # hours since local midnight; the offset only depends on the day, so it
+    # is looked up once per daily point, not per hour
+    offsets = np.array([time.localtime(t).tm_gmtoff for t in timestamps.tolist()], dtype=np.int64)
+    day_hour = (timestamps + offsets) % 86400 // HOUR
+    hours = np.arange(HOURS_PER_DAY, dtype=np.int64) * HOUR
+    hourly_timestamps = ((timestamps - day_hour * HOUR)[:, None] + hours).ravel()
 
+    if method == 'split':
+        hourly_values = np.repeat(values / HOURS_PER_DAY, HOURS_PER_DAY)
+    elif method == 'ffill':
+        hourly_values = np.repeat(values, HOURS_PER_DAY)
+    elif method == 'interpolate':
+        hourly_values = np.interp(hourly_timestamps, timestamps - day_hour * HOUR, values / HOURS_PER_DAY)
+    else:
+        raise ValueError(f'unknown upsample method {method!r}')
 
-def get_24h_timestamps(timestamps: list) -> list:
-    all_timestamps = np.array([[datetime.fromtimestamp(t)]*24 for t in timestamps]).flatten()
-    return [datetime.timestamp(d.replace(hour=i%24)) for i,d in enumerate(all_timestamps)]
+    return hourly_timestamps, hourly_values
 
 
-def get_underlying_recent(coin: str) -> pd.DataFrame:
+def get_underlying_recent(coin: str, raw_dir: str = RAW_DIR) -> pd.DataFrame:
     """Returns useful data from underlying/recent folder. Polygon API.
     Returns: price, volume, volume weighted, transactions; by timestamp (1h)
     """
-    with open(f'./data/raw/underlying/recent/{coin}.json') as json_file:
+    with open(f'{raw_dir}/underlying/recent/{coin}.json') as json_file:
         data = json.load(json_file)
 
     u_prices = [d['c'] for d in data['results']]
@@ -39,147 +80,307 @@ def get_underlying_recent(coin: str) -> pd.DataFrame:
     return pd.DataFrame(zipped, columns=['t', 'recent_price', 'recent_volume', 'recent_transaction']).set_index('t')
 
 
-def get_underlying_price(coin: str) -> pd.DataFrame:
+def get_underlying_price(coin: str, raw_dir: str = RAW_DIR) -> pd.DataFrame:
     """Returns useful data from underlying/price folder. Glassnode API.
     Returns: open, high, low, close; by timestamp (1h)
     """
-    with open(f'./data/raw/underlying/price/{coin}.json') as json_file:
-        data = json.load(json_file)
-
-    u_timestamps = [d['t'] for d in data]
-    u_open = [d['o']['o'] for d in data]
-    u_high = [d['o']['h'] for d in data]
-    u_low = [d['o']['l'] for d in data]
-    u_close = [d['o']['c'] for d in data]
+    data = raw_store.load(f'{raw_dir}/underlying/price/{coin}', ['t', 'open', 'high', 'low', 'close'])
 
-    zipped = list(zip(u_timestamps, u_open, u_high, u_low, u_close))
-    return pd.DataFrame(zipped, columns=['t', 'u_open', 'u_high', 'u_low', 'u_close']).set_index('t')
+    return pd.DataFrame({
+        't': data['t'],
+        'u_open': data['open'],
+        'u_high': data['high'],
+        'u_low': data['low'],
+        'u_close': data['close']}).set_index('t')
 
-def get_underlying_volume(coin: str) -> pd.DataFrame:
+def get_underlying_volume(coin: str, raw_dir: str = RAW_DIR) -> pd.DataFrame:
     """Returns useful data from underlying/volume folder. Coingecko API.
-    Returns: volume by timestamp (daily)
+    Returns: hourly volume by timestamp
     """
-    with open(f'./data/raw/underlying/volume/{coin}.json') as json_file:
-        data = json.load(json_file)
-
-    correct_time = lambda x: datetime.fromtimestamp(x/1000).replace(hour=0).timestamp()
-    u_timestamps = [correct_time(d[0]) for d in data['total_volumes']]
-    u_volumes = [d[1] for d in data['total_volumes']]
+    data = raw_store.load(f'{raw_dir}/underlying/volume/{coin}', ['t', 'v'])
+    t = data['t'] // 1000
 
-    all_volumes = get_24h_data(u_volumes)
-    all_timestamps = get_24h_timestamps(u_timestamps)
+    # market_chart/range is daily over ranges of 90 days or more, hourly or
+    # 5-minutely on the shorter ranges of update cycles; every point is a
+    # 24h volume, the last one of every hour is kept as its hourly share
+    if len(t) < 2 or np.median(np.diff(t)) < 86400 / 2:
+        hour = t // HOUR * HOUR
+        last = np.append(hour[1:] != hour[:-1], True)
+        return pd.DataFrame({'t': hour[last], 'u_volume': data['v'][last] / HOURS_PER_DAY}).set_index('t')
 
-    zipped = list(zip(all_timestamps, all_volumes))
-    return pd.DataFrame(zipped, columns=['t', 'u_volume']).set_index('t')
+    # interpolated, so hourly volumes change smoothly like the recent ones
+    t, u_volume = upsample_hourly(t, data['v'], 'interpolate')
+    return pd.DataFrame({'t': t, 'u_volume': u_volume}).set_index('t')
 
 
-def get_onchain_tx(coin: str) -> pd.DataFrame:
+def get_onchain_tx(coin: str, raw_dir: str = RAW_DIR) -> pd.DataFrame:
     """Returns useful data from onchain/tx folder.
     Returns: tx by timestamp
     """
-    with open(f'./data/raw/onchain/tx/{coin}.json') as json_file:
-        data = json.load(json_file)
-
-    u_timestamps = [d['t'] for d in data]
-    u_tx = [d['v'] for d in data]
+    data = raw_store.load(f'{raw_dir}/onchain/tx/{coin}', ['t', 'v'])
 
-    all_tx = get_24h_data(u_tx)
-    all_timestamps = get_24h_timestamps(u_timestamps)
+    t, chain_tx = upsample_hourly(data['t'], data['v'])
+    return pd.DataFrame({'t': t, 'chain_tx': chain_tx}).set_index('t')
 
-    zipped = list(zip(all_timestamps, all_tx))
-    return pd.DataFrame(zipped, columns=['t', 'chain_tx']).set_index('t')
 
-
-def get_onchain_volume(coin: str) -> pd.DataFrame:
+def get_onchain_volume(coin: str, raw_dir: str = RAW_DIR) -> pd.DataFrame:
     """Returns useful data from onchain/volume folder.
     Returns: volume by timestamp
     """
-    with open(f'./data/raw/onchain/volume/{coin}.json') as json_file:
-        data = json.load(json_file)
-
-    u_timestamps = [d['t'] for d in data]
-    u_volumes = [d['v'] for d in data]
+    data = raw_store.load(f'{raw_dir}/onchain/volume/{coin}', ['t', 'v'])
 
-    all_volumes = get_24h_data(u_volumes)
-    all_timestamps = get_24h_timestamps(u_timestamps)
+    t, chain_volume = upsample_hourly(data['t'], data['v'])
+    return pd.DataFrame({'t': t, 'chain_volume': chain_volume}).set_index('t')
 
-    zipped = list(zip(all_timestamps, all_volumes))
-    return pd.DataFrame(zipped, columns=['t', 'chain_volume']).set_index('t')
 
-
-def get_contract_data(coin: str) -> pd.DataFrame:
+def get_contract_data(coin: str, raw_dir: str = RAW_DIR) -> pd.DataFrame:
     """Returns useful data from contracts/data folder
     Returns: contract data(volume, price) by timestamp, contract
     """
-    with open(f'./data/raw/contracts/data/{coin}.json') as json_file:
-        data = json.load(json_file)
-    contracts = list(data.keys())
-    has_data = [bool(data[c]['ticks']) for c in contracts]
-    contracts = [c for i, c in enumerate(contracts) if has_data[i]]
-
-    c_v = [data[c]['volume'] for c in contracts]
-    c_t = [map(lambda x: x/1000, data[c]['ticks']) for c in contracts]
-    c_o = [data[c]['open'] for c in contracts]
-    c_l = [data[c]['low'] for c in contracts]
-    c_h = [data[c]['high'] for c in contracts]
-    c_c = [data[c]['close'] for c in contracts]
-
-    c_name_split = [c.split('-') for c in contracts]
-
-    get_timestamp = lambda d: time.mktime(datetime.strptime(d + '-10',"%d%b%y-%H").timetuple())
-    c_expiration = [get_timestamp(c[1]) for c in c_name_split]
-    c_strike = [int(c[2]) for c in c_name_split]
-    c_is_call = [c[3] == 'C' for c in c_name_split]
-
-    c_zip = lambda i: list(zip(c_t[i], c_v[i], c_o[i], c_l[i], c_h[i], c_c[i]))
-    c_data = [c_zip(i) for i, c in enumerate(contracts)]
-    
-    keys_names = ['contract', 'expiration', 'strike', 'is_call']
-    keys = list(zip(contracts, c_expiration, c_strike, c_is_call))
+    data = raw_store.load(f'{raw_dir}/contracts/data/{coin}')
+
+    contracts = np.asarray(data['contract'])
+    c_expiration, c_strike, c_is_call = instruments.parse_instruments(contracts)
+
+    c_df = pd.DataFrame({
+        'contract': contracts,
+        'expiration': c_expiration,
+        'strike': c_strike,
+        'is_call': c_is_call,
+        't': data['t'] / 1000,
+        'c_volume': data['volume'],
+        'c_open': data['open'],
+        'c_low': data['low'],
+        'c_high': data['high'],
+        'c_close': data['close']})
 
-    columns = ['t', 'c_volume','c_open','c_low','c_high','c_close']
-    c_dfs = [pd.DataFrame(data, columns=columns).set_index('t') for data in c_data]
+    return c_df
 
-    c_df = pd.concat(c_dfs, keys=keys, names=keys_names).reset_index()
 
-    return c_df
+def get_history(db_file: str, coin: str, before: float, window: float = finance.VOL_WINDOW) -> pd.Series:
+    """Close of coin in the warehouse over the window before timestamp
+    before, by timestamp (empty if there is no warehouse yet). Starts at
+    before - window, the close the first return of the window is taken from.
+    """
+    if db_file is None or not os.path.exists(db_file):
+        return pd.Series(dtype=np.float64)
+    with closing(sqlite3.connect(db_file)) as con:
+        rows = sql_select.get_underlying_close(con, coin, before - window, before)
+    t, close = zip(*rows) if rows else ((), ())
+    return pd.Series(close, index=pd.Index(t, name='t'), dtype=np.float64)
 
 
-def contract_metrics(row) -> dict:
-    """Higher order function for contract_df.apply"""
-    return finance.metrics(
-        s = row['u_close'],
-        k = row['strike'],
-        r = 0,
-        T = (abs((datetime.fromtimestamp(row['expiration']) - datetime.fromtimestamp(row.name)).days)+1) / 365, 
-        sigma = row['volatility'],
-        p = row['c_close'] * row['u_close'],
-        is_call = bool(row['is_call']))
+def get_stored_underlying(db_file: str, coin: str, start: float, end: float) -> pd.DataFrame:
+    """u_close and volatility of coin in the warehouse with start <= t < end,
+    by timestamp (empty if there is no warehouse yet)
+    """
+    rows = []
+    if db_file is not None and os.path.exists(db_file):
+        with closing(sqlite3.connect(db_file)) as con:
+            rows = sql_select.get_underlying_data(con, coin, start, end)
+    return pd.DataFrame(rows, columns=['t', 'u_close', 'volatility'], dtype=np.float64).set_index('t')
+
+
+def get_volatility(
+        coin: str,
+        close: pd.Series,
+        state_dir: str = VOLATILITY_DIR,
+        history: pd.Series = None) -> pd.Series:
+    """Rolling volatility of close, see finance.RollingVolatility.
+    Update cycles only fetch points newer than the watermarks, so the points
+    of close after the last one of the previous run continue from the state
+    that run saved in state_dir. Points at or before it (a batch fetched
+    again after a failure, or a full rebuild) are computed over history and
+    themselves, never from the few points of a batch alone.
+    history: close over the window before close (see get_history); the
+        estimator starts over from history + close when there is no state or
+        the warehouse has points newer than it (a gap)
+    """
+    close = close[~close.index.duplicated(keep='first')]
+    t = close.index.to_numpy(dtype=np.float64)
+    history = close.iloc[:0] if history is None else history
+    if len(t):
+        history = history[history.index < t[0]]
+    path = f'{state_dir}/{coin}'
+
+    estimator = None
+    if len(t) and os.path.exists(path):
+        estimator = finance.RollingVolatility.from_state(raw_store.load(path))
+        behind = len(history) and estimator.last_t is not None and estimator.last_t < history.index[-1]
+        if estimator.last_t is None or behind:
+            estimator = None
+
+    if estimator is None:
+        estimator = finance.RollingVolatility()
+        series = pd.concat([history, close])
+        values = estimator.init(series.index.to_numpy(dtype=np.float64), series)[len(history):]
+    else:
+        new = t > estimator.last_t
+        values = np.empty(len(t))
+        if not new.all():
+            series = pd.concat([history, close[~new]])
+            values[~new] = finance.RollingVolatility(
+                estimator.window, estimator.estimator, estimator.factor).init(
+                series.index.to_numpy(dtype=np.float64), series)[len(history):]
+        values[new] = estimator.update(t[new], close[new])
+
+    os.makedirs(state_dir, exist_ok=True)
+    raw_store.save(path, estimator.state())
+    return pd.Series(values, index=close.index)
+
+
+def time_to_expiry(contract_df: pd.DataFrame) -> np.ndarray:
+    """Time to expiry in years, counted in whole days (rounded up) from the
+    row timestamp
+    """
+    days = np.floor_divide(
+        contract_df['expiration'].to_numpy(dtype=np.float64) - contract_df['t'].to_numpy(dtype=np.float64),
+        24 * 60 * 60)
+    return (np.abs(days) + 1) / 365
+
+
+def contract_iv(contract_df: pd.DataFrame) -> pd.DataFrame:
+    """Market implied volatility of every row of contract_df at once
+    Returns: DataFrame indexed like contract_df, with column iv
+    """
+    s = contract_df['u_close'].to_numpy(dtype=np.float64)
+    k = contract_df['strike'].to_numpy(dtype=np.float64)
+    p = contract_df['c_close'].to_numpy(dtype=np.float64) * s
+    is_call = contract_df['is_call'].to_numpy(dtype=bool)
+
+    iv = finance.bsm_iv(s, k, 0, time_to_expiry(contract_df), p, is_call)[['iv']]
+    iv.index = contract_df.index
+    return iv
+
+
+def contract_metrics(contract_df: pd.DataFrame) -> pd.DataFrame:
+    """Computes fair price, greeks and iv for every row of contract_df at once.
+    Greeks use the 'sigma' column (volatility surface) when contract_df has
+    one, else the historical 'volatility'. If contract_df already has an 'iv'
+    column it is not solved again (nor returned).
+    Returns: DataFrame indexed like contract_df, one column per metric
+    """
+    s = contract_df['u_close'].to_numpy(dtype=np.float64)
+    k = contract_df['strike'].to_numpy(dtype=np.float64)
+    is_call = contract_df['is_call'].to_numpy(dtype=bool)
+    sigma_column = 'sigma' if 'sigma' in contract_df else 'volatility'
+    sigma = contract_df[sigma_column].to_numpy(dtype=np.float64)
+    T = time_to_expiry(contract_df)
+
+    metrics = finance.bsm_greeks(s, k, 0, T, sigma, is_call)
+    metrics.index = contract_df.index
+    if 'iv' not in contract_df:
+        metrics.insert(5, 'iv', contract_iv(contract_df)['iv'])
+    return metrics
+
+
+def contract_surface(contract_df: pd.DataFrame) -> tuple:
+    """Fits the volatility surface of every timestamp of contract_df (from
+    its 'iv' column) and looks up each row's sigma on it
+    Returns: (surface_df, sigma), see surface.fit; sigma is NaN for rows
+        whose slice could not be fitted
+    """
+    t = contract_df['t'].to_numpy(dtype=np.float64)
+    expiration = contract_df['expiration'].to_numpy(dtype=np.float64)
+    T = time_to_expiry(contract_df)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        k = np.log(contract_df['strike'].to_numpy(dtype=np.float64) / contract_df['u_close'].to_numpy(dtype=np.float64))
+
+    surface_df = surface.fit(t, expiration, T, k, contract_df['iv'])
+    sigma = surface.VolSurface(surface_df).sigma(t, expiration, T, k)
+    return surface_df, pd.Series(sigma, index=contract_df.index)
 
 
-def preprocess(coin: str):
-    """Preprocesses raw data by coin"""
+def split_chunks(contract_df: pd.DataFrame, n_chunks: int, chunk_by: str = 'expiration') -> list:
+    """Splits contract_df into at most n_chunks frames of similar size, never
+    splitting the rows of one chunk_by value (contract or expiration) apart.
+    """
+    keys, inverse = np.unique(contract_df[chunk_by].to_numpy(), return_inverse=True)
+    rows_until_key = np.cumsum(np.bincount(inverse, minlength=len(keys)))
+    chunk_of_key = (rows_until_key - 1) * n_chunks // max(len(contract_df), 1)
+    chunk_of_row = chunk_of_key[inverse]
+    return [contract_df[chunk_of_row == i] for i in np.unique(chunk_of_row)]
+
+
+def contract_metrics_parallel(
+        contract_df: pd.DataFrame,
+        executor: ProcessPoolExecutor,
+        workers: int,
+        chunk_by: str = 'expiration',
+        func=contract_metrics) -> pd.DataFrame:
+    """Runs func (contract_metrics or contract_iv) over chunks of
+    contract_df in executor's workers. Every metric is computed element-wise,
+    so the result is identical to func(contract_df); chunks are merged back
+    in row order.
+    """
+    chunks = split_chunks(contract_df, workers * CHUNKS_PER_WORKER, chunk_by)
+    metrics = pd.concat(executor.map(func, chunks))
+    return metrics.reindex(contract_df.index)
+
+
+def preprocess(
+        coin: str,
+        executor: ProcessPoolExecutor = None,
+        workers: int = 1,
+        raw_dir: str = RAW_DIR,
+        interim_dir: str = None,
+        volatility_dir: str = VOLATILITY_DIR,
+        db_file: str = None) -> tuple:
+    """Preprocesses raw data by coin
+    executor: if passed, greeks and iv are computed in its worker processes
+    workers: number of worker processes in executor
+    raw_dir: folder with the raw snapshots (see api.main)
+    interim_dir: if passed, the results are also written there as csv files
+        (for debugging, insert_dataset takes the DataFrames directly)
+    volatility_dir: where the rolling volatility state is kept between runs
+    db_file: warehouse the data goes to, read for the volatility window
+        before the first point (see get_volatility)
+    Returns: (underlying_df, contract_df, surface_df), the first two with a
+        't' column, surface_df as returned by surface.fit
+    """
     logger = logging.getLogger(__name__)
     
     logger.info(f'{coin} -- Preprocess -- getting interim data')
-    u_recent_df = get_underlying_recent(coin)
-    u_price_df = get_underlying_price(coin)
-    u_volume_df = get_underlying_volume(coin)
-    chain_tx_df = get_onchain_tx(coin)
-    chain_volume_df = get_onchain_volume(coin)
-    c_df = get_contract_data(coin)
+    u_recent_df = get_underlying_recent(coin, raw_dir)
+    u_price_df = get_underlying_price(coin, raw_dir)
+    u_volume_df = get_underlying_volume(coin, raw_dir)
+    chain_tx_df = get_onchain_tx(coin, raw_dir)
+    chain_volume_df = get_onchain_volume(coin, raw_dir)
+    c_df = get_contract_data(coin, raw_dir)
 
     underlying_df = u_price_df.join(u_volume_df).join(chain_tx_df).join(chain_volume_df).join(u_recent_df)
     underlying_df = underlying_df[~underlying_df.index.duplicated(keep='first')]
 
     logger.info(f'{coin} -- Preprocess -- calculating volatility')
-    underlying_df["volatility"] = finance.volatility(underlying_df["u_close"])
+    history = get_history(db_file, coin, underlying_df.index.min()) if len(underlying_df) else None
+    underlying_df["volatility"] = get_volatility(coin, underlying_df["u_close"], volatility_dir, history)
     contract_df = c_df.join(underlying_df, on='t').drop_duplicates()
 
+    # contract hours older than this batch of underlying data are priced with
+    # the warehouse; the newer ones wait for their underlying price, api.main
+    # keeps the contract watermarks behind it
+    missing = contract_df['u_close'].isna()
+    if missing.any():
+        end = underlying_df.index.min() if len(underlying_df) else np.inf
+        stored = get_stored_underlying(db_file, coin, contract_df.loc[missing, 't'].min(), end)
+        found = stored.reindex(contract_df.loc[missing, 't'])
+        contract_df.loc[missing, ['u_close', 'volatility']] = found[['u_close', 'volatility']].to_numpy()
+        contract_df = contract_df[contract_df['u_close'].notna()]
+
+    metrics = lambda func: func(contract_df) if executor is None else \
+        contract_metrics_parallel(contract_df, executor, workers, func=func)
+
+    logger.info(f'{coin} -- Preprocess -- calculating iv')
+    contract_df = contract_df.join(metrics(contract_iv))
+
+    # greeks are priced with the smile of their own strike and expiry, the
+    # historical volatility only where no slice could be fitted
+    logger.info(f'{coin} -- Preprocess -- fitting volatility surface')
+    surface_df, sigma = contract_surface(contract_df)
+    contract_df['sigma'] = sigma.fillna(contract_df['volatility'])
+
     logger.info(f'{coin} -- Preprocess -- calculating greeks')
-    tqdm.pandas()
-    metrics = contract_df.progress_apply(contract_metrics, axis=1, result_type='expand')
-    contract_df = contract_df.join(metrics)
+    contract_df = contract_df.join(metrics(contract_metrics))
 
     logger.info(f'{coin} -- Preprocess -- all calculations done')
     contract_df = contract_df.drop(columns=[
@@ -192,19 +393,63 @@ def preprocess(coin: str):
         'u_close',
         'u_volume',
         'chain_volume',
-        'chain_tx'])
-    underlying_df.fillna(0).to_csv(f'./data/interim/underlying/{coin}.csv')
-    contract_df.fillna(0).to_csv(f'./data/interim/contracts/{coin}.csv')
-
-
-def main():
+        'chain_tx',
+        'sigma'])
+    underlying_df = underlying_df.fillna(0).reset_index()
+    contract_df = contract_df.fillna(0)
+
+    if interim_dir is not None:
+        underlying_df.to_csv(f'{interim_dir}/underlying/{coin}.csv', index=False)
+        contract_df.to_csv(f'{interim_dir}/contracts/{coin}.csv')
+        surface_df.to_csv(f'{interim_dir}/surface/{coin}.csv', index=False)
+
+    return underlying_df, contract_df, surface_df
+
+
+def ignore_interrupts():
+    """Pool workers leave SIGINT to the parent, which finishes its cycle"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def main(
+        workers: int = 1,
+        raw_dir: str = RAW_DIR,
+        interim_dir: str = None,
+        volatility_dir: str = VOLATILITY_DIR,
+        db_file: str = None) -> dict:
+    """Preprocesses every coin in raw_dir
+    workers: number of processes computing greeks. With more than one, coins
+        are also preprocessed concurrently, sharing the same process pool
+    interim_dir: if passed, the results are also written there as csv files
+    db_file: warehouse being updated, if any (see preprocess)
+    Returns: {coin: (underlying_df, contract_df, surface_df)}, see insert_dataset.insert_connection
+    """
     pd.set_option('display.float_format', lambda x: '%.6f' % x)
     
-    underlying_dir = os.listdir(f'./data/raw/underlying/price')
+    price_dir = f'{raw_dir}/underlying/price'
+    underlying_dir = os.listdir(price_dir) if os.path.isdir(price_dir) else []
     coins = [*map(lambda x: x.split('.')[0], underlying_dir)]
-
-    [preprocess(coin) for coin in coins]
+    if interim_dir is not None:
+        os.makedirs(f'{interim_dir}/underlying', exist_ok=True)
+        os.makedirs(f'{interim_dir}/contracts', exist_ok=True)
+        os.makedirs(f'{interim_dir}/surface', exist_ok=True)
+
+    # nothing fetched yet (e.g. the first cycle of the daemon)
+    if not coins:
+        return {}
+    if workers <= 1:
+        return {coin: preprocess(coin, raw_dir=raw_dir, interim_dir=interim_dir,
+                                 volatility_dir=volatility_dir, db_file=db_file)
+                for coin in coins}
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(MP_CONTEXT),
+                             initializer=ignore_interrupts) as executor, \
+            ThreadPoolExecutor(max_workers=len(coins)) as coin_executor:
+        # list() re-raises any exception from the coin threads
+        results = list(coin_executor.map(preprocess, coins, repeat(executor), repeat(workers),
+            repeat(raw_dir), repeat(interim_dir), repeat(volatility_dir), repeat(db_file)))
+    return dict(zip(coins, results))
 
 
 if __name__ == "__main__":
-    main()
+    main(interim_dir=INTERIM_DIR)
@@ -0,0 +1,135 @@
+"""Per provider rate limiting for the fetch layer.
+Each provider has one token bucket, configured from .env with
+<PROVIDER>_RATE (requests per second) and <PROVIDER>_BURST (bucket size).
+Requests reserve a token and sleep until it is due; a 429 response pauses
+the whole bucket for the Retry-After time (or an exponential backoff with
+jitter) so no other thread hits the provider while it is throttling us.
+"""
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import dotenv
+
+dotenv.load_dotenv('.env')
+
+
+# (requests per second, burst) used when .env has no value
+DEFAULT_LIMITS = {
+    'deribit': (20.0, 20),
+    'glassnode': (1.0, 5),
+    'coingecko': (0.25, 5),
+    'polygon': (5 / 60, 5),
+}
+
+MAX_RETRIES = 5
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 120.0
+
+
+class TokenBucket:
+    """Token bucket refilled at rate tokens per second, holding at most burst
+    tokens. acquire() may leave the bucket negative: that is a reservation,
+    and the caller sleeps until its token has been refilled.
+    """
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+        self.requests = 0
+        self.throttled = 0
+        self.wait_time = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self) -> float:
+        """Takes one token, sleeping until it is available.
+        Returns: seconds waited
+        """
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= 1
+            wait = max(-self.tokens / self.rate, self.paused_until - now, 0.0)
+            self.requests += 1
+            self.wait_time += wait
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def pause(self, seconds: float):
+        """Stops handing out tokens for the next seconds (after a 429).
+        The pause is reserved in the bucket: it is left empty at the end of
+        the pause, so requests queued meanwhile resume at rate, not at once.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            # only the part not covered by a pause already reserved
+            extension = now + seconds - max(self.paused_until, now)
+            self.tokens = min(self.tokens, 0.0)
+            if extension > 0:
+                self.tokens -= extension * self.rate
+                self.paused_until = now + seconds
+            self.throttled += 1
+
+
+_lock = threading.Lock()
+_buckets = {}
+
+
+def get_limits(provider: str) -> tuple:
+    rate, burst = DEFAULT_LIMITS.get(provider, (1.0, 1))
+    rate = float(os.environ.get(f'{provider.upper()}_RATE', rate))
+    burst = int(os.environ.get(f'{provider.upper()}_BURST', burst))
+    return rate, burst
+
+
+def get_bucket(provider: str) -> TokenBucket:
+    """Returns the (lazily created) token bucket of provider"""
+    with _lock:
+        if provider not in _buckets:
+            _buckets[provider] = TokenBucket(*get_limits(provider))
+        return _buckets[provider]
+
+
+def retry_after(value: str) -> float:
+    """Seconds to wait from a Retry-After header, either delta-seconds or an
+    HTTP date. Returns None if missing or unparseable.
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff(attempt: int) -> float:
+    """Exponential backoff with full jitter for the attempt-th retry"""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def metrics() -> dict:
+    """Per provider counters: requests, throttled (429s) and the seconds
+    requests spent waiting for a token.
+    """
+    with _lock:
+        return {
+            provider: {
+                'requests': bucket.requests,
+                'throttled': bucket.throttled,
+                'wait_time': bucket.wait_time,
+            } for provider, bucket in _buckets.items()}
@@ -0,0 +1,36 @@
+"""Columnar store for raw api snapshots.
+A snapshot is a directory holding one .npy file per column, e.g.
+./data/raw/contracts/data/BTC/close.npy. Columns are typed arrays, so they
+are loaded memory-mapped and only the columns a reader asks for are touched.
+"""
+import os
+import shutil
+import numpy as np
+
+
+def save(path: str, columns: dict):
+    """Saves columns ({name: array-like}) as a snapshot in directory path,
+    replacing any previous snapshot there.
+    """
+    tmp_path = f'{path}.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    for name, values in columns.items():
+        np.save(os.path.join(tmp_path, f'{name}.npy'), np.asarray(values))
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+
+
+def load(path: str, names: list = None) -> dict:
+    """Loads a snapshot saved in directory path, memory-mapped.
+    names: columns to load (default: all of them)
+    Returns: {name: np.ndarray}
+    """
+    if names is None:
+        names = [f[:-len('.npy')] for f in sorted(os.listdir(path)) if f.endswith('.npy')]
+    return {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r') for name in names}
+
@@ -71,13 +71,176 @@ create_underlying_data_table = """CREATE TABLE UNDERLYING_DATA (
 );"""
 
 
+create_watermarks_table = """CREATE TABLE IF NOT EXISTS WATERMARKS (
+	PROVIDER VARCHAR(20),
+	METRIC VARCHAR(20),
+	COIN VARCHAR(3),
+	CONTRACT VARCHAR(30),
+	TIMESTAMP TIMESTAMP,
+	PRIMARY KEY (PROVIDER, METRIC, COIN, CONTRACT)
+);"""
+
+
+# SVI parameters of every (timestamp, expiration) slice, see surface.py
+create_vol_surface_table = """CREATE TABLE IF NOT EXISTS VOL_SURFACE (
+	ID INTEGER PRIMARY KEY AUTOINCREMENT,
+	UNDERLYING_ID INTEGER,
+	TIMESTAMP TIMESTAMP,
+	EXPIRATION TIMESTAMP,
+	T FLOAT,
+	A FLOAT,
+	B FLOAT,
+	RHO FLOAT,
+	M FLOAT,
+	SIGMA FLOAT,
+	RMSE FLOAT,
+	N INTEGER,
+	FOREIGN KEY(UNDERLYING_ID) REFERENCES UNDERLYING_META(ID)
+);"""
+
+
+# natural keys (unique, needed for upserts) and time range lookups
+create_indexes_list = [
+	"""CREATE UNIQUE INDEX IF NOT EXISTS UNDERLYING_META_NAME
+		ON UNDERLYING_META (NAME);""",
+	"""CREATE UNIQUE INDEX IF NOT EXISTS CONTRACTS_META_NAME
+		ON CONTRACTS_META (NAME);""",
+	"""CREATE UNIQUE INDEX IF NOT EXISTS META_UNDERLYING_ID
+		ON META (UNDERLYING_ID);""",
+	"""CREATE UNIQUE INDEX IF NOT EXISTS VOL_SURFACE_ID_TIMESTAMP_EXPIRATION
+		ON VOL_SURFACE (UNDERLYING_ID, TIMESTAMP, EXPIRATION);""",
+	"""CREATE UNIQUE INDEX IF NOT EXISTS UNDERLYING_DATA_ID_TIMESTAMP
+		ON UNDERLYING_DATA (UNDERLYING_ID, TIMESTAMP);""",
+	"""CREATE UNIQUE INDEX IF NOT EXISTS CONTRACTS_DATA_ID_TIMESTAMP
+		ON CONTRACTS_DATA (CONTRACT_ID, TIMESTAMP);""",
+	"""CREATE INDEX IF NOT EXISTS UNDERLYING_DATA_TIMESTAMP
+		ON UNDERLYING_DATA (TIMESTAMP);""",
+	"""CREATE INDEX IF NOT EXISTS CONTRACTS_DATA_TIMESTAMP
+		ON CONTRACTS_DATA (TIMESTAMP);""",
+]
+
+
+# page_size only applies to new databases, so it goes before journal_mode
+PRAGMAS = [
+	('page_size', 8192),
+	('journal_mode', 'WAL'),
+	('synchronous', 'NORMAL'),
+	('mmap_size', 1 << 30),
+	('cache_size', -64 * 1024),
+	('temp_store', 'MEMORY'),
+]
+
+SCHEMA_VERSION = 3
+
+
+def connect(db_file: str) -> sqlite3.Connection:
+	"""Opens the data warehouse with the tuning pragmas applied"""
+	con = sqlite3.connect(db_file)
+	with closing(con.cursor()) as cursor:
+		for pragma, value in PRAGMAS:
+			cursor.execute(f'PRAGMA {pragma} = {value}')
+	return con
+
+
 def create(con):
-    with closing(con.cursor()) as cursor:
-        cursor.execute(create_underlying_meta_table)
-        cursor.execute(create_underlying_data_table)
-        cursor.execute(create_contracts_meta_table)
-        cursor.execute(create_contracts_data_table)
-        cursor.execute(create_meta_table)
+	with closing(con.cursor()) as cursor:
+		cursor.execute(create_underlying_meta_table)
+		cursor.execute(create_underlying_data_table)
+		cursor.execute(create_contracts_meta_table)
+		cursor.execute(create_contracts_data_table)
+		cursor.execute(create_meta_table)
+		cursor.execute(create_watermarks_table)
+		cursor.execute(create_vol_surface_table)
+		for index in create_indexes_list:
+			cursor.execute(index)
+		cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+	con.commit()
+
+
+# remove the duplicates left by blind re-inserts, so unique indexes can be
+# built
+dedup_queries = [
+	# point every reference to a duplicated name at its first ID
+	"""UPDATE UNDERLYING_DATA SET UNDERLYING_ID = (
+		SELECT MIN(B.ID) FROM UNDERLYING_META A
+		JOIN UNDERLYING_META B ON A.NAME = B.NAME
+		WHERE A.ID = UNDERLYING_DATA.UNDERLYING_ID)
+	WHERE UNDERLYING_ID NOT IN (
+		SELECT MIN(ID) FROM UNDERLYING_META GROUP BY NAME);""",
+	"""UPDATE CONTRACTS_META SET UNDERLYING_ID = (
+		SELECT MIN(B.ID) FROM UNDERLYING_META A
+		JOIN UNDERLYING_META B ON A.NAME = B.NAME
+		WHERE A.ID = CONTRACTS_META.UNDERLYING_ID)
+	WHERE UNDERLYING_ID NOT IN (
+		SELECT MIN(ID) FROM UNDERLYING_META GROUP BY NAME);""",
+	"""UPDATE META SET UNDERLYING_ID = (
+		SELECT MIN(B.ID) FROM UNDERLYING_META A
+		JOIN UNDERLYING_META B ON A.NAME = B.NAME
+		WHERE A.ID = META.UNDERLYING_ID)
+	WHERE UNDERLYING_ID NOT IN (
+		SELECT MIN(ID) FROM UNDERLYING_META GROUP BY NAME);""",
+	"""UPDATE CONTRACTS_DATA SET CONTRACT_ID = (
+		SELECT MIN(B.ID) FROM CONTRACTS_META A
+		JOIN CONTRACTS_META B ON A.NAME = B.NAME
+		WHERE A.ID = CONTRACTS_DATA.CONTRACT_ID)
+	WHERE CONTRACT_ID NOT IN (
+		SELECT MIN(ID) FROM CONTRACTS_META GROUP BY NAME);""",
+	"""DELETE FROM UNDERLYING_META WHERE ID NOT IN (
+		SELECT MIN(ID) FROM UNDERLYING_META GROUP BY NAME);""",
+	"""DELETE FROM CONTRACTS_META WHERE ID NOT IN (
+		SELECT MIN(ID) FROM CONTRACTS_META GROUP BY NAME);""",
+	"""DELETE FROM META WHERE ID NOT IN (
+		SELECT MAX(ID) FROM META GROUP BY UNDERLYING_ID);""",
+	# keep the newest row of every (id, timestamp)
+	"""DELETE FROM UNDERLYING_DATA WHERE ID NOT IN (
+		SELECT MAX(ID) FROM UNDERLYING_DATA GROUP BY UNDERLYING_ID, TIMESTAMP);""",
+	"""DELETE FROM CONTRACTS_DATA WHERE ID NOT IN (
+		SELECT MAX(ID) FROM CONTRACTS_DATA GROUP BY CONTRACT_ID, TIMESTAMP);""",
+]
+
+
+def migrate(con):
+	"""Upgrades an existing warehouse in place to SCHEMA_VERSION, without a
+	rebuild: removes duplicated rows, then adds missing tables and indexes.
+	"""
+	version = con.execute('PRAGMA user_version').fetchone()[0]
+	if version >= SCHEMA_VERSION:
+		return
+	# one transaction: rolled back if any step fails
+	with con:
+		con.execute('BEGIN')
+		con.execute(create_watermarks_table)
+		con.execute(create_vol_surface_table)
+		for query in dedup_queries:
+			con.execute(query)
+		for index in create_indexes_list:
+			con.execute(index)
+		con.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+
+def drop_indexes(con, tables: list) -> list:
+	"""Drops the non-unique indexes of tables (unique ones enforce the natural
+	keys, so they stay)
+	Returns: their CREATE INDEX statements, to build them again with
+		create_indexes
+	"""
+	placeholders = ', '.join('?' * len(tables))
+	with closing(con.cursor()) as cursor:
+		indexes = cursor.execute(f"""SELECT name, sql FROM sqlite_master
+			WHERE type = 'index' AND sql IS NOT NULL AND sql NOT LIKE 'CREATE UNIQUE%'
+			AND tbl_name IN ({placeholders})""", tables).fetchall()
+		for name, _ in indexes:
+			cursor.execute(f'DROP INDEX {name}')
+	con.commit()
+	return [sql for _, sql in indexes]
+
+
+def create_indexes(con, indexes: list):
+	"""Runs CREATE INDEX statements, as returned by drop_indexes"""
+	with closing(con.cursor()) as cursor:
+		for sql in indexes:
+			cursor.execute(sql)
+	con.commit()
 
 
 def main(args):
@@ -86,7 +249,7 @@ def main(args):
     if os.path.exists(db_file):
         os.remove(db_file)
 
-    con = sqlite3.connect(db_file)
+    con = connect(db_file)
 
     create(con)
 
@@ -1,30 +1,78 @@
 from contextlib import closing
 
 
-def insert_many(con, query: str, data: list):
+def insert_many(con, query: str, data: list, commit: bool = True):
     """Inserts many rows (data) using query
     con: sqlite3 connect object
     query: sql insert query
         form: must have parameterized values: (?, ...)
-    data: arbitrary list
+    data: arbitrary list (or iterable of rows)
+    commit: commit after the insert; False leaves the transaction open, so
+        several inserts can be committed together
     """
     with closing(con.cursor()) as cursor:
         cursor.executemany(query, data)
-    con.commit()
+    if commit:
+        con.commit()
+
+
+def upsert_many(con, table: str, keys: list, columns: list, data: list, commit: bool = True) -> dict:
+    """Inserts new rows and updates changed ones, matching rows on keys (which
+    must have a unique index). Rows equal to the stored ones are skipped.
+    con: sqlite3 connect object
+    table: table to upsert into
+    keys: natural key columns
+    columns: all columns in data, keys included
+    data: arbitrary list (or iterable of rows); the last row of a repeated key wins
+    commit: commit after the upsert
+    Returns: {'inserted': n, 'updated': n, 'skipped': n}
+    """
+    stage = f'STAGE_{table}'
+    cols = ', '.join(columns)
+    key_cols = ', '.join(keys)
+    values = [c for c in columns if c not in keys]
+    match = ' AND '.join(f'T.{k} = S.{k}' for k in keys)
+    changed = ' OR '.join(f'T.{v} IS NOT S.{v}' for v in values)
+
+    with closing(con.cursor()) as cursor:
+        cursor.execute(f'DROP TABLE IF EXISTS temp.{stage}')
+        cursor.execute(f'CREATE TEMP TABLE {stage} AS SELECT {cols} FROM {table} WHERE 0')
+        cursor.executemany(
+            f'INSERT INTO {stage} ({cols}) VALUES ({", ".join("?" * len(columns))})', data)
+        cursor.execute(f"""DELETE FROM {stage} WHERE rowid NOT IN (
+            SELECT MAX(rowid) FROM {stage} GROUP BY {key_cols})""")
+
+        total = cursor.execute(f'SELECT COUNT(*) FROM {stage}').fetchone()[0]
+        inserted = cursor.execute(f"""SELECT COUNT(*) FROM {stage} S
+            WHERE NOT EXISTS (SELECT 1 FROM {table} T WHERE {match})""").fetchone()[0]
+        updated = cursor.execute(f"""SELECT COUNT(*) FROM {stage} S
+            JOIN {table} T ON {match} WHERE {changed}""").fetchone()[0]
+
+        # WHERE true: lets sqlite parse ON CONFLICT after a SELECT
+        cursor.execute(f"""INSERT INTO {table} ({cols}) SELECT {cols} FROM {stage} WHERE true
+            ON CONFLICT ({key_cols}) DO UPDATE SET {", ".join(f"{v} = excluded.{v}" for v in values)}
+            WHERE {" OR ".join(f"{table}.{v} IS NOT excluded.{v}" for v in values)}""")
+        cursor.execute(f'DROP TABLE {stage}')
+    if commit:
+        con.commit()
+
+    return {'inserted': inserted, 'updated': updated, 'skipped': total - inserted - updated}
 
 
 def insert_underlying_meta(con, data: list = [('BTC',),('ETH',)]):
-    """Inserts to UNDERLYING_META
+    """Inserts to UNDERLYING_META, ignoring rows whose natural key
+    (see sql_create.create_indexes_list) is already there
     con: sqlite3 connect object
     data: list of coin names
         default: ['BTC', 'ETH']
     """
-    query = "INSERT INTO UNDERLYING_META (NAME) VALUES (?)"
+    query = "INSERT OR IGNORE INTO UNDERLYING_META (NAME) VALUES (?)"
     insert_many(con, query, data)
 
 
 def insert_underlying_data(con, data: list = []):
-    """Inserts to UNDERLYING_DATA
+    """Inserts to UNDERLYING_DATA, ignoring rows whose natural key
+    (see sql_create.create_indexes_list) is already there
     con: sqlite3 connect object
     data: list of coins data
         form: [ 
@@ -33,7 +81,7 @@ def insert_underlying_data(con, data: list = []):
                 RECENT_VOLUME, RECENT_TX, VOLATILITY], 
             ... ]
     """
-    query = """INSERT INTO UNDERLYING_DATA
+    query = """INSERT OR IGNORE INTO UNDERLYING_DATA
     (UNDERLYING_ID, TIMESTAMP, OPEN, HIGH, LOW, CLOSE, 
         VOLUME, CHAIN_TX, CHAIN_VOLUME, RECENT_PRICE, 
         RECENT_VOLUME, RECENT_TX, VOLATILITY) 
@@ -41,22 +89,36 @@ def insert_underlying_data(con, data: list = []):
     insert_many(con, query, data)
 
 
+def upsert_underlying_data(con, data: list = [], commit: bool = True) -> dict:
+    """Upserts to UNDERLYING_DATA on (UNDERLYING_ID, TIMESTAMP), see upsert_many
+    con: sqlite3 connect object
+    data: list of coins data, same form as insert_underlying_data
+    Returns: {'inserted': n, 'updated': n, 'skipped': n}
+    """
+    columns = ['UNDERLYING_ID', 'TIMESTAMP', 'OPEN', 'HIGH', 'LOW', 'CLOSE',
+        'VOLUME', 'CHAIN_TX', 'CHAIN_VOLUME', 'RECENT_PRICE',
+        'RECENT_VOLUME', 'RECENT_TX', 'VOLATILITY']
+    return upsert_many(con, 'UNDERLYING_DATA', ['UNDERLYING_ID', 'TIMESTAMP'], columns, data, commit)
+
+
 def insert_contracts_meta(con, data: list = []):
-    """Inserts to CONTRACTS_META
+    """Inserts to CONTRACTS_META, ignoring rows whose natural key
+    (see sql_create.create_indexes_list) is already there
     con: sqlite3 connect object
     data: list of contracts metadata
         form: [ 
             [UNDERLYING_ID, NAME, EXPIRATION, STRIKE, IS_CALL], 
             ... ]
     """
-    query = """INSERT INTO CONTRACTS_META
+    query = """INSERT OR IGNORE INTO CONTRACTS_META
     (UNDERLYING_ID, NAME, EXPIRATION, STRIKE, IS_CALL) 
     VALUES (?, ?, ?, ?, ?)"""
     insert_many(con, query, data)
 
 
-def insert_contracts_data(con, data: list = []):
-    """Inserts to CONTRACTS_DATA
+def insert_contracts_data(con, data: list = [], commit: bool = True):
+    """Inserts to CONTRACTS_DATA, ignoring rows whose natural key
+    (see sql_create.create_indexes_list) is already there
     con: sqlite3 connect object
     data: list of coins data
         form: [ 
@@ -64,12 +126,52 @@ def insert_contracts_data(con, data: list = []):
                 HIGH, LOW, FAIR_PRICE, D, V, T, G, R, IV], 
             ... ]
     """
-    query = """INSERT INTO CONTRACTS_DATA
+    query = """INSERT OR IGNORE INTO CONTRACTS_DATA
     (CONTRACT_ID, TIMESTAMP, VOLUME, OPEN, CLOSE, 
         HIGH, LOW, FAIR_PRICE, D, V, T, G, R, IV) 
     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
-    insert_many(con, query, data)
+    insert_many(con, query, data, commit)
 
 
-# TODO: insert general metadata
+def upsert_contracts_data(con, data: list = [], commit: bool = True) -> dict:
+    """Upserts to CONTRACTS_DATA on (CONTRACT_ID, TIMESTAMP), see upsert_many
+    con: sqlite3 connect object
+    data: list of contracts data, same form as insert_contracts_data
+    Returns: {'inserted': n, 'updated': n, 'skipped': n}
+    """
+    columns = ['CONTRACT_ID', 'TIMESTAMP', 'VOLUME', 'OPEN', 'CLOSE',
+        'HIGH', 'LOW', 'FAIR_PRICE', 'D', 'V', 'T', 'G', 'R', 'IV']
+    return upsert_many(con, 'CONTRACTS_DATA', ['CONTRACT_ID', 'TIMESTAMP'], columns, data, commit)
+
+
+def insert_watermarks(con, watermarks: dict = {}):
+    """Inserts or replaces WATERMARKS, all in one transaction
+    con: sqlite3 connect object
+    watermarks: newest timestamp fetched by series
+        form: {(PROVIDER, METRIC, COIN, CONTRACT): TIMESTAMP, ... }
+    """
+    query = """INSERT OR REPLACE INTO WATERMARKS
+    (PROVIDER, METRIC, COIN, CONTRACT, TIMESTAMP) 
+    VALUES (?, ?, ?, ?, ?)"""
+    insert_many(con, query, [(*key, mark) for key, mark in watermarks.items()])
+
+
+def upsert_vol_surface(con, data: list = [], commit: bool = True) -> dict:
+    """Upserts to VOL_SURFACE on (UNDERLYING_ID, TIMESTAMP, EXPIRATION), see upsert_many
+    data: list of SVI slices
+        form: [(UNDERLYING_ID, TIMESTAMP, EXPIRATION, T, A, B, RHO, M, SIGMA, RMSE, N), ... ]
+    Returns: {'inserted': n, 'updated': n, 'skipped': n}
+    """
+    columns = ['UNDERLYING_ID', 'TIMESTAMP', 'EXPIRATION', 'T', 'A', 'B', 'RHO', 'M', 'SIGMA', 'RMSE', 'N']
+    return upsert_many(con, 'VOL_SURFACE', ['UNDERLYING_ID', 'TIMESTAMP', 'EXPIRATION'], columns, data, commit)
+
+
+def upsert_meta(con, data: list):
+    """Inserts or updates the exchange metadata of each underlying in META
+    data: list of metadata
+        form: [(UNDERLYING_ID, TICK_SIZE, TAKER_COMMISION, MAKER_COMMISION, MIN_TRADE), ... ]
+    Returns: {'inserted': n, 'updated': n, 'skipped': n}
+    """
+    columns = ['UNDERLYING_ID', 'TICK_SIZE', 'TAKER_COMMISION', 'MAKER_COMMISION', 'MIN_TRADE']
+    return upsert_many(con, 'META', ['UNDERLYING_ID'], columns, data)
 
@@ -18,6 +18,10 @@ def get_underlying_data(con):
     return select(con, 'SELECT * FROM UNDERLYING_DATA')
 
 
+def get_meta(con):
+    return select(con, 'SELECT * FROM META')
+
+
 def get_contracts_meta(con):
     return select(con, 'SELECT * FROM CONTRACTS_META')
 
@@ -27,4 +31,45 @@ def get_contracts_ids(con):
 
 
 def get_contracts_data(con):
-    return select(con, 'SELECT * FROM CONTRACTS_DATA')
\ No newline at end of file
+    return select(con, 'SELECT * FROM CONTRACTS_DATA')
+
+
+def get_vol_surface(con, underlying_id: int, start: float = None, end: float = None) -> list:
+    """SVI slices of underlying_id, optionally only start <= TIMESTAMP <= end
+    Returns: [(TIMESTAMP, EXPIRATION, T, A, B, RHO, M, SIGMA, RMSE, N), ...]
+    """
+    query = """SELECT TIMESTAMP, EXPIRATION, T, A, B, RHO, M, SIGMA, RMSE, N FROM VOL_SURFACE
+        WHERE UNDERLYING_ID = ? AND TIMESTAMP >= ? AND TIMESTAMP <= ?
+        ORDER BY TIMESTAMP, EXPIRATION"""
+    bounds = (underlying_id, -float('inf') if start is None else start, float('inf') if end is None else end)
+    with closing(con.cursor()) as cursor:
+        return cursor.execute(query, bounds).fetchall()
+
+
+def get_underlying_close(con, name: str, start: float, end: float) -> list:
+    """Close of underlying name with start <= TIMESTAMP < end
+    Returns: [(TIMESTAMP, CLOSE), ...], sorted by TIMESTAMP
+    """
+    query = """SELECT D.TIMESTAMP, D.CLOSE FROM UNDERLYING_DATA D
+        JOIN UNDERLYING_META M ON M.ID = D.UNDERLYING_ID
+        WHERE M.NAME = ? AND D.TIMESTAMP >= ? AND D.TIMESTAMP < ?
+        ORDER BY D.TIMESTAMP"""
+    with closing(con.cursor()) as cursor:
+        return cursor.execute(query, (name, start, end)).fetchall()
+
+
+def get_underlying_data(con, name: str, start: float, end: float) -> list:
+    """Close and volatility of underlying name with start <= TIMESTAMP < end
+    Returns: [(TIMESTAMP, CLOSE, VOLATILITY), ...], sorted by TIMESTAMP
+    """
+    query = """SELECT D.TIMESTAMP, D.CLOSE, D.VOLATILITY FROM UNDERLYING_DATA D
+        JOIN UNDERLYING_META M ON M.ID = D.UNDERLYING_ID
+        WHERE M.NAME = ? AND D.TIMESTAMP >= ? AND D.TIMESTAMP < ?
+        ORDER BY D.TIMESTAMP"""
+    with closing(con.cursor()) as cursor:
+        return cursor.execute(query, (name, start, end)).fetchall()
+
+
+def get_watermarks(con) -> dict:
+    rows = select(con, 'SELECT PROVIDER, METRIC, COIN, CONTRACT, TIMESTAMP FROM WATERMARKS')
+    return {tuple(row[:4]): row[4] for row in rows}
\ No newline at end of file
@@ -0,0 +1,201 @@
+"""Implied volatility surface.
+Every (timestamp, expiration) slice of market implied volatilities is fitted
+with a raw SVI smile in total variance, w(k) = iv^2 T:
+    w(k) = a + b (rho (k - m) + sqrt((k - m)^2 + sigma^2))
+with k = log(strike / underlying price). The fitted parameters are stored in
+the VOL_SURFACE table of the warehouse, and VolSurface answers sigma for any
+(strike, expiry) at a fitted timestamp, interpolating total variance linearly
+in T between expiries.
+"""
+import numpy as np
+import pandas as pd
+
+import sql_select
+
+
+# grid searched for (m, sigma); for each pair a, b, rho are a linear fit
+M_GRID = np.linspace(-0.5, 0.5, 11)
+SIGMA_GRID = np.geomspace(0.01, 1.0, 8)
+# slices with less quotes are not fitted (their contracts fall back to the
+# historical volatility)
+MIN_POINTS = 5
+# local search rounds around the best grid point
+REFINE_ROUNDS = 4
+
+COLUMNS = ['t', 'expiration', 'T', 'a', 'b', 'rho', 'm', 'sigma', 'rmse', 'n']
+
+
+def svi(a, b, rho, m, sigma, k):
+    """Raw SVI total variance at log-moneyness k (broadcasted)"""
+    return a + b * (rho * (k - m) + np.sqrt((k - m) ** 2 + sigma ** 2))
+
+
+def _solve(total, n, k, w, group, m, sigma) -> np.ndarray:
+    """Least squares a, b, rho of every slice for its (m, sigma), with b >= 0,
+    |rho| <= 1 and a non negative minimum variance enforced
+    total: grouped sum over the quotes of each slice
+    m, sigma: one value per slice
+    Returns: array (a, b, b rho, m, sigma, squared error) x slices
+    """
+    y = k - m[group]
+    z = np.sqrt(y * y + sigma[group] ** 2)
+    s_w, s_ww = total(w), total(w * w)
+    s_y, s_yy, s_yw = total(y), total(y * y), total(y * w)
+    s_z, s_zz, s_yz, s_zw = total(z), total(z * z), total(y * z), total(z * w)
+
+    gram = np.stack([
+        np.stack([n, s_y, s_z], -1),
+        np.stack([s_y, s_yy, s_yz], -1),
+        np.stack([s_z, s_yz, s_zz], -1)], -2)
+    rhs = np.stack([s_w, s_yw, s_zw], -1)[..., None]
+    # tiny ridge: slices whose quotes share a strike are singular
+    a, c, d = np.linalg.solve(gram + 1e-12 * np.eye(3), rhs)[..., 0].T
+
+    d = np.maximum(d, 0)
+    c = np.clip(c, -d, d)
+    a = (s_w - c * s_y - d * s_z) / n
+    rho = np.divide(c, d, out=np.zeros_like(c), where=d > 0)
+    a = np.maximum(a, -d * sigma * np.sqrt(1 - rho ** 2))
+
+    err = (s_ww + a * a * n + c * c * s_yy + d * d * s_zz
+           - 2 * (a * s_w + c * s_yw + d * s_zw)
+           + 2 * (a * c * s_y + a * d * s_z + c * d * s_yz))
+    return np.stack([a, d, c, m, sigma, err])
+
+
+def fit(t, expiration, T, k, iv, min_points: int = MIN_POINTS) -> pd.DataFrame:
+    """Fits one SVI smile per (t, expiration) slice, all slices at once.
+    For every (m, sigma) tried the other parameters are the least squares
+    solution of a 3x3 system per slice, built from grouped sums (see _solve);
+    each slice keeps the pair with the smallest error, searched on a grid and
+    then refined locally.
+    t, expiration: timestamp and expiration of each quote (s)
+    T: time to expiry of each quote (years)
+    k: log-moneyness, log(strike / underlying price)
+    iv: market implied volatility (NaN quotes are ignored)
+    Returns: DataFrame with COLUMNS, one row per fitted slice
+    """
+    t, expiration, T, k, iv = (np.asarray(x, dtype=np.float64)
+                               for x in (t, expiration, T, k, iv))
+    valid = np.isfinite(iv) & (iv > 0) & np.isfinite(k) & (T > 0)
+    t, expiration, T, k = t[valid], expiration[valid], T[valid], k[valid]
+    w = iv[valid] ** 2 * T
+
+    slices = pd.DataFrame({'t': t, 'expiration': expiration})
+    group = slices.groupby(['t', 'expiration'], sort=True).ngroup().to_numpy()
+    n = np.bincount(group) if len(group) else np.zeros(0, dtype=np.int64)
+    fitted = n >= min_points
+    keep = fitted[group]
+    group = np.cumsum(fitted)[group[keep]] - 1
+    k, w = k[keep], w[keep]
+    n_slices = int(fitted.sum())
+    n = n[fitted].astype(np.float64)
+
+    def total(x):
+        return np.bincount(group, weights=x, minlength=n_slices)
+
+    best = np.full((6, n_slices), np.nan)
+    best_err = np.full(n_slices, np.inf)
+
+    def try_params(m, sigma):
+        # keeps, per slice, (m, sigma) and their linear fit if they beat the
+        # best
+        params = _solve(total, n, k, w, group, m, sigma)
+        better = params[-1] < best_err
+        best_err[better] = params[-1][better]
+        best[:, better] = params[:, better]
+
+    for m in M_GRID:
+        for sigma in SIGMA_GRID:
+            try_params(np.full(n_slices, m), np.full(n_slices, sigma))
+
+    # then refine around each slice's best pair, halving the step every round
+    m_step = M_GRID[1] - M_GRID[0]
+    sigma_step = np.log(SIGMA_GRID[1] / SIGMA_GRID[0])
+    for _ in range(REFINE_ROUNDS):
+        m_step, sigma_step = m_step / 2, sigma_step / 2
+        m_best, sigma_best = best[3].copy(), best[4].copy()
+        for dm in (-m_step, 0, m_step):
+            for ds in (-sigma_step, 0, sigma_step):
+                if dm or ds:
+                    try_params(m_best + dm, sigma_best * np.exp(ds))
+
+    a, b, c, m, sigma, err = best
+    rho = np.divide(c, b, out=np.zeros_like(c), where=b > 0)
+
+    # every quote of a slice shares its t, expiration and T
+    def slice_of(x):
+        return np.bincount(group, weights=x[keep], minlength=n_slices) / n
+
+    return pd.DataFrame({
+        't': slice_of(t),
+        'expiration': slice_of(expiration),
+        'T': slice_of(T),
+        'a': a, 'b': b, 'rho': rho, 'm': m, 'sigma': sigma,
+        'rmse': np.sqrt(np.maximum(err, 0) / n),
+        'n': n.astype(np.int64)}, columns=COLUMNS).dropna(subset=['a'])
+
+
+class VolSurface:
+    """Fitted SVI slices (as returned by fit) indexed for lookups: finding the
+    slices around a (t, expiration) is a binary search over the few expiries
+    of t, so sigma costs O(1) per row however long the history is.
+    """
+    def __init__(self, params: pd.DataFrame):
+        params = params.sort_values(['t', 'expiration'])
+        self.params = params
+        self.times, t_idx = np.unique(params['t'].to_numpy(dtype=np.float64),
+                                      return_inverse=True)
+        self.keys = self._key(t_idx, params['expiration'].to_numpy())
+        slots = np.arange(len(self.times))
+        self.starts = np.searchsorted(t_idx, slots, side='left')
+        self.ends = np.searchsorted(t_idx, slots, side='right')
+        self.T = params['T'].to_numpy(dtype=np.float64)
+        self.svi = [params[c].to_numpy(dtype=np.float64)
+                    for c in ['a', 'b', 'rho', 'm', 'sigma']]
+
+    @classmethod
+    def from_db(cls, con, underlying_id: int, start: float = None,
+                end: float = None) -> 'VolSurface':
+        """Loads the slices of underlying_id stored in the warehouse"""
+        rows = sql_select.get_vol_surface(con, underlying_id, start, end)
+        return cls(pd.DataFrame(rows, columns=COLUMNS))
+
+    @staticmethod
+    def _key(t_idx, expiration):
+        return ((np.asarray(t_idx, dtype=np.int64) << 32)
+                + np.asarray(expiration, dtype=np.int64))
+
+    def _w(self, j, k):
+        return svi(*(p[j] for p in self.svi), k)
+
+    def sigma(self, t, expiration, T, k) -> np.ndarray:
+        """Volatility for each (t, expiration, T, k) row, NaN where t has no
+        fitted slice. Between expiries total variance is interpolated
+        linearly in T; before the first and after the last one the implied
+        volatility of the nearest slice is kept.
+        k: log-moneyness, log(strike / underlying price)
+        """
+        t, expiration, T, k = np.broadcast_arrays(
+            *(np.asarray(x, dtype=np.float64) for x in (t, expiration, T, k)))
+        out = np.full(t.shape, np.nan)
+        if not len(self.times):
+            return out
+
+        t_idx = np.minimum(np.searchsorted(self.times, t), len(self.times) - 1)
+        found = self.times[t_idx] == t
+        t_idx, expiration = t_idx[found], expiration[found]
+        T, k = T[found], k[found]
+        start, end = self.starts[t_idx], self.ends[t_idx]
+
+        j = np.searchsorted(self.keys, self._key(t_idx, expiration))
+        hi = np.clip(j, start, end - 1)
+        lo = np.clip(j - 1, start, end - 1)
+        T_lo, T_hi = self.T[lo], self.T[hi]
+        w_lo = self._w(lo, k) * np.where(lo == hi, T / T_lo, 1)
+        w_hi = self._w(hi, k) * np.where(lo == hi, T / T_hi, 1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weight = np.where(T_hi > T_lo, (T - T_lo) / (T_hi - T_lo), 1.0)
+            w = w_lo + np.clip(weight, 0, 1) * (w_hi - w_lo)
+            out[found] = np.sqrt(np.maximum(w, 0) / T)
+        return out
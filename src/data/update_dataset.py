@@ -1,14 +1,25 @@
-import sqlite3
 import os
 import argparse
 import logging
+import queue
+import shutil
+import signal
+import threading
 import time
 from datetime import datetime
 from dotenv import find_dotenv, dotenv_values
 
-from preprocess import main as preprocess_main
-from api import main as api_main
+from preprocess import main as preprocess_main, INTERIM_DIR
+from api import main as api_main, START_DATE
 from insert_dataset import insert_connection
+import sql_create
+import sql_insert
+import sql_select
+
+CYCLES_DIR = './data/cycles'
+# batches waiting between two stages; a full queue blocks the stage before it
+QUEUE_SIZE = 1
+
 
 def get_last_point(con):
     cursor = con.cursor()
@@ -16,33 +27,200 @@ def get_last_point(con):
     return cursor.fetchone()[0]
 
 
+def get_start(con, args) -> datetime:
+    """Date to fetch from: the last point in the DW or, while it is empty,
+    START_DATE from .env (ISO format) or api.START_DATE
+    """
+    last = get_last_point(con)
+    if last is not None:
+        return datetime.fromtimestamp(last)
+    start = getattr(args, 'START_DATE', None)
+    return datetime.fromisoformat(start) if start else START_DATE
+
+
+def stop_on_signals(stop: threading.Event):
+    """SIGINT/SIGTERM set stop, so the cycle in progress can finish; a
+    second signal exits right away
+    """
+    logger = logging.getLogger(__name__)
+
+    def on_signal(signum, frame):
+        logger.info(f'received signal {signum}, finishing the cycle in progress')
+        stop.set()
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    signal.signal(signal.SIGINT, on_signal)
+    signal.signal(signal.SIGTERM, on_signal)
+
+
 def main(args):
+    """Fetches, preprocesses and loads one cycle, or cycles until stopped
+    with --continuous-update. SIGINT/SIGTERM stop it after the cycle in
+    progress is loaded and its watermarks saved.
+    """
     logger = logging.getLogger(__name__)
-    con = sqlite3.connect(os.path.join(args.output_filepath, args.DATA_WAREHOUSE_FILE))
+    db_file = os.path.join(args.output_filepath, args.DATA_WAREHOUSE_FILE)
+    con = sql_create.connect(db_file)
     logger.info("Connected to database")
+    sql_create.migrate(con)
+    stop = threading.Event()
+    stop_on_signals(stop)
     first_time = True
-    while args.continuous_update or first_time:
+    while (args.continuous_update or first_time) and not stop.is_set():
         first_time = False
+        start = get_start(con, args)
+        end = datetime.now()
+        # request, transform and load data to DW
+        logger.info(f'requesting data from api')
+        watermarks = api_main(start, end, sql_select.get_watermarks(con))
+
+        logger.info('preprocessing data (adding greeks)')
+        data = preprocess_main(args.workers, interim_dir=INTERIM_DIR if args.keep_interim else None,
+                               db_file=db_file)
+
+        logger.info('inserting data into the destination database')
+        insert_connection(con, data)
+
+        # only advance the watermarks once their data is in the DW
+        sql_insert.insert_watermarks(con, watermarks)
+
+        stop.wait(float(args.WAIT_INTERVAL) if args.continuous_update else 0)
+    con.close()
+    logger.info('update stopped' if stop.is_set() else 'update finished')
+
+
+class Batch:
+    """One update cycle moving through the daemon stages.
+    Every cycle gets its own raw folder, so a cycle being fetched never
+    overwrites the files of the one being preprocessed. The preprocessed
+    DataFrames are handed to the load stage in memory (data).
+    """
+    def __init__(self, n: int, keep_interim: bool = False):
+        self.n = n
+        self.dir = os.path.join(CYCLES_DIR, str(n))
+        self.raw_dir = os.path.join(self.dir, 'raw')
+        self.interim_dir = os.path.join(self.dir, 'interim') if keep_interim else None
+        self.watermarks = {}
+        self.data = None
+        os.makedirs(self.dir, exist_ok=True)
+
+    def cleanup(self):
+        """Removes the cycle folder, keeping the interim files if requested"""
+        path = self.dir if self.interim_dir is None else self.raw_dir
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def merge_watermarks(old: dict, new: dict) -> dict:
+    merged = dict(old)
+    for key, timestamp in new.items():
+        merged[key] = max(timestamp, merged.get(key, timestamp))
+    return merged
+
+
+def daemon(args):
+    """Runs fetch -> preprocess -> load as a pipeline of three threads joined
+    by bounded queues: cycle n+1 is fetched while cycle n is preprocessed and
+    cycle n-1 loaded. A full queue blocks the stage feeding it (backpressure).
+    SIGINT/SIGTERM stop fetching new cycles; batches already fetched are
+    preprocessed and loaded before exiting. A second signal exits right away.
+    """
+    logger = logging.getLogger(__name__)
+    db_file = os.path.join(args.output_filepath, args.DATA_WAREHOUSE_FILE)
+    wait_interval = float(args.WAIT_INTERVAL)
+
+    con = sql_create.connect(db_file)
+    sql_create.migrate(con)
+    con.close()
+
+    stop = threading.Event()
+    to_preprocess = queue.Queue(maxsize=QUEUE_SIZE)
+    to_load = queue.Queue(maxsize=QUEUE_SIZE)
+    # watermarks fetched but not loaded yet: the next fetch starts after them
+    pending = {}
+    pending_lock = threading.Lock()
+    # cycles before this one were fetched after a batch that failed: their
+    # watermarks are not committed, so the failed data is fetched again
+    state = {'next': 0, 'valid_from': 0}
+
+    stop_on_signals(stop)
+
+    def timed(batch: Batch, stage: str, func):
+        started = time.perf_counter()
         try:
-            start = datetime.fromtimestamp(get_last_point(con))
-            end = datetime.now()
-            # request, transform and load data to DW
-            logger.info(f'requesting data from api')
-            api_main(start, end)
+            func()
+        except Exception:
+            logger.exception(f'cycle {batch.n} -- {stage} -- failed, skipping batch')
+            return False
+        logger.info(f'cycle {batch.n} -- {stage} -- {time.perf_counter() - started:.1f}s')
+        return True
+
+    def fetch_stage():
+        con = sql_create.connect(db_file)
+        while not stop.is_set():
+            with pending_lock:
+                batch = Batch(state['next'], args.keep_interim)
+                state['next'] += 1
+                watermarks = merge_watermarks(sql_select.get_watermarks(con), pending)
+
+            def run():
+                batch.watermarks = api_main(get_start(con, args), datetime.now(), watermarks, batch.raw_dir)
+
+            if timed(batch, 'fetch', run):
+                with pending_lock:
+                    if batch.n >= state['valid_from']:
+                        pending.update(merge_watermarks(pending, batch.watermarks))
+                to_preprocess.put(batch)
+            else:
+                batch.cleanup()
+            stop.wait(wait_interval)
+        con.close()
+        to_preprocess.put(None)
+
+    def preprocess_stage():
+        while (batch := to_preprocess.get()) is not None:
+            def run():
+                batch.data = preprocess_main(args.workers, batch.raw_dir, batch.interim_dir, db_file=db_file)
+
+            if timed(batch, 'preprocess', run):
+                to_load.put(batch)
+            else:
+                fail(batch)
+        to_load.put(None)
+
+    def load_stage():
+        con = sql_create.connect(db_file)
+        while (batch := to_load.get()) is not None:
+            def run():
+                insert_connection(con, batch.data)
+                # only advance the watermarks once their data is in the DW
+                with pending_lock:
+                    valid = batch.n >= state['valid_from']
+                if valid:
+                    sql_insert.insert_watermarks(con, batch.watermarks)
 
-            logger.info('preprocessing data (adding greeks)')
-            preprocess_main()
-            
-            logger.info('inserting data into the destination database')
-            insert_connection(con)
+            if not timed(batch, 'load', run):
+                fail(batch)
+            batch.data = None
+            batch.cleanup()
+        con.close()
 
-            time.sleep(args.WAIT_INTERVAL)
+    def fail(batch: Batch):
+        # refetch the data of a failed batch on the next cycle
+        with pending_lock:
+            pending.clear()
+            state['valid_from'] = state['next']
+        batch.cleanup()
 
-        except KeyboardInterrupt:
-            logger.info('Exiting without saving last iteration')
-            time.sleep(5)
-            # TODO: save last iteration or better deal with the exception
-            break
+    stages = [threading.Thread(target=stage, name=stage.__name__)
+              for stage in (fetch_stage, preprocess_stage, load_stage)]
+    for thread in stages:
+        thread.start()
+    # join with a timeout so the main thread keeps handling signals
+    for thread in stages:
+        while thread.is_alive():
+            thread.join(timeout=1)
+    logger.info('daemon stopped')
 
 
 if __name__ == "__main__":
@@ -53,7 +231,10 @@ if __name__ == "__main__":
     parser.add_argument('-i', '--input_filepath', help='input filepath', required=True)
     parser.add_argument('-o', '--output_filepath', help='output filepath', required=True)
     parser.add_argument('-c', '--continuous-update', help='Whether the script will be left running.', action='store_true')
+    parser.add_argument('-d', '--daemon', help='Pipeline fetch, preprocess and load of consecutive cycles until stopped (SIGINT/SIGTERM).', action='store_true')
+    parser.add_argument('-k', '--keep-interim', help='Also write the preprocessed data as csv, to ./data/interim (or the cycle folder with --daemon), for debugging.', action='store_true')
+    parser.add_argument('-w', '--workers', help='Processes used to compute greeks (1: serial).', type=int, default=1)
     args = parser.parse_args()
     # add arguments from .env to the namespace 
     args = argparse.Namespace(**vars(args), **dotenv_values(find_dotenv()))
-    main(args)
+    daemon(args) if args.daemon else main(args)
@@ -0,0 +1,218 @@
+"""Accuracy vs speed of the greeks and iv engines.
+Reads a saved contracts/metadata snapshot (the Deribit tickers api.main saves,
+{instrument_name: ticker}), computes greeks and iv of every contract through
+each registered engine, and reports the error distribution of every metric
+against Deribit's own values next to the engine's throughput. Nothing is
+requested from the apis, so it runs offline from any saved snapshot; by
+default from fixtures/tickers_BTC.json, 48 BTC calls and puts of one
+timestamp in the ticker format, anonymised (a Black-Scholes smile, rounded
+as Deribit rounds its values).
+
+    python src/data/validate.py -f data/raw/contracts/metadata/BTC.json
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import benchmark
+import finance
+import instruments
+import preprocess
+
+
+METRICS = ['delta', 'gamma', 'vega', 'theta', 'rho', 'iv']
+OUTPUT_DIR = './reports/validation'
+FIXTURE = os.path.join(os.path.dirname(__file__), 'fixtures',
+                       'tickers_BTC.json')
+# finance.theta is per year (with r = 0, as here), Deribit's theta per day
+THETA_DAYS = 365
+# processes of the parallel engine
+WORKERS = os.cpu_count()
+
+ENGINES = {}
+
+
+def register(name: str):
+    """Registers an engine: a function taking the contracts DataFrame (s, k,
+    T, sigma, p, is_call columns) and a process pool, and returning one
+    column per METRICS
+    """
+    def decorator(func):
+        ENGINES[name] = func
+        return func
+    return decorator
+
+
+def load_tickers(path: str) -> pd.DataFrame:
+    """Contracts of a contracts/metadata snapshot with the inputs of the
+    engines and Deribit's values (<metric>_o columns). Contracts without a
+    mark price or greeks are left out.
+    """
+    with open(path) as json_file:
+        data = json.load(json_file)
+    tickers = [d for d in data.values()
+               if d and d.get('greeks') and d.get('mark_price')]
+
+    df = pd.DataFrame({
+        'contract': [d['instrument_name'] for d in tickers],
+        't': [d['timestamp'] / 1000 for d in tickers],
+        's': [d['underlying_price'] for d in tickers],
+        # deribit quotes iv in %, mark price in coin
+        'sigma': [d['mark_iv'] / 100 for d in tickers],
+        'p': [d['mark_price'] * d['underlying_price'] for d in tickers],
+        **{f'{m}_o': [d['greeks'][m] for d in tickers] for m in METRICS[:-1]},
+        'iv_o': [d['mark_iv'] / 100 for d in tickers],
+    })
+    df['expiration'], df['k'], df['is_call'] = instruments.parse_instruments(
+        df['contract'].to_numpy())
+    df['T'] = preprocess.time_to_expiry(df)
+    return df.set_index('contract')
+
+
+@register('scalar')
+def scalar_engine(df: pd.DataFrame, executor=None) -> pd.DataFrame:
+    rows = [finance.metrics(*args) for args in zip(
+        df['s'], df['k'], [0] * len(df), df['T'], df['sigma'], df['p'],
+        df['is_call'])]
+    return pd.DataFrame(rows, index=df.index)[METRICS]
+
+
+@register('vectorized')
+def vectorized_engine(df: pd.DataFrame, executor=None) -> pd.DataFrame:
+    s, k, T = (df[c].to_numpy(dtype=np.float64) for c in ['s', 'k', 'T'])
+    is_call = df['is_call'].to_numpy(dtype=bool)
+    sigma, p = (df[c].to_numpy(dtype=np.float64) for c in ['sigma', 'p'])
+    metrics = finance.bsm_greeks(s, k, 0, T, sigma, is_call)
+    metrics['iv'] = finance.bsm_iv(s, k, 0, T, p, is_call)['iv'].to_numpy()
+    metrics.index = df.index
+    return metrics[METRICS]
+
+
+@register('parallel')
+def parallel_engine(df: pd.DataFrame,
+                    executor: ProcessPoolExecutor) -> pd.DataFrame:
+    rows = np.array_split(np.arange(len(df)),
+                          WORKERS * preprocess.CHUNKS_PER_WORKER)
+    return pd.concat(executor.map(
+        vectorized_engine, [df.iloc[r] for r in rows if len(r)]))
+
+
+def start_pool(df: pd.DataFrame) -> ProcessPoolExecutor:
+    """Process pool for the parallel engine, with every worker started and
+    its modules imported, so the timed runs do not include the startup
+    """
+    context = multiprocessing.get_context(preprocess.MP_CONTEXT)
+    executor = ProcessPoolExecutor(max_workers=WORKERS, mp_context=context)
+    list(executor.map(vectorized_engine, [df.iloc[:1]] * WORKERS * 2))
+    return executor
+
+
+def errors(computed: pd.Series, expected: pd.Series) -> dict:
+    """Error distribution of computed against expected (rows where either is
+    missing are not counted)
+    """
+    valid = (computed.notna() & expected.notna()
+             & np.isfinite(computed) & np.isfinite(expected))
+    diff = (computed - expected)[valid].abs()
+    if not valid.any():
+        return {'n': 0}
+    return {
+        'n': int(valid.sum()),
+        'mean_abs': float(diff.mean()),
+        'median_abs': float(diff.median()),
+        'p95_abs': float(diff.quantile(0.95)),
+        'max_abs': float(diff.max()),
+        'corr': (float(np.corrcoef(computed[valid], expected[valid])[0, 1])
+                 if valid.sum() > 1 else None),
+    }
+
+
+def validate(df: pd.DataFrame, engines: list, repeat: int = 1) -> dict:
+    """Runs every engine over df; theta is compared per day
+    Returns: {engine: {'throughput': benchmark.measure result,
+        'errors': {metric: errors, by option type}}}
+    """
+    executor = start_pool(df) if 'parallel' in engines else None
+    try:
+        return {name: validate_engine(df, name, repeat, executor)
+                for name in engines}
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+def validate_engine(df: pd.DataFrame, name: str, repeat: int,
+                    executor: ProcessPoolExecutor = None) -> dict:
+    """Throughput and errors of engine name over df, see validate"""
+    out = {}
+
+    def run():
+        out['metrics'] = ENGINES[name](df, executor)
+        return len(df)
+    throughput = benchmark.measure(run, repeat, memory=False)
+
+    metrics = out['metrics'].reindex(df.index)
+    metrics['theta'] = metrics['theta'] / THETA_DAYS
+    by_type = {'call': df['is_call'], 'put': ~df['is_call']}
+    return {
+        'throughput': throughput,
+        'errors': {
+            m: {kind: errors(metrics[m][rows], df[f'{m}_o'][rows])
+                for kind, rows in by_type.items()}
+            for m in METRICS},
+    }
+
+
+def main(args):
+    logger = logging.getLogger(__name__)
+    df = load_tickers(args.fixture)
+    logger.info(f'{len(df)} contracts from {args.fixture}')
+
+    report = validate(df, args.engines or list(ENGINES), args.repeat)
+    for name, result in report.items():
+        rows_per_s = result['throughput']['rows_per_s']
+        logger.info(f'{name} -- {rows_per_s:,.0f} rows/s')
+        for metric, kinds in result['errors'].items():
+            for kind, e in kinds.items():
+                if e['n']:
+                    logger.info(
+                        f'{name} -- {metric} {kind} -- n {e["n"]} '
+                        f'-- median {e["median_abs"]:.4g} '
+                        f'-- p95 {e["p95_abs"]:.4g} '
+                        f'-- max {e["max_abs"]:.4g} -- corr {e["corr"]}')
+
+    output = (args.output
+              or f'{OUTPUT_DIR}/validate-{datetime.now():%Y%m%d-%H%M%S}.json')
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({'fixture': args.fixture, 'commit': benchmark.git_commit(),
+                   'engines': report}, f, indent=2)
+    logger.info(f'results saved to {output}')
+    return report
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    parser = argparse.ArgumentParser(
+        description='Compare the greeks and iv engines against Deribit '
+                    'ticker values.')
+    parser.add_argument('-f', '--fixture', default=FIXTURE,
+                        help='contracts/metadata snapshot (json, default: '
+                             'the anonymised fixture).')
+    parser.add_argument('-e', '--engines', nargs='+',
+                        help='Engines to run (default: all).')
+    parser.add_argument('-r', '--repeat', type=int, default=1,
+                        help='Timed runs per engine (best is kept).')
+    parser.add_argument('-o', '--output',
+                        help=f'Json report file (default: '
+                             f'{OUTPUT_DIR}/validate-<date>.json).')
+    main(parser.parse_args())
@@ -3,137 +3,247 @@ import torch.nn
 import torch.nn.functional as F
 from torch.utils.data import Dataset
 from torch import Tensor
-import sqlite3
+from collections import OrderedDict
 import gym
+import numpy as np
 
+import rewards
+import tensor_store
 
-def find_extremes(file):
-    """This function returns the first and last date in the database."""
-    time_query = """SELECT TIMESTAMP
-                    FROM CONTRACTS_DATA;"""
-    with sqlite3.connect(file) as conn:
-        cursor = conn.cursor()
-        response = cursor.execute(time_query)
-        return min(response), max(response)
+
+# windows kept in memory by each DeribitDataset (per process)
+CACHE_SIZE = 128
 
 
 class DeribitDataset(Dataset):
-    def __init__(self, file, interval_length, future_distance, start=None, end=None):
-        self.connection = sqlite3.connect(file)
-        self.cursor = self.connection.cursor()
+    """Windows of interval_length seconds of the (time, contract slot, feature)
+    tensor of an underlying (see tensor_store). The tensor is built once from
+    the warehouse and read memory-mapped, so a sample is a slice of it, not a
+    query; the last windows read are kept in an LRU cache. The memory map and
+    the cache are opened lazily in every process, so the dataset can be
+    shared by DataLoader workers.
+    A sample is (state, live, timestamps, to_expiry): state (time, slots,
+    features), live, a (time, slots) mask of the contracts alive, with a
+    strike within band times the price and expiring within future_distance
+    seconds, the timestamps of the window (time,) and the exact seconds to
+    expiry (time, slots) of the contracts (int32). The live contracts are
+    read from the index built with the tensor, so any band can be used
+    without a rebuild; windows with no live contract at their start are not
+    sampled.
+    Samples are copies: a consumer may change them in place without
+    touching the cache or the files.
+    """
+    def __init__(self, file, interval_length, future_distance, start=None,
+                 end=None, underlying='BTC',
+                 tensor_dir=tensor_store.TENSOR_DIR, cache_size=CACHE_SIZE,
+                 band=(0.5, 1.5)):
+        self.path = tensor_store.build(file, underlying, tensor_dir)
         self.interval_length = interval_length
-        self.future_distance
-        # get the first and last timestamp
-
-        # separate the intervals evenly and generate a dictionary with pairs:
-        # self.samples = {idx: (t0, t1)} or a list
-        if start is None or end is None:
-            self.start, self.end = find_extremes(self.cursor)
-        else:
-            self.start = start
-            self.end = end
+        self.future_distance = future_distance
+        self.cache_size = cache_size
+        self.band = band
+        self._tensors = None
+        self._cache = OrderedDict()
+        self.timestamps = self.tensors()['timestamps']
+        self.start = self.timestamps[0] if start is None else start
+        self.end = self.timestamps[-1] + 1 if end is None else end
         self.samples = self.generate_samples_dict()
-    
+
+    def __getstate__(self):
+        # workers open their own memory map and cache
+        state = self.__dict__.copy()
+        state['_tensors'] = None
+        state['_cache'] = OrderedDict()
+        return state
+
+    def tensors(self) -> dict:
+        if self._tensors is None:
+            self._tensors = tensor_store.load(self.path)
+        return self._tensors
+
     def __len__(self):
         return len(self.samples)
-    
+
     def __getitem__(self, idx):
+        if idx in self._cache:
+            self._cache.move_to_end(idx)
+        else:
+            self._cache[idx] = self.read(idx)
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return tuple(x.clone() for x in self._cache[idx])
+
+    def read(self, idx) -> tuple:
+        """Sample idx read from the memory-mapped tensors"""
         t0, t1 = self.samples[idx]
-        response_iterator = self.query(t0, t1)  # TODO: decide if we need to cache this
-        # convert the data in the iterator to a tensor
-        state_data = torch.Tensor(response_iterator.fetchall())
-        return state_data, all_data
-
-    def query(self, t0, t1):
-        """This function generates an iterator object with data to build the 
-        state tath the model will see between t0 and t1.
+        i0, i1 = np.searchsorted(self.timestamps, [t0, t1])
+        state = torch.from_numpy(np.array(self.tensors()['features'][i0:i1]))
+        timestamps = torch.from_numpy(np.array(self.timestamps[i0:i1]))
+        live = torch.from_numpy(self.live(i0, i1))
+        to_expiry = torch.from_numpy(
+            np.array(self.tensors()['to_expiry'][i0:i1]))
+        return state, live, timestamps, to_expiry
+
+    def live(self, i0: int, i1: int) -> np.ndarray:
+        """Mask (time, slots) of the contracts of timestamps i0 to i1: alive,
+        within the moneyness band and expiring within future_distance
         """
-        # TODO: check the query is ok and check whether the newlines are ok
-        query_text =  f"SELECT \
-                            PRICE, DELTA, VEGA, THETA, GAMMA, IV, \
-                            P_C, EXPIRATION, STRIKE, \
-                            OPEN, CLOSE, HIGH, LOW, VOLUME, VOLATILITY \
-                        FROM \
-                            VARIABLE_DATA NATURAL \
-                            LEFT JOIN CONTRACTS_METADATA \
-                            LEFT JOIN UNDERLYING ON TIMESTAMP \
-                        WHERE \
-                            TIMESTAMP BETWEEN {t0} AND {t1} \
-                            AND PRICE * 0.5 < STRIKE AND STRIKE < PRICE * 1.5 \
-                            AND TIMESTAMP < EXPIRATION \
-                            AND TIMESTAMP - EXPIRATION < {self.future_distance} \
-                        SORT BY TIMESTAMP, STRIKE, EXIPRATION DESC;"
-        return self.cursor.execute(query_text)
+        tensors = self.tensors()
+        mask = np.zeros((i1 - i0, tensors['contracts'].shape[1]), dtype=bool)
+        mask[tensor_store.live(tensors, i0, i1, self.band,
+                               self.future_distance)] = True
+        return mask
 
     def generate_samples_dict(self) -> dict:
+        """Consecutive full windows {idx: (t0, t1)} between start and end
+        with live contracts at t0
+        """
         i = 0
         current_start = self.start
         samples = dict()
-        while current_start < self.end:
-            samples[i] = (current_start, current_start + self.interval_length)
+        while current_start + self.interval_length <= self.end:
+            i0 = np.searchsorted(self.timestamps, current_start)
+            t, _ = tensor_store.live(self.tensors(), i0, i0 + 1, self.band,
+                                     self.future_distance)
+            if len(t):
+                samples[i] = (current_start,
+                              current_start + self.interval_length)
+                i += 1
             current_start = current_start + self.interval_length
-            i += 1
         return samples
 
 class DeribitEnv(gym.Env):
     """gym.Env class to manage the execution of actions. This inplementation
     works with porfolio agnostic models.
-    TODO: implement batches
+    Runs a batch of episodes in lockstep: the episode data is a batch of
+    DeribitDataset samples, state (batch, time, slots, features), and every
+    step takes one action per episode and slot, the number of contracts to
+    buy (> 0) or sell (< 0) at the mark price, CLOSE * PRICE. Positions, cash
+    and P&L are (batch, slots) and (batch,) tensors updated with tensor ops
+    only, so a step costs the same for 1 or B episodes.
+    Positions are settled at their intrinsic value once their contract
+    expires, and closed at their last mark if their slot is taken by another
+    contract before that. Trades pay the costs of the exchange metadata
+    (costs, see rewards.load_costs).
     """
-    def __init__(self, args):
+    def __init__(self, args, costs: dict = rewards.NO_COSTS):
         super().__init__()
-        self.action_space = gym.spaces.Discrete(6,)  # TODO: decide how the action space will be
-        self.porfolio = torch.zeros(args.batch_size, 1)
+        # TODO: decide how the action space will be
+        self.action_space = gym.spaces.Discrete(6,)
         self.batch_size = args.batch_size
         self.reward_delay = args.reward_delay
+        self.costs = costs
+        # args.compile: 'script' or 'compile' to run the P&L kernel compiled
+        self.kernel = rewards.compile_kernel(getattr(args, 'compile', None))
 
-    def reset(self, data):
+    def reset(self, batch):
         """This function resets the state of the environment to the initial
         point in the data passed.
+        batch: (state, live, timestamps, to_expiry) as collated from
+            DeribitDataset
         """
-        self.current_episode_data = data
+        self.batch = batch
+        (self.current_episode_data, self.live, self.timestamps,
+         self.to_expiry) = batch
         self.timestep = 0
-        self.porfolio = torch.zeros(self.batch_size, self.porfolio_size)
-        state = self.current_episode_data
-        return state
-    
+        batch_size, _, slots, _ = self.current_episode_data.shape
+
+        def zeros(*shape):
+            return torch.zeros(*shape, dtype=torch.float64,
+                               device=self.current_episode_data.device)
+
+        self.positions = zeros(batch_size, slots)
+        self.cash = zeros(batch_size)
+        self.value = zeros(batch_size)
+        # last mark, terms (strike, expiration, is_call) and exact expiry
+        # timestamp of the contract seen in every slot
+        self.mark = zeros(batch_size, slots)
+        self.held = zeros(batch_size, slots, 3)
+        self.expiry = zeros(batch_size, slots)
+        self.price = zeros(batch_size)
+        return self.current_episode_data[:, 0]
+
     def render(self):
         pass
-    
+
     def close(self):
         pass
 
     def step(self, action):
-        self.process_action(action)  # update the porfolio
-        reward = self.get_reward(self.timestep)
+        """action: (batch, slots) contracts bought (> 0) or sold (< 0)
+        Returns: next state (batch, slots, features), None after the last
+            step; reward, the change of the porfolio value (batch,); done;
+            info with the porfolio value (P&L from the reset)
+        """
+        self.process_action(action)
+        value = self.cash + (self.positions * self.mark).sum(-1)
+        reward = value - self.value
+        self.value = value
         self.timestep += 1
 
-        done = self.timestep == len(self.current_episode_data)
-        return None, reward, done, []  # next_state: None, reward, done: bool, info
-    
-    def get_reward(self) -> float:
-        # very dummy function working as example
-        return self.porfolio.sum().item()
-    
+        done = self.timestep == self.current_episode_data.shape[1]
+        next_state = (None if done
+                      else self.current_episode_data[:, self.timestep])
+        return next_state, reward, done, {'pnl': value}
+
     def get_reward_sequence(self, sequence_of_actions) -> Tensor:
-        """This function returns the reward for a sequence of actions.
+        """This function returns the reward for a sequence of actions: the
+        gain of the contracts traded over the next reward_delay timesteps,
+        booked as step books it, net of trading costs.
         Notes:
         current_episode_data -> (batch, time, contracts, features)
         sequence_of_actions: -> (batch, time, contracts)
+        Returns: (batch, time - reward_delay)
         """
-        time_crop_actions = sequence_of_actions[:, :-self.reward_delay]  # working with batch_first
-        time_crop_data = self.current_episode_data[:, self.reward_delay:]
-
-        porfolio = torch.mul(self.current_episode_data, sequence_of_actions.unsqueeze(-1))
-        oracle = torch.mul(time_crop_data, time_crop_actions.unsqueeze(-1))
+        return rewards.delayed_reward(self.batch, sequence_of_actions,
+                                      self.reward_delay, self.costs)
 
-        feature_dim = 0
-        return (oracle[:, :, :, feature_dim] - porfolio[:, :, :, feature_dim]).sum(dim=-1)  # shape (batch, time)
-    
-    def get_gains(self) -> float:
-        pass
+    def get_gains(self, sequence_of_actions) -> Tensor:
+        """P&L of a sequence of actions over the whole episode, net of trading
+        costs (batch,); see rewards.pnl for its other components
+        """
+        return rewards.pnl(self.batch, sequence_of_actions, self.costs,
+                           self.kernel)['net'].sum(-1)
 
     def process_action(self, action):
-        # dummy example but it would be great to make it as simple and tensory
-        # as possible
-        self.porfolio += action * self.current_episode_data[self.timestep]
+        """Settles expired positions, marks to market and trades action in the
+        live contracts of the current timestep
+        """
+        state = self.current_episode_data[:, self.timestep].double()
+        now = self.timestamps[:, self.timestep].double().unsqueeze(-1)
+        has_data = ~torch.isnan(state[..., tensor_store.feature('CLOSE')])
+        terms = state[..., [tensor_store.feature(c)
+                            for c in ('STRIKE', 'EXPIRATION', 'IS_CALL')]]
+
+        # the underlying price is shared by the slots; kept when no slot has
+        # data
+        price = torch.nan_to_num(state[..., tensor_store.feature('PRICE')],
+                                 nan=-float('inf')).amax(-1)
+        self.price = torch.where(torch.isfinite(price), price, self.price)
+
+        held = self.positions != 0
+        strike, _, is_call = self.held.unbind(-1)
+        # seconds to expiry are exact, float32 EXPIRATION is not
+        expired = held & (self.expiry - now <= 0)
+        price = self.price.unsqueeze(-1)
+        intrinsic = torch.where(is_call == 1, price - strike, strike - price)
+        settle = torch.where(expired, intrinsic.clamp(min=0), self.mark)
+        replaced = held & ~expired & has_data & (terms != self.held).any(-1)
+        closed = expired | replaced
+        zero = torch.zeros_like(self.positions)
+        self.cash += torch.where(closed, self.positions * settle, zero).sum(-1)
+        self.positions = torch.where(closed, zero, self.positions)
+
+        close = state[..., tensor_store.feature('CLOSE')] * price
+        self.mark = torch.where(has_data, close, self.mark)
+        self.held = torch.where(has_data.unsqueeze(-1), terms, self.held)
+        to_expiry = self.to_expiry[:, self.timestep].double()
+        self.expiry = torch.where(has_data, now + to_expiry, self.expiry)
+
+        # only live contracts are traded
+        trade = torch.where(self.live[:, self.timestep], action.double(), zero)
+        self.cash -= (trade * self.mark).sum(-1)
+        self.cash -= rewards.fees(trade, self.mark, self.price,
+                                  self.costs['taker_commission'],
+                                  self.costs['tick_size'] / 2)
+        self.positions += trade
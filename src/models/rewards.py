@@ -0,0 +1,208 @@
+"""Rewards and P&L of whole action sequences.
+Every function takes an episode batch, (state, live, timestamps, to_expiry)
+as DeribitDataset collates it and DeribitEnv holds it, and actions (batch,
+time, slots), contracts bought (> 0) or sold (< 0) at each timestep, and
+works on all timesteps at once. Only the features needed (CLOSE, PRICE, D
+and the contract terms) are read from the state. Positions are booked as
+DeribitEnv.step books them: only live contracts are traded, a position is
+settled at its intrinsic value once its contract expires and closed at its
+last mark when another contract takes its slot.
+
+Trading costs come from the exchange metadata in META: per contract, the
+commission (a fraction of the underlying, capped at FEE_CAP of the option
+price, as Deribit charges it) plus half a tick of spread.
+"""
+from contextlib import closing
+import sqlite3
+from typing import Tuple
+
+import torch
+from torch import Tensor
+
+import tensor_store
+
+
+# deribit caps option fees at 12.5% of the option price
+FEE_CAP = 0.125
+# costs used when the warehouse has no META row for an underlying
+NO_COSTS = {'tick_size': 0.0, 'taker_commission': 0.0,
+            'maker_commission': 0.0, 'min_trade': 0.0}
+# contract terms compared to tell the contracts of a slot apart
+TERMS = ['STRIKE', 'EXPIRATION', 'IS_CALL']
+
+
+def load_costs(db_file: str, underlying: str) -> dict:
+    """Exchange metadata of underlying from the META table
+    Returns: {'tick_size', 'taker_commission', 'maker_commission',
+        'min_trade'}, in coin units
+    """
+    query = """SELECT M.TICK_SIZE, M.TAKER_COMMISION, M.MAKER_COMMISION,
+        M.MIN_TRADE FROM META M
+        JOIN UNDERLYING_META U ON U.ID = M.UNDERLYING_ID WHERE U.NAME = ?"""
+    with closing(sqlite3.connect(db_file)) as con:
+        row = con.execute(query, (underlying,)).fetchone()
+    if row is None:
+        return dict(NO_COSTS)
+    return {k: float(v or 0) for k, v in zip(NO_COSTS, row)}
+
+
+def ffill(x: Tensor, valid: Tensor) -> Tensor:
+    """Forward fills x along dim 1 where valid is False (zeros before the
+    first valid value)
+    """
+    steps = torch.arange(x.shape[1], device=x.device).unsqueeze(0)
+    while steps.dim() < x.dim():
+        steps = steps.unsqueeze(-1)
+    last = torch.where(valid, steps, torch.zeros_like(steps))
+    filled = torch.gather(x, 1, last.cummax(dim=1)[0])
+    return torch.where(valid.cumsum(1) > 0, filled, torch.zeros_like(filled))
+
+
+def shift(x: Tensor) -> Tensor:
+    """x one timestep later along dim 1: x[:, t - 1] at t, zeros at 0"""
+    return torch.cat([torch.zeros_like(x[:, :1]), x[:, :-1]], 1)
+
+
+def marks(close: Tensor, price: Tensor) -> Tuple[Tensor, Tensor]:
+    """Mark price (batch, time, slots) of every contract, CLOSE * PRICE when
+    it has data, and the underlying price (batch, time), both carried
+    forward over gaps
+    """
+    price = ffill(price, ~torch.isnan(price))
+    mark = torch.nan_to_num(close) * price.unsqueeze(-1)
+    return ffill(mark, ~torch.isnan(close)), price
+
+
+def unit_gains(close: Tensor, price: Tensor, terms: Tensor, now: Tensor,
+               expiry: Tensor) -> Tuple[Tensor, Tensor, Tensor, Tensor]:
+    """Gain per timestep (batch, time, slots) of one contract held in every
+    slot since the timestep before, and the timesteps closing it: its
+    contract expired (settled at intrinsic value) or another contract took
+    the slot (closed at its last mark)
+    terms: (batch, time, slots, TERMS)
+    now: (batch, time) timestamps
+    expiry: (batch, time, slots) expiry timestamp of the contracts
+    Returns: (gain, closes, mark, price), mark and price as marks returns
+    """
+    has_data = ~torch.isnan(close)
+    mark, price = marks(close, price)
+    held = shift(ffill(terms, has_data.unsqueeze(-1).expand_as(terms)))
+    expired = shift(ffill(expiry, has_data)) <= now.unsqueeze(-1)
+    replaced = has_data & (terms != held).any(-1)
+
+    spot = price.unsqueeze(-1)
+    strike, is_call = held[..., 0], held[..., 2]
+    intrinsic = torch.where(is_call == 1, spot - strike, strike - spot)
+    last = shift(mark)
+    gain = torch.where(replaced, torch.zeros_like(mark), mark - last)
+    gain = torch.where(expired, intrinsic.clamp(min=0) - last, gain)
+    return gain, expired | replaced, mark, price
+
+
+def fees(actions: Tensor, mark: Tensor, price: Tensor, commission: float,
+         half_spread: float, fee_cap: float = FEE_CAP) -> Tensor:
+    """Trading costs (batch, time) of actions"""
+    price = price.unsqueeze(-1)
+    fee = (torch.minimum(commission * price, fee_cap * mark)
+           + half_spread * price)
+    return (actions.abs() * fee).sum(-1)
+
+
+def pnl_kernel(close: Tensor, price: Tensor, delta: Tensor, terms: Tensor,
+               now: Tensor, expiry: Tensor, live: Tensor, actions: Tensor,
+               commission: float, half_spread: float,
+               fee_cap: float = FEE_CAP) -> Tuple[Tensor, Tensor, Tensor]:
+    """P&L per timestep (batch, time) of actions: mark-to-market, trading
+    costs and delta-hedged (mark-to-market plus the P&L of shorting the
+    delta of the porfolio in the underlying)
+    close: (batch, time, slots) option price, in coin
+    price: (batch, time) underlying price
+    delta: (batch, time, slots)
+    terms, now, expiry: see unit_gains
+    live: (batch, time, slots) contracts that can be traded
+    fee_cap: an argument, TorchScript does not read module globals
+    """
+    gain, closes, mark, price = unit_gains(close, price, terms, now, expiry)
+    trades = torch.where(live, actions, torch.zeros_like(actions))
+    traded = trades.cumsum(1)
+    # a closed position restarts from the trades of the timestep closing it
+    held = shift(traded - ffill(traded - trades, closes))
+
+    mtm = (held * gain).sum(-1)
+    hedge = -(held * shift(torch.nan_to_num(delta))).sum(-1)
+    hedged = mtm + hedge * (price - shift(price))
+    cost = fees(trades, mark, price, commission, half_spread, fee_cap)
+    return mtm, cost, hedged
+
+
+def compile_kernel(mode: str = None):
+    """pnl_kernel as TorchScript (mode 'script') or torch.compile (mode
+    'compile'), faster on cpu; mode None is the eager function
+    """
+    if mode == 'script':
+        return torch.jit.script(pnl_kernel)
+    if mode == 'compile':
+        return torch.compile(pnl_kernel)
+    return pnl_kernel
+
+
+def inputs(batch) -> Tuple[Tensor, Tensor, Tensor, Tensor, Tensor, Tensor,
+                           Tensor]:
+    """close, underlying price, delta, terms, timestamps, expiry timestamps
+    and live mask of the episode batch, as float64; the price is shared by
+    the slots, NaN at timesteps where none has data
+    """
+    data, live, timestamps, to_expiry = batch
+    close = data[..., tensor_store.feature('CLOSE')].double()
+    delta = data[..., tensor_store.feature('D')].double()
+    terms = data[..., [tensor_store.feature(c) for c in TERMS]].double()
+    price = torch.nan_to_num(data[..., tensor_store.feature('PRICE')].double(),
+                             nan=-float('inf')).amax(-1)
+    price = torch.where(torch.isfinite(price), price,
+                        torch.full_like(price, float('nan')))
+    now = timestamps.double()
+    expiry = now.unsqueeze(-1) + to_expiry.double()
+    return close, price, delta, terms, now, expiry, live
+
+
+def pnl(batch, actions: Tensor, costs: dict = NO_COSTS,
+        kernel=pnl_kernel) -> dict:
+    """P&L per timestep (batch, time) of actions over the episode batch
+    kernel: pnl_kernel or its compiled version (see compile_kernel)
+    Returns: {'mtm', 'costs', 'hedged', 'net' (mtm - costs),
+        'hedged_net' (hedged - costs)}
+    """
+    mtm, cost, hedged = kernel(*inputs(batch), actions.double(),
+                               costs['taker_commission'],
+                               costs['tick_size'] / 2)
+    return {'mtm': mtm, 'costs': cost, 'hedged': hedged, 'net': mtm - cost,
+            'hedged_net': hedged - cost}
+
+
+def delayed_reward(batch, actions: Tensor, delay: int,
+                   costs: dict = NO_COSTS) -> Tensor:
+    """Reward of the actions of every timestep: the gain of the contracts
+    traded over the next delay timesteps, or until they are closed if that
+    comes first, net of trading costs
+    Returns: (batch, time - delay)
+    """
+    close, price, _, terms, now, expiry, live = inputs(batch)
+    gain, closes, mark, price = unit_gains(close, price, terms, now, expiry)
+    actions = actions.double()
+    trades = torch.where(live, actions, torch.zeros_like(actions))
+
+    # first timestep after every t closing its contract (steps if none)
+    steps = close.shape[1]
+    t = torch.arange(steps, device=close.device).view(1, -1, 1)
+    t = t.expand_as(closes)
+    at = torch.where(closes, t, torch.full_like(t, steps))
+    next_close = at.flip(1).cummin(1)[0].flip(1)
+    next_close = torch.cat(
+        [next_close[:, 1:], torch.full_like(at[:, :1], steps)], 1)
+    end = torch.minimum(t + delay, next_close).clamp(max=steps - 1)
+
+    cumulative = gain.cumsum(1)
+    gained = (trades * (cumulative.gather(1, end) - cumulative)).sum(-1)
+    cost = fees(trades, mark, price, costs['taker_commission'],
+                costs['tick_size'] / 2)
+    return (gained - cost)[:, :steps - delay]
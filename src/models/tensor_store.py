@@ -0,0 +1,254 @@
+"""Dense tensors of the warehouse, read by the environment.
+Every contract of an underlying gets a slot, reused once the contract that
+held it has no more data, and its hourly rows are laid out as a
+(time, slot, feature) float32 array next to the (time, slot) ids of the
+contract in every cell (-1: empty). Both are .npy files read memory-mapped,
+built once per underlying in ./data/processed/tensors/<coin> and rebuilt
+only when the warehouse has newer data than the one they were built from.
+
+Next to them is an index of the contracts alive at every timestamp, sorted by
+log-moneyness, log(strike / price): the contracts within any moneyness band
+at any timestamp are a contiguous range of it, found with a binary search, so
+bands and expiry horizons are chosen when reading, without a rebuild.
+"""
+from contextlib import closing
+import heapq
+import json
+import os
+import shutil
+import sqlite3
+
+import numpy as np
+
+
+TENSOR_DIR = './data/processed/tensors'
+
+# PRICE and VOLATILITY are the underlying's, the rest the contract's (as
+# float32, EXPIRATION is only exact to about a minute)
+FEATURES = ['PRICE', 'VOLATILITY', 'D', 'V', 'T', 'G', 'R', 'IV',
+            'FAIR_PRICE', 'IS_CALL', 'EXPIRATION', 'STRIKE', 'OPEN', 'CLOSE',
+            'HIGH', 'LOW', 'VOLUME']
+CONTRACT_FEATURES = FEATURES[2:]
+# contract rows read from the warehouse at a time
+CHUNK_ROWS = 500_000
+# timestamps indexed at a time
+INDEX_BLOCK = 4096
+# index keys are t_idx * MONEYNESS_SPAN + log-moneyness, clipped to fit
+MONEYNESS_SPAN = 16
+
+ARRAYS = ['timestamps', 'features', 'contracts', 'to_expiry', 'live_keys',
+          'live_slots', 'live_expiry']
+
+
+def feature(name: str) -> int:
+    """Index of a feature in the last axis of the tensor"""
+    return FEATURES.index(name)
+
+
+def assign_slots(first: np.ndarray, last: np.ndarray) -> np.ndarray:
+    """Slot of every contract, given the first and last timestamp it has data.
+    Contracts whose lifetimes do not overlap share a slot (greedy interval
+    colouring), so there are as many slots as contracts alive at once.
+    """
+    slots = np.empty(len(first), dtype=np.int32)
+    busy = []  # heap of (last timestamp, slot)
+    free = []  # heap of released slots
+    n_slots = 0
+    for i in np.argsort(first, kind='stable'):
+        while busy and busy[0][0] < first[i]:
+            heapq.heappush(free, heapq.heappop(busy)[1])
+        if free:
+            slot = heapq.heappop(free)
+        else:
+            slot, n_slots = n_slots, n_slots + 1
+        slots[i] = slot
+        heapq.heappush(busy, (last[i], slot))
+    return slots
+
+
+def warehouse_key(con, underlying_id: int) -> dict:
+    """What the tensors of underlying_id were built from: they are stale when
+    the warehouse has newer data or the features changed
+    """
+    cursor = con.cursor()
+    underlying = cursor.execute(
+        'SELECT MAX(TIMESTAMP) FROM UNDERLYING_DATA WHERE UNDERLYING_ID = ?',
+        (underlying_id,)).fetchone()[0]
+    contracts = cursor.execute(
+        'SELECT MAX(TIMESTAMP) FROM CONTRACTS_DATA').fetchone()[0]
+    return {'underlying': underlying, 'contracts': contracts,
+            'features': FEATURES, 'arrays': ARRAYS}
+
+
+def _built_key(path: str) -> dict:
+    try:
+        with open(f'{path}/key.json') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def build(db_file: str, underlying: str, tensor_dir: str = TENSOR_DIR,
+          force: bool = False) -> str:
+    """Builds the tensors of underlying from the warehouse, unless the ones
+    already in tensor_dir are up to date. The arrays are written in place
+    (memory-mapped) from chunks of rows, so the whole table is never in
+    memory, to a temporary directory renamed over the old one at the end,
+    so readers never see half a build.
+    Returns: the directory holding them
+    """
+    path = f'{tensor_dir}/{underlying}'
+    with closing(sqlite3.connect(db_file)) as con:
+        cursor = con.cursor()
+        row = cursor.execute('SELECT ID FROM UNDERLYING_META WHERE NAME = ?',
+                             (underlying,)).fetchone()
+        if row is None:
+            raise ValueError(f'{underlying} is not in {db_file}')
+        underlying_id = row[0]
+        key = warehouse_key(con, underlying_id)
+        if not force and _built_key(path) == key:
+            return path
+
+        rows = cursor.execute("""SELECT TIMESTAMP, CLOSE, VOLATILITY
+            FROM UNDERLYING_DATA WHERE UNDERLYING_ID = ?
+            ORDER BY TIMESTAMP""", (underlying_id,)).fetchall()
+        times, price, volatility = np.array(
+            rows, dtype=np.float64).reshape(-1, 3).T
+
+        rows = cursor.execute("""SELECT D.CONTRACT_ID, MIN(D.TIMESTAMP),
+            MAX(D.TIMESTAMP) FROM CONTRACTS_DATA D
+            JOIN CONTRACTS_META M ON M.ID = D.CONTRACT_ID
+            WHERE M.UNDERLYING_ID = ?
+            GROUP BY D.CONTRACT_ID ORDER BY D.CONTRACT_ID""",
+                              (underlying_id,)).fetchall()
+        ids, first, last = np.array(rows, dtype=np.float64).reshape(-1, 3).T
+        ids = ids.astype(np.int64)
+        slots = assign_slots(first, last)
+        n_slots = int(slots.max()) + 1 if len(slots) else 0
+
+        tmp_path = f'{path}.tmp-{os.getpid()}'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        np.save(f'{tmp_path}/timestamps.npy', times)
+        features = np.lib.format.open_memmap(
+            f'{tmp_path}/features.npy', mode='w+', dtype=np.float32,
+            shape=(len(times), n_slots, len(FEATURES)))
+        contracts = np.lib.format.open_memmap(
+            f'{tmp_path}/contracts.npy', mode='w+', dtype=np.int32,
+            shape=(len(times), n_slots))
+        # exact seconds to expiry (float32 EXPIRATION is not)
+        to_expiry = np.lib.format.open_memmap(
+            f'{tmp_path}/to_expiry.npy', mode='w+', dtype=np.int32,
+            shape=(len(times), n_slots))
+        features[:] = np.nan
+        contracts[:] = -1
+        to_expiry[:] = 0
+
+        meta = ('IS_CALL', 'EXPIRATION', 'STRIKE')
+        columns = ', '.join(f'M.{c}' if c in meta else f'D.{c}'
+                            for c in CONTRACT_FEATURES)
+        expiration = 2 + CONTRACT_FEATURES.index('EXPIRATION')
+        cursor.execute(f"""SELECT D.CONTRACT_ID, D.TIMESTAMP, {columns}
+            FROM CONTRACTS_DATA D JOIN CONTRACTS_META M ON M.ID = D.CONTRACT_ID
+            WHERE M.UNDERLYING_ID = ?""", (underlying_id,))
+        while len(times) and (rows := cursor.fetchmany(CHUNK_ROWS)):
+            chunk = np.array(rows, dtype=np.float64)
+            t_idx = np.minimum(np.searchsorted(times, chunk[:, 1]),
+                               len(times) - 1)
+            # contract rows without an underlying row at their timestamp have
+            # no price
+            found = times[t_idx] == chunk[:, 1]
+            chunk, t_idx = chunk[found], t_idx[found]
+            contract = chunk[:, 0].astype(np.int64)
+            slot = slots[np.searchsorted(ids, contract)]
+
+            features[t_idx, slot, 0] = price[t_idx]
+            features[t_idx, slot, 1] = volatility[t_idx]
+            features[t_idx, slot, 2:] = chunk[:, 2:]
+            contracts[t_idx, slot] = contract
+            to_expiry[t_idx, slot] = chunk[:, expiration] - chunk[:, 1]
+
+        keys, live_slots, live_expiry = build_index(features, to_expiry)
+        np.save(f'{tmp_path}/live_keys.npy', keys)
+        np.save(f'{tmp_path}/live_slots.npy', live_slots)
+        np.save(f'{tmp_path}/live_expiry.npy', live_expiry)
+        for array in (features, contracts, to_expiry):
+            array.flush()
+        del features, contracts, to_expiry
+
+        with open(f'{tmp_path}/key.json', 'w') as f:
+            json.dump(key, f)
+        # the old build is renamed aside, not deleted, before the new one
+        # takes its place: a failed swap leaves one of them in place
+        old_path = f'{path}.old-{os.getpid()}'
+        if os.path.exists(path):
+            os.replace(path, old_path)
+        os.replace(tmp_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
+    return path
+
+
+def build_index(features: np.ndarray, to_expiry: np.ndarray) -> tuple:
+    """Index of the contracts alive (with data, not expired) at every
+    timestamp, ordered by timestamp then log-moneyness; built INDEX_BLOCK
+    timestamps at a time
+    Returns: keys (t_idx * MONEYNESS_SPAN + log-moneyness, sorted), and the
+        slot and seconds to expiry of every entry
+    """
+    blocks = []
+    limit = MONEYNESS_SPAN / 2 - 1e-3
+    for start in range(0, len(features), INDEX_BLOCK):
+        block = features[start:start + INDEX_BLOCK]
+        expiry = to_expiry[start:start + INDEX_BLOCK]
+        alive = ~np.isnan(block[..., feature('CLOSE')]) & (expiry > 0)
+        t_idx, slot = np.nonzero(alive)
+        price = block[t_idx, slot, feature('PRICE')].astype(np.float64)
+        strike = block[t_idx, slot, feature('STRIKE')].astype(np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            moneyness = np.nan_to_num(np.log(strike / price), nan=limit)
+        keys = ((start + t_idx) * MONEYNESS_SPAN
+                + np.clip(moneyness, -limit, limit))
+        order = np.argsort(keys, kind='stable')
+        blocks.append((keys[order], slot[order].astype(np.int32),
+                       expiry[t_idx, slot][order]))
+    if not blocks:
+        return (np.zeros(0), np.zeros(0, dtype=np.int32),
+                np.zeros(0, dtype=np.int32))
+    return tuple(np.concatenate(b) for b in zip(*blocks))
+
+
+def live(tensors: dict, i0: int, i1: int, band: tuple = (0.5, 1.5),
+         future_distance: float = None) -> tuple:
+    """Contracts of timestamps i0 to i1 (excluded) within the moneyness band,
+    band[0] * price < strike < band[1] * price, and expiring within
+    future_distance seconds (None: any)
+    Returns: (t, slot) arrays, t relative to i0
+    """
+    keys = tensors['live_keys']
+    steps = np.arange(i0, i1)
+    with np.errstate(divide='ignore'):
+        low, high = np.clip(np.log(band), -MONEYNESS_SPAN / 2,
+                            MONEYNESS_SPAN / 2)
+    # strict bounds: keys above low, below high
+    lo = np.searchsorted(keys, steps * MONEYNESS_SPAN + low, side='right')
+    hi = np.searchsorted(keys, steps * MONEYNESS_SPAN + high, side='left')
+    counts = np.maximum(hi - lo, 0)
+    entries = (np.repeat(lo - np.cumsum(counts) + counts, counts)
+               + np.arange(counts.sum()))
+    t = np.repeat(steps - i0, counts)
+    slot = tensors['live_slots'][entries]
+    if future_distance is not None:
+        soon = tensors['live_expiry'][entries] < future_distance
+        t, slot = t[soon], slot[soon]
+    return t, slot
+
+
+def load(path: str) -> dict:
+    """Tensors built in path, memory-mapped read-only: slices are views of
+    the files, copied by readers that need to write to them
+    Returns: {'timestamps': (time,), 'features': (time, slot, feature),
+        'contracts': (time, slot), 'to_expiry': (time, slot), and the index
+        of live contracts (see build_index)}
+    """
+    return {name: np.load(f'{path}/{name}.npy', mmap_mode='r')
+            for name in ARRAYS}
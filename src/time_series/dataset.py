@@ -1,75 +1,155 @@
-import pytorch_forecasting as ptf
-import pytorch_lightning as pl
+import hashlib
+import os
 import sqlite3
+
+import numpy as np
 import pandas as pd
+import pytorch_forecasting as ptf
+import pytorch_lightning as pl
+
+
+CACHE_DIR = './data/processed/time_series'
+HOUR = 3600
+# rows read from the warehouse at a time
+CHUNK_SIZE = 100_000
+
+REALS = ["open", "high", "low", "close",
+    "volume", "chain_tx", "chain_volume", "recent_price",
+    "recent_volume", "recent_tx", "volatility"]
+
+
+def data_key(db_file: str, start: float = None, end: float = None) -> str:
+    """Key of the data between start and end: changes when the warehouse has
+    a newer timestamp
+    """
+    con = sqlite3.connect(db_file)
+    last = con.execute(
+        "SELECT MAX(TIMESTAMP) FROM UNDERLYING_DATA").fetchone()[0]
+    con.close()
+    return hashlib.md5(repr((last, start, end, REALS)).encode()).hexdigest()
+
+
+def load_underlying(db_file: str, start: float = None, end: float = None,
+                    cache_dir: str = CACHE_DIR) -> pd.DataFrame:
+    """Hourly UNDERLYING_DATA between start and end (epoch s, None: all), with
+    only the columns the model uses, as float32, and its time_idx. Read in
+    chunks; the prepared frame is cached in cache_dir and reused until the
+    warehouse has a newer timestamp.
+    """
+    cache_file = f'{cache_dir}/underlying-{data_key(db_file, start, end)}.pkl'
+    if os.path.exists(cache_file):
+        return pd.read_pickle(cache_file)
+
+    con = sqlite3.connect(db_file)
+
+    query = f"""SELECT UNDERLYING_ID, TIMESTAMP, {', '.join(REALS)}
+                FROM UNDERLYING_DATA
+                WHERE TIMESTAMP >= ? AND TIMESTAMP <= ?
+                ORDER BY UNDERLYING_ID, TIMESTAMP;"""
+    bounds = (-np.inf if start is None else start,
+              np.inf if end is None else end)
+    chunks = [chunk.astype({c: np.float32 for c in chunk.columns[2:]})
+              for chunk in pd.read_sql_query(query, con, params=bounds,
+                                             chunksize=CHUNK_SIZE)]
+    con.close()
+    columns = ['UNDERLYING_ID', 'TIMESTAMP', *REALS]
+    dataframe = (pd.concat(chunks, ignore_index=True) if chunks
+                 else pd.DataFrame(columns=columns))
+    dataframe.columns = list(map(lambda x: x.lower(), dataframe.columns))
+    dataframe["time_idx"] = make_idx(dataframe["underlying_id"],
+                                     dataframe["timestamp"])
+    # group ids are encoded as categories by pytorch_forecasting
+    dataframe["underlying_id"] = (dataframe["underlying_id"].astype(str)
+                                  .astype("category"))
+
+    os.makedirs(cache_dir, exist_ok=True)
+    dataframe.to_pickle(f'{cache_file}.tmp')
+    os.replace(f'{cache_file}.tmp', cache_file)
+    return dataframe
+
+
+def make_idx(groups: pd.Series, timestamps: pd.Series) -> np.ndarray:
+    """This function converts epoch timestamps (s) to the hour index of each
+    row within its group, starting from 0 at the first hour of the group;
+    missing hours leave gaps.
+    """
+    timestamps = timestamps.to_numpy(dtype=np.int64)
+    first = (pd.Series(timestamps).groupby(groups.to_numpy())
+             .transform('min').to_numpy())
+    return (timestamps - first) // HOUR
+
 
 class Dataset(pl.LightningDataModule):
+    """Underlying time series for pytorch_forecasting. The training
+    TimeSeriesDataSet (normalisers, encoders and index fitted on the train
+    split) is built once and the validation one derived from it with
+    from_dataset; both are saved in CACHE_DIR and loaded by later runs with
+    the same data and windows.
+    """
     def __init__(self, args):
         self.args = args
-        self.query = """SELECT
-                            ID, UNDERLYING_ID,
-                            TIMESTAMP,
-                            OPEN, HIGH, LOW, CLOSE,
-                            VOLUME, CHAIN_TX, CHAIN_VOLUME,
-                            RECENT_PRICE, RECENT_VOLUME, RECENT_TX,
-                            VOLATILITY
-                        FROM
-                            UNDERLYING_DATA;"""
-
-        self.con = sqlite3.connect(args.DATA_WAREHOUSE_FILE)
-        self.dataframe = pd.read_sql_query(self.query, self.con)
-        self.dataframe.columns = list(map(lambda x: x.lower(), self.dataframe.columns))
-        self.dataframe["time_idx"] = self.make_idx(self.dataframe["timestamp"])
-
-        self.train_size = int(len(self.dataframe) * args.train_size)
+        start, end = getattr(args, "start", None), getattr(args, "end", None)
+        self.dataframe = load_underlying(args.DATA_WAREHOUSE_FILE, start, end)
+
+        # every series is split at the same hour, counted from its first one
+        hours = self.dataframe["time_idx"].max() + 1
+        self.train_size = (int(hours * args.train_size)
+                           if len(self.dataframe) else 0)
 
         self.back_window = args.back_window
         self.train_forward_window = args.train_forward_window
         self.val_forward_window = args.val_forward_window
 
-    def train_dataloader(self):
-        train_dataset = ptf.TimeSeriesDataSet(
+        key = (data_key(args.DATA_WAREHOUSE_FILE, start, end),
+               args.train_size, self.back_window, self.train_forward_window,
+               self.val_forward_window)
+        self.key = hashlib.md5(repr(key).encode()).hexdigest()
+        self.datasets = {}
+
+    def cached(self, name: str, build) -> ptf.TimeSeriesDataSet:
+        """Dataset name, from memory, from CACHE_DIR or built (and saved)"""
+        if name not in self.datasets:
+            path = f'{CACHE_DIR}/{name}-{self.key}.pt'
+            if os.path.exists(path):
+                self.datasets[name] = ptf.TimeSeriesDataSet.load(path)
+            else:
+                self.datasets[name] = build()
+                os.makedirs(CACHE_DIR, exist_ok=True)
+                self.datasets[name].save(f'{path}.tmp')
+                os.replace(f'{path}.tmp', path)
+        return self.datasets[name]
+
+    def train_dataset(self) -> ptf.TimeSeriesDataSet:
+        return self.cached("train", lambda: ptf.TimeSeriesDataSet(
             self.dataframe[self.dataframe["time_idx"] < self.train_size],
             time_idx="time_idx",
             target="close",
             max_encoder_length=self.back_window,
             max_prediction_length=self.train_forward_window,
-            time_varying_unknown_reals=["open", "high", "low", "close",
-                "volume", "chain_tx", "chain_volume", "recent_price",
-                "recent_volume", "recent_tx", "volatility"],
-        )
-        return train_dataset.to_dataloader(batch_size=self.args.batch_size, shuffle=True)
+            group_ids=["underlying_id"],
+            time_varying_unknown_reals=REALS,
+            allow_missing_timesteps=True,
+        ))
 
-    def val_dataloader(self):
-        val_dataset = ptf.TimeSeriesDataSet(
+    def val_dataset(self) -> ptf.TimeSeriesDataSet:
+        # reuses the normalisers and encoders fitted on the train split
+        return self.cached("val", lambda: ptf.TimeSeriesDataSet.from_dataset(
+            self.train_dataset(),
             self.dataframe,
-            time_idx="time_idx",
-            target="close",
-            max_encoder_length=self.back_window,
+            stop_randomization=True,
             max_prediction_length=self.val_forward_window,
-            time_varying_unknown_reals=["open", "high", "low", "close",
-                "volume", "chain_tx", "chain_volume", "recent_price",
-                "recent_volume", "recent_tx", "volatility"],
-        )
-        return val_dataset.to_dataloader(batch_size=self.args.batch_size, shuffle=False)
-
-    def make_idx(self, timestamps):
-        """This function converts a list of arbitrary timestamps to a sorted
-        list of indices, with increment 1, starting from 0.
-        """
-        return pd.DatetimeIndex(timestamps).sort_values().index.values
+        ))
+
+    def train_dataloader(self):
+        return self.train_dataset().to_dataloader(
+            batch_size=self.args.batch_size, shuffle=True)
+
+    def val_dataloader(self):
+        return self.val_dataset().to_dataloader(
+            batch_size=self.args.batch_size, shuffle=False)
 
     def sample_dataset(self) -> ptf.TimeSeriesDataSet:
-        """This function returns a TimeSeriesDataSet with all the data in the
-        dataset. This should be used to define models.
+        """This function returns the TimeSeriesDataSet models are defined
+        from (the training one: same features, encoders and normalisers).
         """
-        return ptf.TimeSeriesDataSet(
-            self.dataframe,
-            time_idx="time_idx",
-            target="close",
-            max_encoder_length=self.back_window,
-            max_prediction_length=self.train_forward_window,
-            time_varying_unknown_reals=["open", "high", "low", "close",
-                "volume", "chain_tx", "chain_volume", "recent_price",
-                "recent_volume", "recent_tx", "volatility"],
-        )
\ No newline at end of file
+        return self.train_dataset()
@@ -48,7 +48,7 @@ def main(args):
     warnings.filterwarnings('ignore')
     logger = logging.getLogger(__name__)
     dataset = Dataset(args)
-    model = get_model_from_dataset(args, dataset)
+    model = get_model_from_dataset(args, dataset.sample_dataset())
     callbacks_list = list()
     trainer = pl.Trainer.from_argparse_args(args, callbacks=callbacks_list)
 
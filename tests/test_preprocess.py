@@ -0,0 +1,44 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src',
+                                'data'))
+
+import benchmark  # noqa: E402
+import preprocess  # noqa: E402
+
+
+METRICS = ['delta', 'gamma', 'vega', 'theta', 'rho', 'value', 'iv']
+
+
+@pytest.fixture(scope='module')
+def raw_dir(tmp_path_factory):
+    raw = tmp_path_factory.mktemp('raw')
+    benchmark.synthetic_chain(str(raw), n_contracts=40, n_hours=72)
+    return str(raw)
+
+
+def run(raw_dir, workers, volatility_dir):
+    """Contract rows preprocess.main returns, from a fresh volatility state"""
+    os.makedirs(volatility_dir)
+    data = preprocess.main(workers, raw_dir, volatility_dir=volatility_dir)
+    return data[benchmark.COIN]
+
+
+def test_parallel_matches_serial(raw_dir, tmp_path):
+    serial = run(raw_dir, 1, str(tmp_path / 'serial'))
+    parallel = run(raw_dir, 2, str(tmp_path / 'parallel'))
+
+    contracts = serial[1]
+    assert len(contracts) and set(METRICS) <= set(contracts.columns)
+    # bit for bit: every metric is computed element-wise, whatever the chunk
+    for name in METRICS:
+        assert np.array_equal(contracts[name].to_numpy(),
+                              parallel[1][name].to_numpy()), name
+    pd.testing.assert_frame_equal(contracts, parallel[1], check_exact=True)
+    pd.testing.assert_frame_equal(serial[0], parallel[0], check_exact=True)
+    pd.testing.assert_frame_equal(serial[2], parallel[2], check_exact=True)
@@ -0,0 +1,109 @@
+import os
+import sys
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('gym')
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src',
+                                'models'))
+
+import environment  # noqa: E402
+import rewards  # noqa: E402
+import tensor_store  # noqa: E402
+
+
+BATCH, STEPS, SLOTS = 2, 12, 3
+HOUR = 3600
+COSTS = {'tick_size': 0.001, 'taker_commission': 0.0003,
+         'maker_commission': 0.0, 'min_trade': 0.0}
+
+
+@pytest.fixture
+def batch():
+    """Episode batch where slot 0 holds a contract expiring at t=5 and is
+    reused from t=7, slot 1 a contract with gaps expiring between two rows
+    and slot 2 a contract replaced at t=4 before its expiry
+    """
+    rng = np.random.default_rng(0)
+    times = 1_656_662_400 + np.arange(STEPS, dtype=np.float64) * HOUR
+    price = 100 * np.exp(np.cumsum(rng.normal(0, 0.05, (BATCH, STEPS)), 1))
+    state = np.full((BATCH, STEPS, SLOTS, len(tensor_store.FEATURES)),
+                    np.nan, dtype=np.float32)
+    to_expiry = np.zeros((BATCH, STEPS, SLOTS), dtype=np.int32)
+
+    def contract(slot, steps, strike, expiration, is_call):
+        for t in steps:
+            cell = state[:, t, slot]
+            cell[:] = rng.random(cell.shape)
+            cell[:, tensor_store.feature('PRICE')] = price[:, t]
+            cell[:, tensor_store.feature('CLOSE')] = rng.uniform(
+                0.01, 0.2, BATCH)
+            cell[:, tensor_store.feature('STRIKE')] = strike
+            cell[:, tensor_store.feature('EXPIRATION')] = expiration
+            cell[:, tensor_store.feature('IS_CALL')] = is_call
+            to_expiry[:, t, slot] = expiration - times[t]
+
+    contract(0, range(0, 6), 100, times[5], 1)
+    contract(0, range(7, 12), 110, times[11] + 5 * HOUR, 0)
+    contract(1, [0, 1, 2, 5, 6, 7, 8, 9, 10, 11], 90,
+             times[8] + HOUR // 2, 0)
+    contract(2, range(0, 4), 95, times[11] + 9 * HOUR, 1)
+    contract(2, range(4, 12), 105, times[11] + 9 * HOUR, 1)
+
+    live = (~np.isnan(state[..., tensor_store.feature('CLOSE')])
+            & (to_expiry > 0))
+    return (torch.from_numpy(state), torch.from_numpy(live),
+            torch.from_numpy(np.tile(times, (BATCH, 1))),
+            torch.from_numpy(to_expiry))
+
+
+def actions(seed=1):
+    rng = np.random.default_rng(seed)
+    return torch.from_numpy(
+        rng.integers(-3, 4, (BATCH, STEPS, SLOTS)).astype(np.float64))
+
+
+def step_rewards(batch, actions, steps=STEPS):
+    """Sum of the rewards of the first steps of DeribitEnv.step"""
+    env = environment.DeribitEnv(
+        SimpleNamespace(batch_size=BATCH, reward_delay=0), COSTS)
+    env.reset(batch)
+    total = torch.zeros(BATCH, dtype=torch.float64)
+    for t in range(steps):
+        _, reward, _, _ = env.step(actions[:, t])
+        total += reward
+    return total
+
+
+def test_gains_match_step_rewards(batch):
+    env = environment.DeribitEnv(
+        SimpleNamespace(batch_size=BATCH, reward_delay=0), COSTS)
+    env.reset(batch)
+    sequence = actions()
+    assert torch.allclose(env.get_gains(sequence),
+                          step_rewards(batch, sequence))
+
+
+def test_scripted_kernel_matches_eager(batch):
+    sequence = actions()
+    eager = rewards.pnl(batch, sequence, COSTS)
+    scripted = rewards.pnl(batch, sequence, COSTS,
+                           rewards.compile_kernel('script'))
+    for name, value in eager.items():
+        assert torch.allclose(value, scripted[name]), name
+
+
+@pytest.mark.parametrize('delay', [0, 1, 3])
+def test_delayed_reward_matches_step(batch, delay):
+    sequence = actions()
+    reward = rewards.delayed_reward(batch, sequence, delay, COSTS)
+    assert reward.shape == (BATCH, STEPS - delay)
+    for t in range(STEPS - delay):
+        only = torch.zeros_like(sequence)
+        only[:, t] = sequence[:, t]
+        assert torch.allclose(reward[:, t],
+                              step_rewards(batch, only, t + delay + 1))
@@ -0,0 +1,98 @@
+import os
+import sqlite3
+import sys
+from contextlib import closing
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src',
+                                'data'))
+
+import sql_create  # noqa: E402
+
+
+# the tables a warehouse had before versioning, without indexes
+BASELINE_TABLES = [
+    sql_create.create_underlying_meta_table,
+    sql_create.create_underlying_data_table,
+    sql_create.create_contracts_meta_table,
+    sql_create.create_contracts_data_table,
+    sql_create.create_meta_table,
+]
+
+
+def names(con, kind):
+    return {row[0] for row in con.execute(
+        'SELECT name FROM sqlite_master WHERE type = ? AND sql IS NOT NULL',
+        (kind,))}
+
+
+@pytest.fixture
+def baseline(tmp_path):
+    """Warehouse with the baseline schema (user_version 0) and the
+    duplicates blind re-inserts left: BTC and one contract stored twice,
+    and an underlying and a contract row loaded twice
+    """
+    with closing(sqlite3.connect(str(tmp_path / 'baseline.db'))) as con:
+        for table in BASELINE_TABLES:
+            con.execute(table)
+        con.executemany('INSERT INTO UNDERLYING_META (NAME) VALUES (?)',
+                        [('BTC',), ('ETH',), ('BTC',)])
+        con.executemany(
+            'INSERT INTO CONTRACTS_META (UNDERLYING_ID, NAME) VALUES (?, ?)',
+            [(1, 'BTC-1JUL22-12000-C'), (3, 'BTC-1JUL22-12000-C')])
+        con.executemany(
+            'INSERT INTO UNDERLYING_DATA (UNDERLYING_ID, TIMESTAMP, CLOSE) '
+            'VALUES (?, ?, ?)', [(1, 0, 100.0), (3, 0, 101.0), (2, 0, 5.0)])
+        con.executemany(
+            'INSERT INTO CONTRACTS_DATA (CONTRACT_ID, TIMESTAMP, CLOSE) '
+            'VALUES (?, ?, ?)', [(1, 0, 0.1), (2, 0, 0.2), (2, 3600, 0.3)])
+        con.executemany('INSERT INTO META (UNDERLYING_ID, TICK_SIZE) '
+                        'VALUES (?, ?)', [(1, 0.001), (3, 0.0005)])
+        con.commit()
+        yield con
+
+
+def test_migrate_baseline(baseline):
+    assert baseline.execute('PRAGMA user_version').fetchone()[0] == 0
+    sql_create.migrate(baseline)
+
+    assert (baseline.execute('PRAGMA user_version').fetchone()[0]
+            == sql_create.SCHEMA_VERSION)
+    assert {'WATERMARKS', 'VOL_SURFACE'} <= names(baseline, 'table')
+    assert names(baseline, 'index') == {
+        sql.split('EXISTS')[1].split()[0]
+        for sql in sql_create.create_indexes_list}
+
+    assert baseline.execute(
+        'SELECT ID, NAME FROM UNDERLYING_META ORDER BY ID').fetchall() == [
+        (1, 'BTC'), (2, 'ETH')]
+    assert baseline.execute(
+        'SELECT ID, UNDERLYING_ID FROM CONTRACTS_META').fetchall() == [(1, 1)]
+    # the newest row of every (id, timestamp) is kept
+    assert baseline.execute(
+        'SELECT UNDERLYING_ID, TIMESTAMP, CLOSE FROM UNDERLYING_DATA '
+        'ORDER BY UNDERLYING_ID').fetchall() == [(1, 0, 101.0), (2, 0, 5.0)]
+    assert baseline.execute(
+        'SELECT CONTRACT_ID, TIMESTAMP, CLOSE FROM CONTRACTS_DATA '
+        'ORDER BY TIMESTAMP').fetchall() == [(1, 0, 0.2), (1, 3600, 0.3)]
+    assert baseline.execute(
+        'SELECT UNDERLYING_ID, TICK_SIZE FROM META').fetchall() == [
+        (1, 0.0005)]
+
+
+def test_migrate_is_idempotent(baseline):
+    sql_create.migrate(baseline)
+    before = baseline.execute('SELECT * FROM UNDERLYING_DATA').fetchall()
+    sql_create.migrate(baseline)
+    assert baseline.execute('SELECT * FROM UNDERLYING_DATA').fetchall() \
+        == before
+
+
+def test_created_schema_is_current(tmp_path):
+    with closing(sql_create.connect(str(tmp_path / 'new.db'))) as con:
+        sql_create.create(con)
+        assert (con.execute('PRAGMA user_version').fetchone()[0]
+                == sql_create.SCHEMA_VERSION)
+        assert len(names(con, 'index')) == len(
+            sql_create.create_indexes_list)
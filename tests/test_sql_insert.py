@@ -0,0 +1,76 @@
+import os
+import sys
+from contextlib import closing
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src',
+                                'data'))
+
+import benchmark  # noqa: E402
+import insert_dataset  # noqa: E402
+import preprocess  # noqa: E402
+import sql_create  # noqa: E402
+import sql_insert  # noqa: E402
+
+
+KEYS = ['UNDERLYING_ID', 'TIMESTAMP']
+COLUMNS = [*KEYS, 'CLOSE', 'VOLUME']
+BATCH = [(1, t * 3600, 100.0 + t, 1.0) for t in range(5)]
+
+
+@pytest.fixture
+def con(tmp_path):
+    with closing(sql_create.connect(str(tmp_path / 'test.db'))) as con:
+        sql_create.create(con)
+        yield con
+
+
+def upsert(con, data):
+    return sql_insert.upsert_many(con, 'UNDERLYING_DATA', KEYS, COLUMNS, data)
+
+
+def stored(con):
+    return con.execute(f'SELECT {", ".join(COLUMNS)} FROM UNDERLYING_DATA '
+                       'ORDER BY TIMESTAMP').fetchall()
+
+
+def test_same_batch_twice(con):
+    assert upsert(con, BATCH) == {'inserted': 5, 'updated': 0, 'skipped': 0}
+    assert upsert(con, BATCH) == {'inserted': 0, 'updated': 0, 'skipped': 5}
+    assert stored(con) == BATCH
+
+
+def test_changed_and_new_rows(con):
+    upsert(con, BATCH)
+    changed = [*BATCH[:4], (1, 4 * 3600, 200.0, 1.0),
+               (1, 5 * 3600, 105.0, 1.0)]
+    assert upsert(con, changed) == {'inserted': 1, 'updated': 1,
+                                    'skipped': 4}
+    assert stored(con) == changed
+
+
+def test_repeated_key_last_wins(con):
+    data = [BATCH[0], (1, 0, 99.0, 2.0)]
+    assert upsert(con, data) == {'inserted': 1, 'updated': 0, 'skipped': 0}
+    assert stored(con) == [(1, 0, 99.0, 2.0)]
+
+
+def test_insert_connection_twice(con, tmp_path):
+    raw_dir = str(tmp_path / 'raw')
+    benchmark.synthetic_chain(raw_dir, n_contracts=8, n_hours=48)
+    volatility_dir = str(tmp_path / 'volatility')
+    os.makedirs(volatility_dir)
+    data = preprocess.main(1, raw_dir, volatility_dir=volatility_dir)
+    rows = {'underlying': len(data[benchmark.COIN][0]),
+            'contracts': len(data[benchmark.COIN][1]),
+            'surface': len(data[benchmark.COIN][2])}
+
+    def load():
+        return insert_dataset.insert_connection(
+            con, data, raw_dir=raw_dir, catalog_dir=str(tmp_path / 'cat'))
+
+    first, second = load(), load()
+    for name, n in rows.items():
+        assert first[name] == {'inserted': n, 'updated': 0, 'skipped': 0}
+        assert second[name] == {'inserted': 0, 'updated': 0, 'skipped': n}